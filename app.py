@@ -1,76 +1,319 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, current_app, has_request_context, render_template, request, redirect, url_for, session, flash, jsonify, abort
+from flask.cli import AppGroup, ScriptInfo
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, current_user, login_user, logout_user, login_required
 import os
-from flask_migrate import Migrate
+import sys
+import uuid
+import click
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
 from models import db, User, Patient, Caregiver, Appointment, Review
-from forms import RegistrationForm, PatientRegistrationForm, CaregiverRegistrationForm, ProfileForm, AppointmentForm
+from forms import RegistrationForm, PatientRegistrationForm, CaregiverRegistrationForm, ProfileForm, AppointmentForm, \
+    WeeklyScheduleForm, DayExceptionForm
+from search import find_caregivers, ensure_search_index, rebuild_search_index, DEFAULT_PER_PAGE, SORT_ORDERS
+from services import SERVICES, set_caregiver_services, care_needed_to_mask
+from ratings import backfill_ratings
+from leaderboard import leaderboard, LEADERBOARD_PER_PAGE
+from scheduling import reserve_slot, BookingConflict, MAX_DURATION_MINUTES
+from availability import availability_index, default_week, weekly_schedule, day_exceptions, set_weekly_schedule, \
+    set_day_exception, clear_day_exception, parse_ranges, format_ranges
+from geo import caregiver_index
+from pagination import upcoming_appointments
+from user_cache import user_cache
+import database
+from database import submit_write
+import jobs
+import licenses
+from licenses import schedule_verification
+import reminders
+from reminders import reminder_schedule
+import hashing
+from hashing import hash_password, verify_password, needs_rehash, HashingBusy
+import metrics
+import pagecache
+import jinja_cache
+from pagecache import page_cache, cached_page, per_user_page
+import applog
+from applog import log
+
+# Routes and CLI commands are collected here and attached to every app
+# create_app builds, so importing this module does not build an app
+_routes = []
+commands = AppGroup('careconnect')
+login_manager = LoginManager()
+
+
+def route(rule, **options):
+    # Takes the same arguments as Flask.route
+    def decorator(view):
+        _routes.append((rule, view, options))
+        return view
+    return decorator
 
-load_dotenv()  # Load environment variables from .env file
-
-# Create Flask Instance
-app = Flask(__name__, template_folder='templates', static_folder='static')
-
-login_manager = LoginManager(app)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Served from the in-process user cache, falling back to a primary key lookup
+    return user_cache.get(int(user_id))
+
+
+class _LazyMigrateGroup(click.Group):
+    # `flask db ...` without importing Alembic in every worker: Flask-Migrate
+    # is only set up once a db subcommand is looked up
+
+    def _migrate_group(self, ctx):
+        from flask_migrate import Migrate
+        from flask_migrate.cli import db as migrate_group
+        app = ctx.ensure_object(ScriptInfo).load_app()
+        if 'migrate' not in app.extensions:
+            Migrate(app, db)
+        return migrate_group
+
+    def list_commands(self, ctx):
+        return self._migrate_group(ctx).list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._migrate_group(ctx).get_command(ctx, name)
+
+
+def _reset_process_state():
+    # The in-memory caches and indexes hold rows of whichever database the
+    # previous app used; they fill again lazily from the new one
+    user_cache.clear()
+    page_cache.clear()
+    caregiver_index.clear()
+    availability_index.loaded = False
+    leaderboard.loaded = False
+    reminder_schedule.clear()
+    dispatch = sys.modules.get('dispatch')
+    if dispatch is not None:
+        dispatch.dispatch_engine.loaded = False
+
+
+def _payments():
+    # The payment ledger is imported, and set up for this app, on first use
+    # (PAYMENT_* settings); a request, not a CLI command, also starts the
+    # background settlement
+    import payments
+    app = current_app._get_current_object()
+    batcher = payments.init_app(app)
+    if has_request_context() and app.config.get('PAYMENT_SETTLEMENT', payments.PAYMENT_SETTLEMENT):
+        batcher.start()
+    return payments
+
+
+def _payment_stats():
+    payments = sys.modules.get('payments')
+    return payments.stats() if payments is not None else {}
+
+
+def create_app(config=None):
+    load_dotenv()  # Load environment variables from .env file
+
+    # Create Flask Instance
+    app = Flask(__name__, template_folder='templates', static_folder='static')
 
-app.secret_key = os.getenv('SECRET_KEY')
+    app.secret_key = os.getenv('SECRET_KEY')
 
-# Configure the database URI
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///careconnect.db'
+    # Configure the database URI
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///careconnect.db')
 
-# Suppress deprecation warnings
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Suppress deprecation warnings
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# Use the db instance from models.py
-db.init_app(app)
+    # Settings passed in (tests, benchmarks, tools) override the environment
+    app.config.update(config or {})
 
-migrate = Migrate(app, db)
+    login_manager.init_app(app)
+
+    # Use the db instance from models.py
+    db.init_app(app)
+
+    # WAL and other connection pragmas, and the single writer thread (SQLITE_* settings)
+    database.init_app(app)
+
+    # Password hashing runs on its own bounded pool (PASSWORD_HASH_* settings)
+    hashing.init_app(app)
+
+    # Structured logs go through a background writer thread (LOG_* settings)
+    applog.init_app(app)
+
+    # Whole anonymous pages, per-user fragments and 304s (PAGE_CACHE_* and FRAGMENT_CACHE_SIZE)
+    pagecache.init_app(app)
+
+    # Compiled templates kept on disk and loaded before serving (TEMPLATE_* settings)
+    jinja_cache.init_app(app)
+
+    # Background jobs on SQLite-backed queues, worked from the first request on (JOB_* settings)
+    jobs.init_app(app)
+
+    # Batched, cached license checks against the registry (LICENSE_* settings)
+    licenses.init_app(app)
+
+    # Appointment reminders from an in-memory timing wheel, sent in batches (REMINDER* settings)
+    reminders.init_app(app)
+
+    # Per-endpoint latency and SQL counters on /metrics (METRICS_ENABLED = False turns them off)
+    metrics.init_app(app)
+    metrics.add_gauges('user_cache', user_cache.stats, 'User loader cache statistics.')
+    metrics.add_gauges('password_hashing', hashing.hashing_pool.stats, 'Password hashing pool statistics.')
+    metrics.add_gauges('log', applog.stats, 'Background log writer statistics.')
+    metrics.add_gauges('write_queue', database.write_queue.stats, 'Database writer queue statistics.')
+    metrics.add_gauges('page_cache', page_cache.stats, 'Page and fragment cache statistics.')
+    metrics.add_gauges('jobs', jobs.stats, 'Background job worker statistics.')
+    metrics.add_gauges('licenses', licenses.stats, 'License registry lookup statistics.')
+    metrics.add_gauges('payments', _payment_stats, 'Payment settlement statistics.')
+    metrics.add_gauges('reminders', reminders.stats, 'Appointment reminder statistics.')
+
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    for command in commands.commands.values():
+        app.cli.add_command(command)
+    app.cli.add_command(_LazyMigrateGroup('db', help='Perform database migrations.'))
+
+    _reset_process_state()
+    return app
+
+@commands.command('reindex-caregivers')
+def reindex_caregivers():
+    # Rebuild the caregiver full-text index from scratch
+    rebuild_search_index()
+    db.session.commit()
+    print('Caregiver search index rebuilt.')
+
+@commands.command('backfill-ratings')
+def backfill_ratings_command():
+    # Recompute every caregiver's rating aggregates from the review table
+    backfill_ratings()
+    db.session.commit()
+    print('Caregiver ratings recomputed.')
 
-def process_payment(amount):
-    # Placeholder logic for payment processing
-    return 'success'
+@commands.command('geocode-locations')
+def geocode_locations():
+    # Fill in coordinates for patients and caregivers saved before geocoding
+    from geo import geocode_missing_locations
+    updated = geocode_missing_locations()
+    db.session.commit()
+    print(f'Geocoded {updated} locations.')
+
+@commands.command('dispatch-pending')
+def dispatch_pending():
+    # Match every appointment booked without a caregiver to one, in one batch
+    from dispatch import dispatch_engine, pending_appointments
+    appointments = pending_appointments()
+    matched = dispatch_engine.dispatch_batch(appointments)
+    db.session.commit()
+    print(f'Dispatched {len(matched)} of {len(appointments)} pending appointments.')
+
+@commands.command('precompile-templates')
+@click.option('--rebuild', is_flag=True, help='Discard the bytecode cache and compile from source.')
+def precompile_templates(rebuild):
+    # Compile every template into the bytecode cache and show what each took
+    if rebuild and current_app.jinja_env.bytecode_cache is not None:
+        current_app.jinja_env.bytecode_cache.clear()
+    timings = jinja_cache.precompile(current_app, reload=True)
+    for name, seconds, error in timings:
+        print(f'{seconds * 1000:8.2f} ms  {name}' + (f'  FAILED: {error}' if error else ''))
+    print(f'{len(timings)} templates in {sum(seconds for _, seconds, _ in timings) * 1000:.2f} ms.')
+
+@commands.command('run-jobs')
+@click.option('--queue', 'queues', multiple=True, help='Only work this queue; repeat for several (default: all).')
+def run_jobs(queues):
+    # Work the job queues in this process until interrupted, e.g. beside
+    # web processes started with JOB_WORKERS = False
+    runner = current_app.extensions['jobs']
+    runner.start(queues or None)
+    print(f"Working {', '.join(queues or runner.queues)}; Ctrl+C to stop.")
+    try:
+        while not runner.wait(1):
+            pass
+    except KeyboardInterrupt:
+        runner.stop()
+
+@commands.command('verify-licenses')
+def verify_licenses():
+    # Verify every pending caregiver license now, e.g. right after an agency's caregivers are imported
+    checked, lookups = licenses.verify_pending()
+    print(f'Verified {checked} caregiver licenses in {lookups} registry lookups.')
+
+@commands.command('run-reminders')
+def run_reminders():
+    # Send appointment reminders from this process until interrupted, e.g.
+    # beside web processes started with REMINDERS = False
+    runner = current_app.extensions['reminders']
+    runner.start()
+    print('Sending appointment reminders; Ctrl+C to stop.')
+    try:
+        while not runner.wait(1):
+            pass
+    except KeyboardInterrupt:
+        runner.stop()
+
+@commands.command('settle-payments')
+def settle_payments():
+    # Settle every pending payment now instead of waiting for the next settlement run
+    batches, settled, declined = _payments().settle_pending()
+    print(f'Settled {settled} and declined {declined} payments in {batches} batches.')
+
+@commands.command('reconcile-payments')
+@click.option('--since', type=click.DateTime(), help='Only ledger entries from this time on.')
+@click.option('--until', type=click.DateTime(), help='Only ledger entries before this time.')
+def reconcile_payments(since, until):
+    report = _payments().reconciliation_report(since, until)
+    for kind, total in report['totals'].items():
+        print(f"{kind:10} {total['count']:>8} {total['amount_cents'] / 100:>14,.2f}")
+    outstanding = report['outstanding']
+    print(f"{'pending':10} {outstanding['count']:>8} {outstanding['amount_cents'] / 100:>14,.2f}")
+    unbalanced = [batch for batch in report['batches'] if not batch['balanced']]
+    print(f"{len(report['batches'])} settlement batches, {len(unbalanced)} not balanced.")
+    for batch in unbalanced:
+        print(f"  {batch['batch_ref']} submitted {batch['submitted_at']:%Y-%m-%d %H:%M}: "
+              f"{batch['submitted_cents'] / 100:,.2f} submitted, {batch['settled_cents'] / 100:,.2f} settled, "
+              f"{batch['declined_cents'] / 100:,.2f} declined, {batch['unanswered_count']} unanswered")
 
 # Define your routes
-@app.route('/')
+@route('/')
+@cached_page
 def home():
     return render_template('index.html')
 
-@app.route('/about')
+@route('/about')
+@cached_page
 def about():
     return render_template("about.html")
 
-@app.route('/signup', methods=['GET', 'POST'])
+@route('/signup', methods=['GET', 'POST'])
 def signup():
     form = RegistrationForm()
     
+    # RegistrationForm.validate_email already checked that the email is free
     if form.validate_on_submit():
-        # Check if user already exists
-        user = User.query.filter_by(email=form.email.data).first()
-        if user:
-            flash('Email address is already registered. Please use a different one.', 'error')
-            return redirect(url_for('signup'))
-
-        # Hash the password
-        hashed_password = generate_password_hash(form.password.data)
+        # Hash the password on the hashing pool
+        try:
+            hashed_password = hash_password(form.password.data)
+        except HashingBusy as e:
+            flash(str(e), 'error')
+            return render_template('signup.html', form=form), 503
 
         # Create a new user if user does not exist
-        new_user = User(name=form.name.data,
-                        email=form.email.data,
-                        password=hashed_password,
-                        user_type=form.user_type.data,
-                        gender=form.gender.data,
-                        date_of_birth=form.date_of_birth.data,
-                        location=form.location.data,
-                        phone_number=form.phone_number.data)
-        db.session.add(new_user)
-        db.session.commit()
+        def create_user():
+            db.session.add(User(name=form.name.data,
+                                email=User.normalize_email(form.email.data),
+                                password=hashed_password,
+                                user_type=form.user_type.data,
+                                gender=form.gender.data,
+                                date_of_birth=form.date_of_birth.data,
+                                location=form.location.data,
+                                phone_number=form.phone_number.data))
+
+        try:
+            submit_write(create_user)
+        except IntegrityError:
+            # Someone registered the same email since the form was validated
+            flash('Email address is already registered. Please use a different one.', 'error')
+            return redirect(url_for('signup'))
 
         flash("User signed up successfully!")
 
@@ -85,16 +328,25 @@ def signup():
 
     return render_template('signup.html', form=form)
     
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
 
         # Query the database to check if the username exists
-        user = User.query.filter_by(email=email).first()
-
-        if user and check_password_hash(user.password, password):  # Check hashed password
+        user = User.find_by_email(email)
+
+        try:
+            valid = user is not None and verify_password(user.password, password)  # Check hashed password
+            if valid and needs_rehash(user.password):
+                # Upgrade hashes made with older cost settings while we have the plain password
+                submit_write(_set_password_hash, user.id, hash_password(password))
+        except HashingBusy as e:
+            flash(str(e), 'error')
+            return render_template('login.html'), 503
+
+        if valid:
             # If the credentials are correct, set the user as logged in
             login_user(user)  # Use Flask-Login's login_user function
             flash('Logged in successfully!', 'success')
@@ -113,107 +365,104 @@ def login():
     return render_template('login.html', error=None)
 
 
-@app.route('/logout')
+def _set_password_hash(user_id, password_hash):
+    db.session.get(User, user_id).password = password_hash
+
+
+@route('/logout')
 def logout():
     logout_user()  # Log out the current user using Flask-Login's logout_user function
     flash('You have been logged out.', 'success')
     return redirect(url_for('login'))
 
 # Registration route for patients
-@app.route('/register/patient', methods=['GET', 'POST'])
+@route('/register/patient', methods=['GET', 'POST'])
 @login_required
 def register_patient():
     form = PatientRegistrationForm()
     
-    # Debug statement to check if form is submitted
-    print("Form submitted:", form.is_submitted())
-    
     if form.validate_on_submit():
-        # Debug statement to indicate form validation passed
-        print("Form validation passed")
+        log.debug('Patient registration form validated', extra={'fields': form.data})
 
         # Create a new patient associated with the logged-in user
-        patient = Patient(
-            user_id=current_user.id,
-            name=form.patient_name.data,
-            email=form.patient_email.data,
-            phone_number=form.phone_number.data,  
-            condition=form.condition.data,
-            location=form.patient_location.data,
-            gender=form.gender.data,
-            care_needed=form.care_needed.data,
-            preferences=form.preferences.data
-        )
-        db.session.add(patient)
-        db.session.commit()
+        user_id = current_user.id
+
+        def create_patient():
+            db.session.add(Patient(
+                user_id=user_id,
+                name=form.patient_name.data,
+                email=form.patient_email.data,
+                phone_number=form.phone_number.data,
+                condition=form.condition.data,
+                location=form.patient_location.data,
+                gender=form.gender.data,
+                care_needed=form.care_needed.data,
+                care_needed_mask=care_needed_to_mask(form.care_needed.data),
+                preferences=form.preferences.data
+            ))
+
+        submit_write(create_patient)
         flash('Patient registration successful', 'success')
         return redirect(url_for('patient_dashboard'))
     
-    # Debug statement to print form errors if validation fails
-    print("Form errors:", form.errors)
+    if form.errors:
+        log.debug('Patient registration form invalid', extra={'fields': {'errors': form.errors}})
     
     return render_template('register_patient.html', form=form)
 
-def mock_verify_license(license_path):
-    # Placeholder for mock verification process
-    # You can customize this function as needed
-    if license_path:
-        flash('License verification successful', 'success')
-        return True
-    else:
-        flash('License verification failed', 'error')
-        return False
-
-@app.route('/register/caregiver', methods=['GET', 'POST'])
+@route('/register/caregiver', methods=['GET', 'POST'])
 def register_caregiver():
     form = CaregiverRegistrationForm()
     
-    # Debug statement to check if form is submitted
-    print("Form submitted:", form.is_submitted())
-    
     if form.validate_on_submit():
-        # Debug statement to indicate form validation passed
-        print("Form validation passed")
+        log.debug('Caregiver registration form validated', extra={'fields': form.data})
         
         # Process the data as needed
         license_number = form.license_number.data
-        print("License number:", license_number)
-
-        # Perform mock verification using the license number
-        license_verified = mock_verify_license(license_number)
-        print("License verification result:", license_verified)
-
-        # Convert list of selected services to a comma-separated string
-        services_offered = ', '.join(form.services_offered.data)
-
-        # Create a new caregiver instance
-        caregiver = Caregiver(
-            user_id=current_user.id,
-            name=form.caregiver_name.data,
-            email=form.caregiver_email.data,
-            phone_number=form.phone_number.data,
-            location=form.caregiver_location.data,
-            qualification=form.qualification.data,
-            experience=form.experience.data,
-            gender=form.gender.data,
-            license_verified=license_verified,  # Update license_verified field
-            services_offered=services_offered
-        )
-
-        # Add the caregiver to the database
-        db.session.add(caregiver)
-        db.session.commit()
 
-        flash('Caregiver registration successful', 'success')
+        user_id = current_user.id
+
+        def create_caregiver():
+            # Create a new caregiver instance
+            caregiver = Caregiver(
+                user_id=user_id,
+                name=form.caregiver_name.data,
+                email=form.caregiver_email.data,
+                phone_number=form.phone_number.data,
+                location=form.caregiver_location.data,
+                qualification=form.qualification.data,
+                experience=form.experience.data,
+                gender=form.gender.data,
+                license_number=license_number,
+                license_verified=False  # Set by the verify_licenses job
+            )
+
+            # Store the selected services as a display string, a bitmask and association rows
+            set_caregiver_services(caregiver, form.services_offered.data)
+
+            # Add the caregiver to the database
+            db.session.add(caregiver)
+            db.session.flush()
+
+            # Working hours to start from, changed on the availability page
+            set_weekly_schedule(caregiver.id, default_week())
+
+            # Checked in the background, in a batch with other new registrations
+            schedule_verification()
+
+        submit_write(create_caregiver)
+
+        flash('Caregiver registration successful; your license is being verified.', 'success')
         return redirect(url_for('caregiver_dashboard'))
     
-    # Debug statement to print form errors if validation fails
-    print("Form errors:", form.errors)
+    if form.errors:
+        log.debug('Caregiver registration form invalid', extra={'fields': {'errors': form.errors}})
     
     return render_template('register_caregiver.html', form=form)
     
-@app.route('/patient_dashboard')
+@route('/patient_dashboard')
 @login_required
+@per_user_page
 def patient_dashboard():
     if current_user.user_type == 'patient':
         return render_template('patient_dashboard.html', user_name=current_user.name)
@@ -221,8 +470,9 @@ def patient_dashboard():
         flash('You do not have access to the patient dashboard.', 'error')
         return redirect(url_for('dashboard'))
 
-@app.route('/caregiver_dashboard')
+@route('/caregiver_dashboard')
 @login_required
+@per_user_page
 def caregiver_dashboard():
     if current_user.user_type == 'caregiver':
         return render_template('caregiver_dashboard.html', user_name=current_user.name, license_verified=True)  # Set license_verified as needed
@@ -230,7 +480,69 @@ def caregiver_dashboard():
         flash('You do not have access to the caregiver dashboard.', 'error')
         return redirect(url_for('dashboard'))
     
-@app.route('/profile', methods=['GET', 'POST'])
+@route('/availability', methods=['GET', 'POST'])
+@login_required
+def availability():
+    # A caregiver's weekly working hours, and dates that differ from them
+    caregiver = Caregiver.query.filter_by(user_id=current_user.id).first()
+    if caregiver is None:
+        flash('Register as a caregiver to set your working hours.', 'error')
+        return redirect(url_for('home'))
+
+    form = WeeklyScheduleForm(prefix='weekly')
+    if form.validate_on_submit():
+        week = {weekday: parse_ranges(getattr(form, name).data) for weekday, name in enumerate(form.WEEKDAYS)}
+
+        def save_weekly_hours():
+            set_weekly_schedule(caregiver.id, week)
+
+        submit_write(save_weekly_hours)
+        flash('Weekly hours saved.', 'success')
+        return redirect(url_for('availability'))
+    if request.method == 'GET':
+        form = _weekly_schedule_form(caregiver.id)
+
+    return _availability_page(caregiver.id, form, DayExceptionForm(prefix='exception'))
+
+@route('/availability/exception', methods=['POST'])
+@login_required
+def availability_exception():
+    caregiver = Caregiver.query.filter_by(user_id=current_user.id).first()
+    if caregiver is None:
+        flash('Register as a caregiver to set your working hours.', 'error')
+        return redirect(url_for('home'))
+
+    exception_form = DayExceptionForm(prefix='exception')
+    if not exception_form.validate_on_submit():
+        return _availability_page(caregiver.id, _weekly_schedule_form(caregiver.id), exception_form), 400
+
+    day = exception_form.date.data
+    clear = exception_form.clear.data
+    ranges = parse_ranges(exception_form.hours.data)
+
+    def save_exception():
+        if clear:
+            clear_day_exception(caregiver.id, day)
+        else:
+            set_day_exception(caregiver.id, day, ranges)
+
+    submit_write(save_exception)
+    flash(f'{day} follows your weekly hours again.' if clear else f'Hours for {day} saved.', 'success')
+    return redirect(url_for('availability'))
+
+def _weekly_schedule_form(caregiver_id):
+    # The saved template, or the default one a caregiver starts from
+    form = WeeklyScheduleForm(prefix='weekly', formdata=None)
+    week = weekly_schedule(caregiver_id) or default_week()
+    for weekday, name in enumerate(form.WEEKDAYS):
+        getattr(form, name).data = format_ranges(week[weekday])
+    return form
+
+def _availability_page(caregiver_id, form, exception_form):
+    return render_template('availability.html', form=form, exception_form=exception_form,
+                           exceptions=day_exceptions(caregiver_id), format_ranges=format_ranges)
+
+@route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
     form = ProfileForm()
@@ -242,14 +554,18 @@ def profile():
         return redirect(url_for('update_profile'))
 
     if form.validate_on_submit():
-        current_user.name = form.name.data
-        current_user.email = form.email.data
-        current_user.phone_number = form.phone_number.data
-        current_user.date_of_birth = form.date_of_birth.data
-        current_user.gender = form.gender.data
-        current_user.location = form.location.data
-
-        db.session.commit()
+        user_id = current_user.id
+
+        def update_user():
+            user = db.session.get(User, user_id)
+            user.name = form.name.data
+            user.email = User.normalize_email(form.email.data)
+            user.phone_number = form.phone_number.data
+            user.date_of_birth = form.date_of_birth.data
+            user.gender = form.gender.data
+            user.location = form.location.data
+
+        submit_write(update_user)
         flash('Profile updated successfully!', 'success')
         return redirect(url_for('profile'))
 
@@ -261,49 +577,77 @@ def profile():
     form.gender.data = current_user.gender
     form.location.data = current_user.location
 
-    # Debugging statements
-    print("Rendering profile page with form data:", form.data)
-    print("Current user name:", current_user.name)
+    log.debug('Rendering profile page', extra={'fields': {'user_id': current_user.id}})
 
     return render_template('profile.html', form=form, user_name=current_user.name)
 
-@app.route('/appointments')
+@route('/appointments')
 @login_required
 def appointments():
     form = AppointmentForm() 
 
     if current_user.user_type == 'patient':
         # For patients, filter appointments based on patient ID
-        upcoming_appointments = Appointment.query.filter_by(patient_id=current_user.id).filter(Appointment.date_time > datetime.now()).all()
+        owner_column = Appointment.patient_id
     elif current_user.user_type == 'caregiver':
         # For caregivers, filter appointments based on caregiver ID
-        upcoming_appointments = Appointment.query.filter_by(caregiver_id=current_user.id).filter(Appointment.date_time > datetime.now()).all()
+        owner_column = Appointment.caregiver_id
     else:
         return redirect(url_for('index'))  # Redirect to home if user type is not patient or caregiver
-    
-    return render_template('appointments.html', upcoming_appointments=upcoming_appointments, form=form)  # Pass the form variable to the template
 
-@app.route('/book_appointment', methods=['GET', 'POST'])
+    # One page at a time; ?cursor= comes from the previous page's "Next" link
+    cursor = request.args.get('cursor')
+    try:
+        page, next_cursor = upcoming_appointments(owner_column, current_user.id, cursor)
+    except ValueError:
+        abort(400)
+
+    return render_template('appointments.html', upcoming_appointments=page, next_cursor=next_cursor,
+                           first_page=not cursor, form=form)  # Pass the form variable to the template
+
+@route('/book_appointment', methods=['GET', 'POST'])
 @login_required
 def book_appointment():
     form = AppointmentForm()
     if form.validate_on_submit():
-        appointment = Appointment(
-            patient_id=current_user.id if current_user.user_type == 'patient' else form.patient_id.data,
-            caregiver_id=form.caregiver_id.data,
-            date_time=form.date_time.data,
-            duration=form.duration.data,
-            location=form.location.data,
-            notes=form.notes.data
-        )
-        db.session.add(appointment)
-        db.session.commit()
-        flash('Appointment booked successfully!', 'success')
+        patient_id = current_user.id if current_user.user_type == 'patient' else form.patient_id.data
+        if patient_id is None:
+            # The form shares AppointmentForm with rescheduling, where it is optional
+            flash('Choose a patient for the appointment.', 'error')
+            return render_template('book_appointment.html', form=form), 400
+        # Without a caregiver the visit is a request; `flask dispatch-pending` assigns one
+        requested = form.caregiver_id.data is None
+
+        def create_appointment():
+            appointment = Appointment(
+                patient_id=patient_id,
+                caregiver_id=form.caregiver_id.data,
+                date_time=form.date_time.data,
+                duration=form.duration.data,
+                location=form.location.data,
+                notes=form.notes.data,
+                status='Requested' if requested else 'Scheduled'
+            )
+
+            # Make sure neither the caregiver nor the patient is already booked then
+            reserve_slot(appointment.caregiver_id, appointment.patient_id, appointment.date_time, appointment.duration)
+            db.session.add(appointment)
+
+        try:
+            submit_write(create_appointment)
+        except BookingConflict as e:
+            flash(str(e), 'error')
+            return render_template('book_appointment.html', form=form)
+
+        if requested:
+            flash('Appointment requested; a caregiver will be assigned to it.', 'success')
+        else:
+            flash('Appointment booked successfully!', 'success')
         return redirect(url_for('appointments'))
     
     return render_template('book_appointment.html', form=form)
 
-@app.route('/view_appointment/<int:appointment_id>')
+@route('/view_appointment/<int:appointment_id>')
 @login_required
 def view_appointment(appointment_id):
     appointment = Appointment.query.get(appointment_id)
@@ -313,20 +657,24 @@ def view_appointment(appointment_id):
 
     return render_template('view_appointment.html', appointment=appointment)
 
-@app.route('/cancel_appointment/<int:appointment_id>', methods=['POST'])
+@route('/cancel_appointment/<int:appointment_id>', methods=['POST'])
 @login_required
 def cancel_specific_appointment(appointment_id):
-    appointment = Appointment.query.get(appointment_id)
-    if not appointment:
+    if not submit_write(_delete_appointment, appointment_id):
         flash('Appointment not found!', 'error')
         return redirect(url_for('appointments'))
 
-    db.session.delete(appointment)
-    db.session.commit()
     flash('Appointment canceled successfully!', 'success')
     return redirect(url_for('appointments'))
 
-@app.route('/reschedule_appointment/<int:appointment_id>', methods=['GET', 'POST'])
+def _delete_appointment(appointment_id):
+    appointment = db.session.get(Appointment, appointment_id)
+    if appointment is None:
+        return False
+    db.session.delete(appointment)
+    return True
+
+@route('/reschedule_appointment/<int:appointment_id>', methods=['GET', 'POST'])
 @login_required
 def reschedule_appointment(appointment_id):
     appointment = Appointment.query.get(appointment_id)
@@ -336,26 +684,86 @@ def reschedule_appointment(appointment_id):
 
     form = AppointmentForm(obj=appointment)
     if form.validate_on_submit():
-        appointment.date_time = form.date_time.data
-        appointment.duration = form.duration.data
-        appointment.location = form.location.data
-        appointment.notes = form.notes.data
-        db.session.commit()
+        def move_appointment():
+            moved = db.session.get(Appointment, appointment_id)
+
+            # Check the new time against everything except this appointment
+            reserve_slot(moved.caregiver_id, moved.patient_id, form.date_time.data, form.duration.data,
+                         ignore_id=moved.id)
+
+            moved.date_time = form.date_time.data
+            moved.duration = form.duration.data
+            moved.location = form.location.data
+            moved.notes = form.notes.data
+
+        try:
+            submit_write(move_appointment)
+        except BookingConflict as e:
+            flash(str(e), 'error')
+            return render_template('reschedule_appointment.html', form=form, appointment=appointment)
+
         flash('Appointment rescheduled successfully!', 'success')
         return redirect(url_for('appointments'))
     
     return render_template('reschedule_appointment.html', form=form, appointment=appointment)
     
 # Caregiver Search route
-@app.route('/search_caregivers', methods=['GET', 'POST'])
+@route('/search_caregivers', methods=['GET', 'POST'])
 def search_caregivers():
-    if request.method == 'POST':
-        patient_requirements = request.form['patient_requirements']
-        matching_caregivers = Caregiver.query.filter(Caregiver.qualifications.contains(patient_requirements)).all()
-        return render_template('caregivers_results.html', caregivers=matching_caregivers)
+    # Requirements come from the search form (POST) or from a results page link (GET)
+    requirements = request.values.get('requirements')
+    if requirements:
+        page = request.args.get('page', 1, type=int)
+        sort = request.values.get('sort', 'relevance')
+        if sort not in SORT_ORDERS:
+            sort = 'relevance'
+        matching_caregivers, total = find_caregivers(requirements, page=page, sort=sort)
+        return render_template('caregivers_results.html',
+                               caregivers=matching_caregivers,
+                               requirements=requirements,
+                               sort=sort,
+                               page=page,
+                               per_page=DEFAULT_PER_PAGE,
+                               total=total)
     return render_template('search_caregivers.html')
 
-@app.route('/select_caregiver', methods=['POST'])
+# Best rated caregivers per service, optionally within one region
+@route('/top_caregivers')
+def top_caregivers():
+    service = request.args.get('service')
+    region = request.args.get('region') or None
+    page = request.args.get('page', 1, type=int)
+    caregivers, total = [], 0
+    if service in SERVICES:
+        caregiver_ids, total = leaderboard.page(service, region, page)
+        found = {c.id: c for c in Caregiver.query.filter(Caregiver.id.in_(caregiver_ids))} if caregiver_ids else {}
+        caregivers = [found[i] for i in caregiver_ids if i in found]
+    return render_template('top_caregivers.html',
+                           services=SERVICES,
+                           regions=leaderboard.regions(),
+                           service=service,
+                           region=region,
+                           caregivers=caregivers,
+                           page=page,
+                           per_page=LEADERBOARD_PER_PAGE,
+                           total=total)
+
+# Free/busy lookup used by the booking UI
+@route('/free_caregivers')
+def free_caregivers():
+    try:
+        start = datetime.strptime(request.args.get('date_time', ''), "%Y-%m-%d %H:%M")
+        duration = float(request.args.get('duration', 60))
+    except ValueError:
+        return jsonify(error='Expected date_time as YYYY-MM-DD HH:MM and a numeric duration.'), 400
+    # Also refuses nan and inf, which compare false both ways
+    if not 0 < duration <= MAX_DURATION_MINUTES:
+        return jsonify(error=f'Expected a duration between 0 and {MAX_DURATION_MINUTES} minutes.'), 400
+
+    caregiver_ids = availability_index.free_caregivers(start, duration)
+    return jsonify(date_time=start.strftime("%Y-%m-%d %H:%M"), duration=duration, caregiver_ids=caregiver_ids)
+
+@route('/select_caregiver', methods=['POST'])
 def select_caregiver():
     if request.method == 'POST':
         caregiver_id = request.form.get('caregiver_id')  # Assuming caregiver_id is submitted from the form
@@ -366,7 +774,7 @@ def select_caregiver():
         else:
             return "Caregiver not found"
         
-@app.route('/schedule_appointment', methods=['GET', 'POST'])
+@route('/schedule_appointment', methods=['GET', 'POST'])
 @login_required
 def schedule_appointment():
     if request.method == 'POST':
@@ -378,38 +786,45 @@ def schedule_appointment():
         notes = request.form.get('notes')
         location = request.form.get('location')
 
-        # Debug statements to print form data
-        print("Patient ID:", patient_id)
-        print("Caregiver ID:", caregiver_id)
-        print("Date and Time:", date_time_str)
-        print("Duration:", duration)
-        print("Notes:", notes)
-        print("Location:", location)
+        log.debug('Scheduling appointment', extra={'fields': {
+            'patient_id': patient_id,
+            'caregiver_id': caregiver_id,
+            'date_time': date_time_str,
+            'duration': duration,
+            'notes': notes,
+            'location': location,
+        }})
 
         # Find the caregiver and patient by ID
         caregiver = Caregiver.query.get_or_404(caregiver_id)
         patient = Patient.query.get_or_404(patient_id)
 
-        # Debug statements to print found caregiver and patient
-        print("Found caregiver:", caregiver)
-        print("Found patient:", patient)
-
-        # Create a new appointment
-        appointment = Appointment(
-            patient_id=patient.id,
-            caregiver_id=caregiver.id,
-            date_time=datetime.strptime(date_time_str, "%Y-%m-%d %H:%M"),
-            duration=duration,
-            notes=notes,
-            location=location
-        )
-
-        # Add appointment to the database
-        db.session.add(appointment)
-        db.session.commit()
-
-        # Debug statement to indicate successful appointment creation
-        print("Appointment scheduled successfully!")
+        def create_appointment():
+            # Create a new appointment
+            appointment = Appointment(
+                patient_id=patient.id,
+                caregiver_id=caregiver.id,
+                date_time=datetime.strptime(date_time_str, "%Y-%m-%d %H:%M"),
+                duration=duration,
+                notes=notes,
+                location=location
+            )
+
+            # Refuse the booking if either side is busy at that time
+            reserve_slot(caregiver.id, patient.id, appointment.date_time, duration)
+
+            # Add appointment to the database
+            db.session.add(appointment)
+            db.session.flush()
+            return appointment.id
+
+        try:
+            appointment_id = submit_write(create_appointment)
+        except BookingConflict as e:
+            flash(str(e), 'error')
+            return redirect(url_for('schedule_appointment'))
+
+        log.info('Appointment scheduled', extra={'fields': {'appointment_id': appointment_id}})
 
         # Redirect to home page or display success message
         flash('Appointment scheduled successfully!', 'success')
@@ -418,29 +833,29 @@ def schedule_appointment():
     # Render the appointment scheduling form
     return render_template('schedule_appointment.html')
 
-@app.route('/confirm_payment', methods=['POST'])
+@route('/confirm_payment', methods=['POST'])
 def confirm_payment():
     if request.method == 'POST':
-        # Get the appointment ID from the form data
-        appointment_id = request.form['appointment_id']
-        
-        # Retrieve the appointment object from the database using the ID
-        appointment = Appointment.query.get(appointment_id)
-        
-        if appointment:
-            # Process payment (placeholder)
-            appointment.payment_status = True  # Update payment status to True
-            
-            # Commit changes to the database
-            db.session.commit()
-            
-            # Redirect to a success page
-            return redirect(url_for('payment_success'))
-        else:
-            # If appointment ID is not found, redirect to an error page
-            return redirect(url_for('payment_error'))
-        
-@app.route('/confirm_and_pay', methods=['GET', 'POST'])
+        # Get the appointment ID and amount from the form data
+        appointment_id = request.form.get('appointment_id', type=int)
+        payments = _payments()
+        try:
+            amount_cents = payments.to_cents(request.form.get('payment_amount'))
+        except ValueError:
+            return redirect(url_for('payment_status', success='false'))
+        # Sent again with a retried form, so the appointment is only charged once
+        idempotency_key = request.form.get('idempotency_key') or uuid.uuid4().hex
+
+        # Recorded in the ledger and settled in the next batch; nothing is
+        # recorded if the appointment does not exist
+        payment_id, _ = submit_write(payments.record_payment, amount_cents, idempotency_key,
+                                     appointment_id=appointment_id, description=f'Appointment {appointment_id}')
+        if payment_id is None:
+            # If appointment ID is not found, show the payment error
+            return redirect(url_for('payment_status', success='false'))
+        return redirect(url_for('payment_status', payment_id=payment_id))
+
+@route('/confirm_and_pay', methods=['GET', 'POST'])
 def confirm_and_pay():
     if request.method == 'POST':
         # Retrieve form data
@@ -449,78 +864,76 @@ def confirm_and_pay():
         appointment_date = request.form['appointment_date']
         appointment_time = request.form['appointment_time']
         appointment_duration = request.form['appointment_duration']
-        payment_amount = request.form['payment_amount']
-        
-        # Perform payment processing (placeholder)
-        payment_status = process_payment(payment_amount)
-        
-        # If payment is successful, proceed to scheduling appointment
-        if payment_status == 'success':
-            appointment = Appointment(patient_name, caregiver_name, appointment_date, appointment_time, appointment_duration)
-            # Save the appointment to the database or perform any other necessary actions
-            return redirect(url_for('payment_status', success='true'))
-        else:
+        payments = _payments()
+        try:
+            amount_cents = payments.to_cents(request.form['payment_amount'])
+        except ValueError:
             return redirect(url_for('payment_status', success='false'))
+        # Sent again with a retried form, so the payment is only taken once
+        idempotency_key = request.form.get('idempotency_key') or uuid.uuid4().hex
+
+        # Recorded in the ledger and settled in the next batch
+        payment_id, _ = submit_write(payments.record_payment, amount_cents, idempotency_key, description=(
+            f'{caregiver_name} for {patient_name} on {appointment_date} {appointment_time}, {appointment_duration}'))
+        return redirect(url_for('payment_status', payment_id=payment_id))
     
-    # If request method is GET, render the confirmation form
-    return render_template('confirm_and_pay.html') 
+    # If request method is GET, render the confirmation form; the key makes
+    # a resubmitted form count as the same payment
+    appointment_id = request.args.get('appointment_id', type=int)
+    appointment = db.session.get(Appointment, appointment_id) if appointment_id else None
+    return render_template('confirm_and_pay.html', appointment=appointment, idempotency_key=uuid.uuid4().hex)
 
 # Route to cancel an appointment
-@app.route('/cancel_appointment/<int:appointment_id>', methods=['POST'])
+@route('/cancel_appointment/<int:appointment_id>', methods=['POST'])
 def cancel_appointment(appointment_id):
-    # Retrieve the appointment from the database using the appointment ID
-    appointment = Appointment.query.get(appointment_id)
-    
-    if appointment:
-        # Delete the appointment from the database
-        db.session.delete(appointment)
-        db.session.commit()
-        
+    # Delete the appointment if it exists
+    if submit_write(_delete_appointment, appointment_id):
         # Redirect to a success page
         return redirect(url_for('cancel_success'))
     else:
         # If appointment ID is not found, redirect to an error page
         return redirect(url_for('cancel_error'))       
 
-@app.route('/payment_status')
+@route('/payment_status')
 def payment_status():
     success = request.args.get('success')
+    payment_id = request.args.get('payment_id', type=int)
+    if payment_id is not None:
+        state = _payments().payment_state(payment_id)
+        success = {'settled': 'true', 'pending': 'pending', 'submitted': 'pending'}.get(state, 'false')
     return render_template('payment_status.html', success=success)
 
-@app.route('/dispatch_caregiver/<int:appointment_id>', methods=['POST'])
+@route('/dispatch_caregiver/<int:appointment_id>', methods=['POST'])
 def dispatch_caregiver(appointment_id):
     if request.method == 'POST':
         # Retrieve the appointment object from the database using the appointment ID
         appointment = Appointment.query.get(appointment_id)
         
         if appointment:
-            # Retrieve a caregiver from the database based on certain criteria (e.g., availability)
-            caregiver = Caregiver.query.filter_by(availability=True).first()
-
-            if caregiver:
-                # Assign the selected caregiver to the appointment
-                appointment.caregiver = caregiver
-
-                # Update the appointment status to "Dispatched"
-                appointment.status = "Dispatched"
-
-                # Commit changes to the database
-                db.session.commit()
+            # Claim the best ranked available caregiver nearby; this assigns the
+            # caregiver and marks the appointment as "Dispatched"
+            caregiver_id = submit_write(_dispatch_appointment, appointment_id)
 
+            if caregiver_id:
                 # Redirect to a success page
-                return redirect(url_for('dispatch_success'))
+                return redirect(url_for('dispatch_status', success='true'))
             else:
                 # If no caregiver is available, redirect to an error page
-                return redirect(url_for('dispatch_status', success='true'))
+                return redirect(url_for('dispatch_status', success='false'))
         else:
             # If appointment ID is not found, redirect to an error page
             return redirect(url_for('dispatch_status', success='false'))
 
-@app.route('/dispatch_status/<string:success>')
+def _dispatch_appointment(appointment_id):
+    # The dispatch engine is imported, and loads its state, on first use
+    from dispatch import dispatch_engine
+    return dispatch_engine.dispatch(db.session.get(Appointment, appointment_id))
+
+@route('/dispatch_status/<string:success>')
 def dispatch_status(success):
     return render_template('dispatch_status.html', success=success)
 
-@app.route('/caregiving_session/<int:appointment_id>')
+@route('/caregiving_session/<int:appointment_id>')
 def caregiving_session(appointment_id):
     # Retrieve the appointment object from the database using the appointment ID
     appointment = Appointment.query.get(appointment_id)
@@ -532,30 +945,52 @@ def caregiving_session(appointment_id):
         # If appointment ID is not found, render an error template
         return render_template('error.html', message='Appointment not found')
     
-@app.route('/complete_and_feedback/<int:appointment_id>', methods=['GET', 'POST'])
+@route('/complete_and_feedback/<int:appointment_id>', methods=['GET', 'POST'])
 def complete_and_feedback(appointment_id):
     appointment = Appointment.query.get_or_404(appointment_id)
 
     if request.method == 'POST':
-        appointment.status = 'Completed'
-        appointment.feedback = request.form.get('feedback')
-
-        # Create a new review object
-        review = Review(
-            reviewer_id=session['user_id'],  # Assuming you have user authentication
-            reviewed_entity_id=appointment.caregiver_id,
-            rating=int(request.form.get('rating')),  # Assuming rating is provided in the form
-            comments=request.form.get('comments')
-        )
-        db.session.add(review)
-        db.session.commit()
-
-        return redirect(url_for('feedback_success'))
+        rating = request.form.get('rating', type=int)
+        comments = request.form.get('comments')
+        feedback = request.form.get('feedback')
+        if rating is not None and not 1 <= rating <= 5:
+            flash('Ratings go from 1 to 5.', 'error')
+            return render_template('complete_and_feedback.html', appointment=appointment)
+
+        def complete_appointment():
+            completed = db.session.get(Appointment, appointment_id)
+            if completed.status == 'Dispatched':
+                # The visit is over, so it no longer weighs on the caregiver's dispatch ranking
+                from dispatch import dispatch_engine
+                dispatch_engine.release(completed.caregiver_id)
+            completed.status = 'Completed'
+            completed.feedback = feedback
+
+            # The appointment's patient reviews its caregiver; the caregiver's
+            # rating aggregates are updated in this transaction (ratings.py)
+            if rating is not None and completed.caregiver_id is not None:
+                db.session.add(Review(
+                    reviewer_id=completed.patient_id,
+                    caregiver_id=completed.caregiver_id,
+                    rating=rating,
+                    comments=comments
+                ))
+
+        submit_write(complete_appointment)
+
+        flash('Thank you for your feedback!', 'success')
+        return redirect(url_for('appointments'))
 
     return render_template('complete_and_feedback.html', appointment=appointment)
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
         # Create all database tables
         db.create_all()
+        # The full-text search table is not a model, so create_all skips it
+        ensure_search_index()
+        db.session.commit()
+        # Build the in-memory leaderboard before the first browse request
+        leaderboard.load()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,165 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+
+from flask import has_request_context, request
+
+LOGGER_NAME = 'careconnect'
+
+# Defaults, overridable through app.config (see init_app)
+LOG_LEVEL = 'INFO'
+LOG_QUEUE_SIZE = 10000        # records buffered before new ones are dropped
+LOG_BATCH_SIZE = 200          # records written per batch
+LOG_FLUSH_INTERVAL = 0.5      # seconds before a partial batch is written
+LOG_SAMPLE_RATES = {}         # {endpoint: fraction of DEBUG/INFO records kept}
+
+# Fields that can identify a patient or caregiver, or are secret
+REDACTED_FIELDS = {
+    'name', 'patient_name', 'caregiver_name', 'email', 'patient_email', 'caregiver_email',
+    'phone_number', 'date_of_birth', 'condition', 'care_needed', 'preferences', 'location',
+    'patient_location', 'caregiver_location', 'license_number', 'password', 'confirm_password',
+    'notes', 'csrf_token',
+}
+REDACTED = '[redacted]'
+
+log = logging.getLogger(LOGGER_NAME)
+
+
+def redact(fields):
+    if isinstance(fields, dict):
+        return {key: REDACTED if key in REDACTED_FIELDS else redact(value) for key, value in fields.items()}
+    if isinstance(fields, (list, tuple)):
+        return [redact(value) for value in fields]
+    return fields
+
+
+class JSONFormatter(logging.Formatter):
+    # One JSON object per line; structured data goes in extra={'fields': {...}}
+
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + '.%03dZ' % record.msecs,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        endpoint = getattr(record, 'endpoint', None)
+        if endpoint:
+            entry['endpoint'] = endpoint
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry['fields'] = redact(fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps a fraction of DEBUG/INFO records per route; warnings and errors always pass
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+
+    def filter(self, record):
+        record.endpoint = request.endpoint if has_request_context() else None
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.endpoint, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class BatchingQueueHandler(logging.Handler):
+    # emit() only formats the record and puts it on a bounded queue; a
+    # background thread writes queued lines to `stream` in batches. When
+    # the queue is full the record is counted as dropped instead of making
+    # the request wait for I/O.
+
+    def __init__(self, stream=None, queue_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL):
+        super().__init__()
+        self.stream = stream or sys.stderr
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._writer.start()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.stream.write('\n'.join(batch) + '\n')
+            self.stream.flush()
+            self.written += len(batch)
+        except Exception:
+            self.dropped += len(batch)
+
+    def close(self):
+        # Drain what is queued, then stop the writer
+        self._stop.set()
+        self._writer.join(timeout=5)
+        super().close()
+
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'written': self.written, 'dropped': self.dropped}
+
+
+_handler = None
+
+
+def init_app(app):
+    global _handler
+    if _handler is None:
+        _handler = BatchingQueueHandler(
+            queue_size=app.config.get('LOG_QUEUE_SIZE', LOG_QUEUE_SIZE),
+            batch_size=app.config.get('LOG_BATCH_SIZE', LOG_BATCH_SIZE),
+            flush_interval=app.config.get('LOG_FLUSH_INTERVAL', LOG_FLUSH_INTERVAL),
+        )
+        _handler.setFormatter(JSONFormatter())
+        _handler.addFilter(SamplingFilter(app.config.get('LOG_SAMPLE_RATES', LOG_SAMPLE_RATES)))
+        log.addHandler(_handler)
+        log.propagate = False
+        atexit.register(_handler.close)
+    log.setLevel(app.config.get('LOG_LEVEL', LOG_LEVEL))
+    return _handler
+
+
+def stats():
+    return _handler.stats() if _handler is not None else {}
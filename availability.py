@@ -0,0 +1,337 @@
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Appointment, CaregiverSchedule, AvailabilityException
+from scheduling import MAX_DURATION_MINUTES
+
+# A day is 96 slots of 15 minutes. Each day's availability is an int with
+# bit i set when the caregiver can work from i*15 to (i+1)*15 minutes past
+# midnight, so "free for the whole visit" is one AND per caregiver.
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+DAY_BYTES = SLOTS_PER_DAY // 8
+FULL_DAY = (1 << SLOTS_PER_DAY) - 1
+
+# Days of booked appointments kept in memory
+MAX_CACHED_DAYS = 62
+
+# Weekly template of caregivers who have not set their own: every day, 08:00 to 18:00
+DEFAULT_WORKING_HOURS = [(time(8), time(18))]
+
+
+def slot_mask(start_minute, end_minute):
+    # Every slot touched by [start_minute, end_minute)
+    first = max(start_minute, 0) // SLOT_MINUTES
+    last = -(-min(end_minute, 24 * 60) // SLOT_MINUTES)
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+def ranges_to_mask(ranges):
+    # [(time(9), time(17)), ...] -> day bitmap; time(0) as an end means midnight
+    mask = 0
+    for start, end in ranges:
+        end_minute = end.hour * 60 + end.minute or 24 * 60
+        mask |= slot_mask(start.hour * 60 + start.minute, end_minute)
+    return mask
+
+
+def mask_to_ranges(mask):
+    # Day bitmap -> [(start_time, end_time), ...], the inverse of ranges_to_mask
+    ranges = []
+    slot = 0
+    while slot < SLOTS_PER_DAY:
+        if not mask >> slot & 1:
+            slot += 1
+            continue
+        first = slot
+        while slot < SLOTS_PER_DAY and mask >> slot & 1:
+            slot += 1
+        ranges.append(tuple(time(minute // 60 % 24, minute % 60)
+                            for minute in (first * SLOT_MINUTES, slot * SLOT_MINUTES)))
+    return ranges
+
+
+def parse_ranges(text):
+    """``'08:00-12:00, 14:00-18:00'`` -> ``[(time(8), time(12)), (time(14), time(18))]``; empty means none.
+
+    Raises ValueError for anything else. An end of 00:00 means midnight.
+    """
+    ranges = []
+    for part in (text or '').split(','):
+        if not part.strip():
+            continue
+        try:
+            start, end = (datetime.strptime(value.strip(), '%H:%M').time() for value in part.split('-'))
+        except ValueError:
+            raise ValueError(f'Write hours as HH:MM-HH:MM, not {part.strip()!r}.') from None
+        if end != time(0) and end <= start:
+            raise ValueError(f'{part.strip()} ends before it starts.')
+        ranges.append((start, end))
+    return ranges
+
+
+def format_ranges(ranges):
+    return ', '.join(f'{start:%H:%M}-{end:%H:%M}' for start, end in ranges)
+
+
+def mask_to_bytes(mask):
+    return mask.to_bytes(DAY_BYTES, 'big')
+
+
+def bytes_to_mask(data):
+    return int.from_bytes(data, 'big')
+
+
+def split_by_day(start, duration):
+    # Yield (date, day_mask) for each day the interval touches
+    end = start + timedelta(minutes=float(duration))
+    day = start.date()
+    while datetime.combine(day, time()) < end:
+        day_start = datetime.combine(day, time())
+        from_minute = max((start - day_start).total_seconds() / 60, 0)
+        to_minute = min((end - day_start).total_seconds() / 60, 24 * 60)
+        yield day, slot_mask(int(from_minute), int(-(-to_minute // 1)))
+        day += timedelta(days=1)
+
+
+class AvailabilityIndex:
+    # Weekly templates and exceptions for every caregiver, plus booked slots
+    # per day built from appointments. Templates load once; booked days load
+    # on first use with one query and are dropped when a commit changes an
+    # appointment on that day.
+
+    def __init__(self, max_days=MAX_CACHED_DAYS):
+        self.loaded = False
+        self.max_days = max_days
+        self._weekly = {}
+        self._exceptions = {}
+        self._booked = OrderedDict()
+        self._lock = threading.RLock()
+
+    def load(self):
+        weekly = {}
+        for caregiver_id, weekly_slots in db.session.query(CaregiverSchedule.caregiver_id, CaregiverSchedule.weekly_slots) \
+                .execution_options(bulk_load=True):
+            weekly[caregiver_id] = [bytes_to_mask(weekly_slots[i * DAY_BYTES:(i + 1) * DAY_BYTES]) for i in range(7)]
+        exceptions = {(caregiver_id, day): bytes_to_mask(slots) for caregiver_id, day, slots in
+                      db.session.query(AvailabilityException.caregiver_id, AvailabilityException.date,
+                                       AvailabilityException.slots)
+                      .filter(AvailabilityException.date >= date.today())
+                      .execution_options(bulk_load=True)}
+        with self._lock:
+            self._weekly = weekly
+            self._exceptions = exceptions
+            self._booked.clear()
+            self.loaded = True
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def set_weekly(self, caregiver_id, days):
+        with self._lock:
+            if days is None:
+                self._weekly.pop(caregiver_id, None)
+            else:
+                self._weekly[caregiver_id] = days
+
+    def set_exception(self, caregiver_id, day, mask):
+        with self._lock:
+            if mask is None:
+                self._exceptions.pop((caregiver_id, day), None)
+            else:
+                self._exceptions[(caregiver_id, day)] = mask
+
+    def forget_days(self, days):
+        with self._lock:
+            for day in days:
+                self._booked.pop(day, None)
+
+    def booked(self, day):
+        """Return ``{caregiver_id: booked_mask}`` for one date."""
+        with self._lock:
+            masks = self._booked.get(day)
+            if masks is not None:
+                self._booked.move_to_end(day)
+                return masks
+
+        day_start = datetime.combine(day, time())
+        rows = db.session.query(Appointment.caregiver_id, Appointment.date_time, Appointment.duration).filter(
+            Appointment.date_time < day_start + timedelta(days=1),
+            Appointment.date_time > day_start - timedelta(minutes=MAX_DURATION_MINUTES)
+        )
+        masks = {}
+        for caregiver_id, start, duration in rows:
+            for booked_day, mask in split_by_day(start, duration):
+                if booked_day == day:
+                    masks[caregiver_id] = masks.get(caregiver_id, 0) | mask
+
+        with self._lock:
+            self._booked[day] = masks
+            while len(self._booked) > self.max_days:
+                self._booked.popitem(last=False)
+        return masks
+
+    def _working(self, caregiver_id, day):
+        mask = self._exceptions.get((caregiver_id, day))
+        if mask is None:
+            days = self._weekly.get(caregiver_id)
+            mask = days[day.weekday()] if days else None
+        return mask
+
+    def free_slots(self, caregiver_id, day):
+        """Free (working and not booked) slots of one caregiver on a date."""
+        self._ensure_loaded()
+        working = self._working(caregiver_id, day) or 0
+        return working & ~self.booked(day).get(caregiver_id, 0)
+
+    def is_free(self, caregiver_id, start, duration):
+        """True/False for caregivers with a schedule, None for those without."""
+        self._ensure_loaded()
+        if caregiver_id not in self._weekly:
+            return None
+        for day, required in split_by_day(start, duration):
+            if self.free_slots(caregiver_id, day) & required != required:
+                return False
+        return True
+
+    def free_caregivers(self, start, duration, candidates=None):
+        """Caregivers whose schedule covers the whole interval and who are not booked."""
+        self._ensure_loaded()
+        pieces = [(day, required, self.booked(day)) for day, required in split_by_day(start, duration)]
+        with self._lock:
+            caregiver_ids = list(self._weekly) if candidates is None else [c for c in candidates if c in self._weekly]
+            free = []
+            for caregiver_id in caregiver_ids:
+                for day, required, booked in pieces:
+                    working = self._working(caregiver_id, day) or 0
+                    if working & ~booked.get(caregiver_id, 0) & required != required:
+                        break
+                else:
+                    free.append(caregiver_id)
+        return free
+
+
+availability_index = AvailabilityIndex()
+
+
+def default_week():
+    return {weekday: list(DEFAULT_WORKING_HOURS) for weekday in range(7)}
+
+
+def weekly_schedule(caregiver_id):
+    """The caregiver's template as ``{weekday: [(start_time, end_time), ...]}``, or None if unset."""
+    schedule = db.session.get(CaregiverSchedule, caregiver_id)
+    if schedule is None:
+        return None
+    data = schedule.weekly_slots
+    return {weekday: mask_to_ranges(bytes_to_mask(data[weekday * DAY_BYTES:(weekday + 1) * DAY_BYTES]))
+            for weekday in range(7)}
+
+
+def day_exceptions(caregiver_id, since=None):
+    """``[(date, [(start_time, end_time), ...])]`` of the caregiver's exceptions from ``since`` on."""
+    rows = db.session.query(AvailabilityException.date, AvailabilityException.slots).filter(
+        AvailabilityException.caregiver_id == caregiver_id,
+        AvailabilityException.date >= (since or date.today())
+    ).order_by(AvailabilityException.date)
+    return [(day, mask_to_ranges(bytes_to_mask(slots))) for day, slots in rows]
+
+
+def set_weekly_schedule(caregiver_id, week):
+    """Store a weekly template from ``{weekday: [(start_time, end_time), ...]}``, Monday = 0."""
+    days = [ranges_to_mask(week.get(weekday, ())) for weekday in range(7)]
+    schedule = db.session.get(CaregiverSchedule, caregiver_id) or CaregiverSchedule(caregiver_id=caregiver_id)
+    schedule.weekly_slots = b''.join(mask_to_bytes(mask) for mask in days)
+    db.session.add(schedule)
+    return schedule
+
+
+def set_day_exception(caregiver_id, day, ranges=()):
+    """Override one date; no ranges marks the caregiver as off that day."""
+    exception = db.session.get(AvailabilityException, (caregiver_id, day)) \
+        or AvailabilityException(caregiver_id=caregiver_id, date=day)
+    exception.slots = mask_to_bytes(ranges_to_mask(ranges))
+    db.session.add(exception)
+    return exception
+
+
+def clear_day_exception(caregiver_id, day):
+    """Go back to the weekly template on one date; False if it had no exception."""
+    exception = db.session.get(AvailabilityException, (caregiver_id, day))
+    if exception is None:
+        return False
+    db.session.delete(exception)
+    return True
+
+
+# Changes reach the in-memory index once their transaction commits
+def _queue(target, change):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('availability_changes', []).append(change)
+
+
+@event.listens_for(CaregiverSchedule, 'after_insert')
+@event.listens_for(CaregiverSchedule, 'after_update')
+def _schedule_saved(mapper, connection, target):
+    data = target.weekly_slots
+    _queue(target, ('weekly', target.caregiver_id,
+                    [bytes_to_mask(data[i * DAY_BYTES:(i + 1) * DAY_BYTES]) for i in range(7)]))
+
+
+@event.listens_for(CaregiverSchedule, 'after_delete')
+def _schedule_deleted(mapper, connection, target):
+    _queue(target, ('weekly', target.caregiver_id, None))
+
+
+@event.listens_for(AvailabilityException, 'after_insert')
+@event.listens_for(AvailabilityException, 'after_update')
+def _exception_saved(mapper, connection, target):
+    _queue(target, ('exception', target.caregiver_id, target.date, bytes_to_mask(target.slots)))
+
+
+@event.listens_for(AvailabilityException, 'after_delete')
+def _exception_deleted(mapper, connection, target):
+    _queue(target, ('exception', target.caregiver_id, target.date, None))
+
+
+@event.listens_for(Appointment, 'after_insert')
+@event.listens_for(Appointment, 'after_update')
+@event.listens_for(Appointment, 'after_delete')
+def _appointment_changed(mapper, connection, target):
+    # Both the old and the new time of a moved appointment change booked slots
+    state = inspect(target)
+    starts = list(state.attrs.date_time.history.deleted or ()) + [target.date_time]
+    durations = list(state.attrs.duration.history.deleted or ()) + [target.duration]
+    days = set()
+    for start in starts:
+        for duration in durations:
+            if start is not None and duration is not None:
+                days.update(day for day, _ in split_by_day(start, duration))
+    _queue(target, ('booked', days))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_availability_changes(session):
+    changes = session.info.pop('availability_changes', None)
+    if not changes or not availability_index.loaded:
+        return
+    for change in changes:
+        if change[0] == 'weekly':
+            availability_index.set_weekly(change[1], change[2])
+        elif change[0] == 'exception':
+            availability_index.set_exception(change[1], change[2], change[3])
+        else:
+            availability_index.forget_days(change[1])
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_availability_changes(session, previous_transaction):
+    session.info.pop('availability_changes', None)
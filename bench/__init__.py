@@ -0,0 +1,7 @@
+# Benchmark tools; run them against a scratch database, never the real one:
+#
+#   python -m bench.seed --database sqlite:////tmp/bench.db --users 1000000
+#   python -m bench.load --database sqlite:////tmp/bench.db --threads 16 --save baseline
+#   python -m bench.load --database sqlite:////tmp/bench.db --compare baseline
+#   python -m bench.startup --runs 5 --profile --target-ms 1500
+#   python -m bench.group_commit --units 50
@@ -0,0 +1,145 @@
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Run as `python -m bench.group_commit`: submits concurrent write units with
+# group commit on, traces the SQL SQLite itself runs on the writer thread
+# and checks that every batch is one transaction, opened by BEGIN and ended
+# by exactly one COMMIT, with each unit's SAVEPOINT and RELEASE inside it.
+# Exits with status 1 otherwise.
+
+
+class WriterTrace:
+    # Every statement SQLite runs on the writer thread, as traced by the
+    # driver, so the COMMITs pysqlite sends on its own are included
+
+    def __init__(self, write_queue):
+        self.statements = []
+        self._write_queue = write_queue
+
+    def _connect(self, dbapi_connection, connection_record):
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            dbapi_connection.set_trace_callback(self._trace)
+
+    def _trace(self, statement):
+        if threading.current_thread() is self._write_queue._writer:
+            self.statements.append(' '.join(statement.split()))
+
+    def __enter__(self):
+        event.listen(Engine, 'connect', self._connect)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, 'connect', self._connect)
+
+
+def transactions(statements):
+    """Split a statement trace into transactions; returns ``(transactions, errors)``."""
+    done, errors, current = [], [], None
+    for statement in statements:
+        word = statement.split()[0].upper()
+        if word == 'BEGIN':
+            if current is not None:
+                errors.append(f'BEGIN inside an open transaction: {statement}')
+            current = []
+        elif word in ('COMMIT', 'ROLLBACK'):
+            if current is None:
+                errors.append(f'{word} with no transaction open')
+            else:
+                done.append((current, word))
+            current = None
+        elif current is None:
+            errors.append(f'Outside a transaction: {statement}')
+        else:
+            current.append(statement)
+    if current is not None:
+        errors.append('Transaction left open at the end of the trace')
+    return done, errors
+
+
+def _unit(i, fail_every):
+    from models import db, GeocodeCache
+    db.session.add(GeocodeCache(location=f'group commit {i}'))
+    if fail_every and i % fail_every == fail_every - 1:
+        raise RuntimeError(f'unit {i} fails on purpose')
+
+
+def run(units=50, wait=0.05, fail_every=5):
+    from app import create_app
+    from database import write_queue, submit_write
+    from models import db, GeocodeCache
+
+    scratch = tempfile.mkdtemp(prefix='careconnect-group-commit-')
+    failed = []
+    barrier = threading.Barrier(units)
+
+    # Traced from before the app exists, so the connection the writer takes
+    # from the pool is traced whenever it was opened
+    with WriterTrace(write_queue) as trace:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(scratch, 'group.db'),
+            'SECRET_KEY': 'group-commit',
+            'SQLITE_GROUP_COMMIT': True,
+            'SQLITE_GROUP_COMMIT_WAIT': wait,
+        })
+        with app.app_context():
+            db.create_all()
+
+        def submit(i):
+            with app.app_context():
+                barrier.wait()
+                try:
+                    submit_write(_unit, i, fail_every)
+                except RuntimeError:
+                    failed.append(i)
+
+        before = write_queue.stats()
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(units)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        after = write_queue.stats()
+
+    with app.app_context():
+        stored = db.session.query(GeocodeCache).count()
+    done, errors = transactions(trace.statements)
+    return {
+        'units': units,
+        'failed_units': len(failed),
+        'rows': stored,
+        'batches': after['batches'] - before['batches'],
+        'commits': sum(1 for _, end in done if end == 'COMMIT'),
+        'transactions': len(done),
+        'errors': errors,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that group commit ends each writer batch in one COMMIT.')
+    parser.add_argument('--units', type=int, default=50, help='write units submitted at once')
+    parser.add_argument('--wait', type=float, default=0.05, help='SQLITE_GROUP_COMMIT_WAIT for the run')
+    parser.add_argument('--fail-every', type=int, default=5, help='every Nth unit raises (0: none)')
+    args = parser.parse_args(argv)
+
+    result = run(args.units, args.wait, args.fail_every)
+    print(f"{result['units']} units ({result['failed_units']} failing) in {result['batches']} batches: "
+          f"{result['commits']} COMMITs, {result['rows']} rows stored")
+    errors = list(result['errors'])
+    if result['commits'] != result['batches'] or result['transactions'] != result['batches']:
+        errors.append(f"Expected one COMMIT per batch, got {result['commits']} for {result['batches']} batches")
+    if result['rows'] != result['units'] - result['failed_units']:
+        errors.append(f"Expected {result['units'] - result['failed_units']} rows, found {result['rows']}")
+    for error in errors:
+        print(error)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from bench.seed import PASSWORD
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# (action, weight) of the default mix
+WORKLOAD = [
+    ('login', 10),
+    ('search_caregivers', 30),
+    ('appointments', 30),
+    ('book_appointment', 20),
+    ('dispatch', 10),
+]
+SEARCH_TERMS = ['post surgery', 'palliative', 'feeding nurse', 'elderly overnight', 'physiotherapist karen',
+                'bathing', 'maternal child', 'medication westlands']
+PERCENTILES = (50, 95, 99)
+
+
+class Target:
+    # Id ranges of the seeded data the actions pick from
+
+    def __init__(self, app, db):
+        from models import Patient, Caregiver, Appointment
+        with app.app_context():
+            self.first_patient_user, self.last_patient_user = db.session.query(
+                db.func.min(Patient.user_id), db.func.max(Patient.user_id)).one()
+            self.caregivers = db.session.query(db.func.max(Caregiver.id)).scalar() or 0
+            self.appointments = db.session.query(db.func.max(Appointment.id)).scalar() or 0
+        if self.first_patient_user is None or not self.caregivers:
+            raise SystemExit('No seeded patients or caregivers; run python -m bench.seed first.')
+
+    def patient_email(self, rng):
+        return f'patient{rng.randint(self.first_patient_user, self.last_patient_user)}@bench.example'
+
+
+def _run_action(client, action, target, rng):
+    if action == 'login':
+        return client.post('/login', data={'email': target.patient_email(rng), 'password': PASSWORD})
+    if action == 'search_caregivers':
+        return client.get('/search_caregivers', query_string={'requirements': rng.choice(SEARCH_TERMS)})
+    if action == 'appointments':
+        return client.get('/appointments')
+    if action == 'book_appointment':
+        start = datetime.now().replace(second=0, microsecond=0) + timedelta(
+            days=rng.randint(1, 60), hours=rng.randint(0, 10), minutes=15 * rng.randint(0, 3))
+        return client.post('/book_appointment', data={
+            'caregiver_id': rng.randint(1, target.caregivers), 'date_time': start.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration': 60, 'location': 'Westlands', 'notes': ''})
+    if action == 'dispatch':
+        return client.post(f'/dispatch_caregiver/{rng.randint(1, target.appointments)}')
+    raise ValueError(action)
+
+
+def _worker(app, target, workload, deadline, seed, samples, errors):
+    rng = random.Random(seed)
+    actions = [action for action, _ in workload]
+    weights = [weight for _, weight in workload]
+    client = app.test_client()
+    client.post('/login', data={'email': target.patient_email(rng), 'password': PASSWORD})
+    while perf_counter() < deadline:
+        action = rng.choices(actions, weights)[0]
+        start = perf_counter()
+        try:
+            status = _run_action(client, action, target, rng).status_code
+        except Exception:
+            status = 599
+        samples[action].append(perf_counter() - start)
+        if status >= 500:
+            errors[action] += 1
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run(app, db, threads=8, duration=30.0, workload=WORKLOAD, seed=1):
+    target = Target(app, db)
+    per_thread = []
+    deadline = perf_counter() + duration
+    workers = []
+    for i in range(threads):
+        samples = {action: [] for action, _ in workload}
+        errors = {action: 0 for action, _ in workload}
+        per_thread.append((samples, errors))
+        workers.append(threading.Thread(target=_worker, args=(app, target, workload, deadline, seed + i,
+                                                              samples, errors)))
+    started = perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = perf_counter() - started
+
+    endpoints = {}
+    total = 0
+    for action, _ in workload:
+        latencies = sorted(value for samples, _ in per_thread for value in samples[action])
+        errors = sum(errors[action] for _, errors in per_thread)
+        total += len(latencies)
+        endpoints[action] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / elapsed,
+            **{f'p{p}_ms': percentile(latencies, p) * 1000 for p in PERCENTILES},
+        }
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'threads': threads,
+        'duration': elapsed,
+        'throughput': total / elapsed,
+        'endpoints': endpoints,
+    }
+
+
+def report(result, baseline=None):
+    lines = [f"{result['threads']} threads, {result['duration']:.1f}s, {result['throughput']:.1f} req/s",
+             f"{'endpoint':20} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+    for action, stats in result['endpoints'].items():
+        line = (f"{action:20} {stats['requests']:>9} {stats['errors']:>7} {stats['throughput']:>9.1f} "
+                f"{stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}")
+        before = (baseline or {}).get('endpoints', {}).get(action)
+        if before and before['p95_ms']:
+            line += f"   p95 {(stats['p95_ms'] / before['p95_ms'] - 1) * 100:+.0f}%"
+            if before['throughput']:
+                line += f", req/s {(stats['throughput'] / before['throughput'] - 1) * 100:+.0f}%"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _baseline_path(name):
+    return name if name.endswith('.json') else os.path.join(BASELINE_DIR, name + '.json')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a mixed workload against the app in-process.')
+    parser.add_argument('--database', required=True, help='SQLAlchemy URL of a database filled by bench.seed')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', metavar='NAME', help='write the result to bench/baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='show changes against a saved baseline')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    from models import db
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database, 'SECRET_KEY': 'bench', 'WTF_CSRF_ENABLED': False})
+    baseline = None
+    if args.compare:
+        with open(_baseline_path(args.compare)) as f:
+            baseline = json.load(f)
+
+    result = run(app, db, threads=args.threads, duration=args.duration, seed=args.seed)
+    print(report(result, baseline))
+
+    if args.save:
+        path = _baseline_path(args.save)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f'Saved {path}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
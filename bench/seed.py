@@ -0,0 +1,163 @@
+import argparse
+import csv
+import random
+import sys
+from datetime import datetime, time, timedelta
+from time import perf_counter
+
+from werkzeug.security import generate_password_hash
+
+# Users, patients and caregivers come out as <kind><n>@bench.example with
+# this password, so the load driver can log in as any of them
+PASSWORD = 'bench-password'
+CAREGIVER_SHARE = 0.3
+CHUNK_SIZE = 10000
+
+QUALIFICATIONS = ['Registered nurse', 'Enrolled nurse', 'Nursing assistant', 'Physiotherapist', 'Home care aide']
+CONDITIONS = ['Stroke recovery', 'Dementia', 'Hip replacement', 'Diabetes', 'Cancer', 'Post-natal', 'Frailty']
+
+
+def _chunks(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _insert(connection, table, rows):
+    # A list of parameter dicts makes SQLAlchemy use cursor.executemany()
+    count = 0
+    for chunk in _chunks(rows):
+        connection.execute(table.insert(), chunk)
+        count += len(chunk)
+    return count
+
+
+def seed(db, users, appointments_per_patient=3, reviews_per_patient=1, seed_value=42):
+    from geo import GAZETTEER_PATH
+    from availability import mask_to_bytes, ranges_to_mask
+    from models import User, Patient, Caregiver, CaregiverService, CaregiverSchedule, Appointment, Review
+    from ratings import backfill_ratings
+    from search import rebuild_search_index
+    from services import SERVICES, SERVICE_BITS, services_to_mask, mask_to_services
+
+    rng = random.Random(seed_value)
+    with open(GAZETTEER_PATH, newline='', encoding='utf-8') as f:
+        places = [(row['name'], float(row['latitude']), float(row['longitude'])) for row in csv.DictReader(f)]
+    password = generate_password_hash(PASSWORD)
+    now = datetime.now().replace(second=0, microsecond=0)
+    caregivers = int(users * CAREGIVER_SHARE)
+    patients = users - caregivers
+    service_masks = []
+
+    def user_rows():
+        for n in range(1, users + 1):
+            kind = 'caregiver' if n <= caregivers else 'patient'
+            name, _, _ = rng.choice(places)
+            yield {'id': n, 'name': f'{kind.title()} {n}', 'email': f'{kind}{n}@bench.example', 'password': password,
+                   'user_type': kind, 'gender': rng.choice(['male', 'female']), 'location': name,
+                   'phone_number': f'07{n:08d}'}
+
+    def caregiver_rows():
+        for n in range(1, caregivers + 1):
+            name, latitude, longitude = rng.choice(places)
+            mask = services_to_mask(rng.sample(SERVICES, rng.randint(1, 4)))
+            service_masks.append(mask)
+            yield {'id': n, 'user_id': n, 'name': f'Caregiver {n}', 'email': f'caregiver{n}@bench.example',
+                   'phone_number': f'07{n:08d}', 'location': name, 'latitude': latitude, 'longitude': longitude,
+                   'qualification': rng.choice(QUALIFICATIONS), 'experience': f'{rng.randint(1, 30)} years',
+                   'gender': rng.choice(['Male', 'Female']), 'services_offered': ', '.join(mask_to_services(mask)),
+                   'services_mask': mask, 'license_verified': True, 'available': True}
+
+    def service_rows():
+        for caregiver_id, mask in enumerate(service_masks, start=1):
+            for service in mask_to_services(mask):
+                yield {'caregiver_id': caregiver_id, 'service_bit': SERVICE_BITS[service]}
+
+    def patient_rows():
+        for n in range(1, patients + 1):
+            name, latitude, longitude = rng.choice(places)
+            care_needed = rng.choice(SERVICES)
+            yield {'id': n, 'user_id': caregivers + n, 'name': f'Patient {caregivers + n}',
+                   'email': f'patient{caregivers + n}@bench.example', 'phone_number': f'07{caregivers + n:08d}',
+                   'condition': rng.choice(CONDITIONS), 'location': name, 'latitude': latitude,
+                   'longitude': longitude, 'gender': rng.choice(['Male', 'Female']), 'care_needed': care_needed,
+                   'care_needed_mask': services_to_mask([care_needed])}
+
+    weekdays = mask_to_bytes(ranges_to_mask([(time(8), time(18))]))
+    weekend = mask_to_bytes(ranges_to_mask([(time(9), time(13))]))
+
+    def schedule_rows():
+        for n in range(1, caregivers + 1):
+            yield {'caregiver_id': n, 'weekly_slots': weekdays * 5 + weekend * 2}
+
+    def appointment_rows():
+        for patient_id in range(1, patients + 1):
+            for _ in range(appointments_per_patient):
+                start = now + timedelta(days=rng.randint(-30, 60), hours=rng.randint(8, 16), minutes=15 * rng.randint(0, 3))
+                yield {'patient_id': patient_id, 'caregiver_id': rng.randint(1, caregivers), 'date_time': start,
+                       'duration': rng.choice([30, 60, 90, 120]), 'location': rng.choice(places)[0],
+                       'status': 'Completed' if start < now else 'Scheduled'}
+
+    def review_rows():
+        for patient_id in range(1, patients + 1):
+            for _ in range(reviews_per_patient):
+                yield {'reviewer_id': patient_id, 'caregiver_id': rng.randint(1, caregivers),
+                       'rating': rng.choices([1, 2, 3, 4, 5], weights=[1, 2, 5, 12, 10])[0], 'comments': None}
+
+    counts = {}
+    with db.engine.begin() as connection:
+        counts['user'] = _insert(connection, User.__table__, user_rows())
+        counts['caregiver'] = _insert(connection, Caregiver.__table__, caregiver_rows())
+        counts['caregiver_service'] = _insert(connection, CaregiverService.__table__, service_rows())
+        counts['caregiver_schedule'] = _insert(connection, CaregiverSchedule.__table__, schedule_rows())
+        counts['patient'] = _insert(connection, Patient.__table__, patient_rows())
+        counts['appointment'] = _insert(connection, Appointment.__table__, appointment_rows())
+        counts['review'] = _insert(connection, Review.__table__, review_rows())
+        # Core inserts skip the mapper events that keep the search index and
+        # the caregiver rating aggregates in step
+        rebuild_search_index(connection)
+        backfill_ratings(connection)
+        connection.exec_driver_sql('ANALYZE')
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fill an empty database with synthetic CareConnect data.')
+    parser.add_argument('--database', required=True, help='SQLAlchemy URL of the database to fill')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--appointments-per-patient', type=int, default=3)
+    parser.add_argument('--reviews-per-patient', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    from models import db, User
+    from search import ensure_search_index
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    with app.app_context():
+        db.create_all()
+        ensure_search_index()
+        db.session.commit()
+        if db.session.query(User.id).first() is not None:
+            print('The database already has users; seed an empty one.', file=sys.stderr)
+            return 1
+        db.session.close()
+
+        start = perf_counter()
+        counts = seed(db, args.users, args.appointments_per_patient, args.reviews_per_patient, args.seed)
+        elapsed = perf_counter() - start
+
+    for table, count in counts.items():
+        print(f'{table:20} {count:>10}')
+    print(f'{sum(counts.values())} rows in {elapsed:.1f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
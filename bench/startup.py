@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+from bench.load import _baseline_path
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a fresh interpreter per measurement and prints one JSON line
+WORKER = '''
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1], 'SECRET_KEY': 'bench'})
+created = time.perf_counter()
+status = app.test_client().get(sys.argv[2]).status_code
+served = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'create_app_ms': (created - imported) * 1000,
+                  'first_request_ms': (served - created) * 1000, 'status': status}))
+'''
+PHASES = ('import_ms', 'create_app_ms', 'first_request_ms', 'ready_ms')
+
+
+def _env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    return env
+
+
+def measure(database, path='/'):
+    """One cold start: phase timings in ms, ready_ms counting interpreter start-up too."""
+    start = perf_counter()
+    out = subprocess.run([sys.executable, '-c', WORKER, database, path], cwd=ROOT, env=_env(),
+                         capture_output=True, text=True, check=True).stdout
+    ready = (perf_counter() - start) * 1000
+    # The app's own log lines go to stderr; the result is the last stdout line
+    result = json.loads(out.strip().splitlines()[-1])
+    result['ready_ms'] = ready
+    return result
+
+
+def import_profile(top=15):
+    """``[(package, self_ms)]`` of the slowest top-level packages when importing app."""
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT, env=_env(),
+                         capture_output=True, text=True, check=True).stderr
+    totals = {}
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + int(self_us) / 1000
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+def run(database, runs=5, path='/'):
+    samples = [measure(database, path) for _ in range(runs)]
+    result = {'runs': runs, 'path': path, 'status': samples[-1]['status']}
+    for phase in PHASES:
+        values = [sample[phase] for sample in samples]
+        result[phase] = {'median': statistics.median(values), 'min': min(values), 'max': max(values)}
+    return result
+
+
+def report(result, baseline=None, profile=None):
+    lines = [f"{result['runs']} cold starts, first request GET {result['path']} -> {result['status']}",
+             f"{'phase':18} {'median':>9} {'min':>9} {'max':>9}"]
+    for phase in PHASES:
+        stats = result[phase]
+        line = f"{phase:18} {stats['median']:>9.1f} {stats['min']:>9.1f} {stats['max']:>9.1f}"
+        before = (baseline or {}).get(phase)
+        if before and before['median']:
+            line += f"   {(stats['median'] / before['median'] - 1) * 100:+.0f}%"
+        lines.append(line)
+    if profile:
+        lines.append('\nSlowest imports (self time, ms):')
+        lines.extend(f'{package:30} {ms:>9.1f}' for package, ms in profile)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time cold starts of the app, from interpreter launch to its first response.')
+    parser.add_argument('--database', help='SQLAlchemy URL (default: an empty scratch SQLite file)')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--path', default='/', help='URL of the first request')
+    parser.add_argument('--target-ms', type=float, help='fail when the median time to ready exceeds this')
+    parser.add_argument('--profile', type=int, nargs='?', const=15, metavar='N',
+                        help='also list the N slowest packages to import')
+    parser.add_argument('--save', metavar='NAME', help='write the result to bench/baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='show changes against a saved baseline')
+    args = parser.parse_args(argv)
+
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='careconnect-startup-'), 'startup.db')
+    baseline = None
+    if args.compare:
+        with open(_baseline_path(args.compare)) as f:
+            baseline = json.load(f)
+
+    result = run(database, runs=args.runs, path=args.path)
+    profile = import_profile(args.profile) if args.profile else None
+    print(report(result, baseline, profile))
+
+    if args.save:
+        path = _baseline_path(args.save)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f'Saved {path}')
+
+    if args.target_ms is not None and result['ready_ms']['median'] > args.target_ms:
+        print(f"Median time to ready {result['ready_ms']['median']:.1f} ms is over the {args.target_ms:.0f} ms target.")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,247 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db
+from metrics import request_state, recording_into
+
+# Defaults, overridable through app.config (see init_app)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',          # readers keep reading while a write commits
+    'synchronous': 'NORMAL',        # fsync at checkpoints only; still safe with WAL
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,       # negative means KiB, so 64 MiB of page cache
+    'busy_timeout': 5000,           # ms to wait for another process's write lock
+    'temp_store': 'MEMORY',
+}
+SQLITE_WRITE_QUEUE = True           # False runs write units on the request thread
+SQLITE_GROUP_COMMIT = False         # commit several queued units in one transaction
+SQLITE_GROUP_COMMIT_WAIT = 0.005    # seconds the writer waits for more units
+SQLITE_GROUP_COMMIT_SIZE = 100      # units per transaction at most
+
+_pragmas = dict(SQLITE_PRAGMAS)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in _pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+def _begin_write_transaction(conn):
+    # pysqlite only sends BEGIN ahead of an INSERT/UPDATE/DELETE, never
+    # ahead of a SAVEPOINT, so a unit's savepoint would be the outermost
+    # transaction and its RELEASE would commit on its own. Beginning
+    # explicitly on the writer thread keeps each batch, and each unit's
+    # reads and writes, in one transaction that ends in a single COMMIT.
+    if conn.dialect.name == 'sqlite' and threading.current_thread() is write_queue._writer:
+        conn.exec_driver_sql('BEGIN')
+
+
+class WriteQueue:
+    # Runs every write of the process on one writer thread, in arrival
+    # order. SQLite allows a single writer at a time, and a transaction that
+    # read before it wrote cannot wait for the lock, so several request
+    # threads writing at once fail with "database is locked". Funnelling
+    # them through one thread means they queue here instead, while reads on
+    # the request threads never wait for a write.
+    #
+    # A unit of work is a callable that makes its changes on db.session; the
+    # writer commits after it returns (or rolls back and re-raises in the
+    # caller if it raises). Units run in the writer's own session, so they
+    # take ids and plain values, load what they change, and return plain
+    # values rather than ORM objects. Each unit runs in an app context of
+    # the app that submitted it, and its SQL counts toward the /metrics
+    # figures of the request that submitted it.
+    #
+    # With group commit on, the writer collects units for up to
+    # `group_wait` seconds or `group_size` units and runs them in a single
+    # transaction, each inside its own SAVEPOINT so a failing unit only
+    # undoes itself. Callers get their result once the shared COMMIT has
+    # returned, so the cost of a sync is spread over the whole batch; that
+    # COMMIT is not counted toward any one request.
+
+    def __init__(self):
+        self.enabled = SQLITE_WRITE_QUEUE
+        self.group_commit = SQLITE_GROUP_COMMIT
+        self.group_wait = SQLITE_GROUP_COMMIT_WAIT
+        self.group_size = SQLITE_GROUP_COMMIT_SIZE
+        self.committed = 0
+        self.failed = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('SQLITE_WRITE_QUEUE', SQLITE_WRITE_QUEUE)
+        self.group_commit = app.config.get('SQLITE_GROUP_COMMIT', SQLITE_GROUP_COMMIT)
+        self.group_wait = app.config.get('SQLITE_GROUP_COMMIT_WAIT', SQLITE_GROUP_COMMIT_WAIT)
+        self.group_size = app.config.get('SQLITE_GROUP_COMMIT_SIZE', SQLITE_GROUP_COMMIT_SIZE)
+
+    def _writer_thread(self):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    writer = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                    writer.start()
+                    self._writer = writer
+        return self._writer
+
+    def submit(self, unit, *args, **kwargs):
+        """Run ``unit(*args, **kwargs)`` as its own committed transaction and return its result."""
+        if threading.current_thread() is self._writer:
+            # Called from inside another unit: part of that unit's transaction
+            return unit(*args, **kwargs)
+        if not self.enabled:
+            return self._execute(unit, args, kwargs, request_state())
+        self._writer_thread()
+        future = Future()
+        self._queue.put((current_app._get_current_object(), unit, args, kwargs, future, request_state()))
+        return future.result()
+
+    def _execute(self, unit, args, kwargs, metrics_state=None):
+        try:
+            with recording_into(metrics_state):
+                result = unit(*args, **kwargs)
+                db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            with self._lock:
+                self.failed += 1
+            raise
+        with self._lock:
+            self.committed += 1
+            self.batches += 1
+        return result
+
+    def _next_batch(self):
+        # Block for the first unit, then take whatever arrives within group_wait
+        batch = [self._queue.get()]
+        if not self.group_commit:
+            return batch
+        deadline = time.monotonic() + self.group_wait
+        while batch[-1] is not None and len(batch) < self.group_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _execute_batch(self, batch):
+        session = db.session()
+        done = []
+        for unit, args, kwargs, future, metrics_state in batch:
+            # Mapper events queue cache updates in session.info and drop them on
+            # any rollback, so each unit starts with an empty info and its
+            # entries are only kept once its savepoint is released
+            kept = dict(session.info)
+            session.info.clear()
+            try:
+                with recording_into(metrics_state), session.begin_nested():
+                    result = unit(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                with self._lock:
+                    self.failed += 1
+            else:
+                done.append((future, result))
+                for key, value in session.info.items():
+                    if key not in kept:
+                        kept[key] = value
+                    elif isinstance(value, dict):
+                        kept[key].update(value)
+                    elif isinstance(value, set):
+                        kept[key] |= value
+                    else:
+                        kept[key].extend(value)
+            session.info.clear()
+            session.info.update(kept)
+
+        try:
+            session.commit()
+        except BaseException as e:
+            session.rollback()
+            for future, _ in done:
+                future.set_exception(e)
+            with self._lock:
+                self.failed += len(done)
+            return
+        with self._lock:
+            self.committed += len(done)
+            self.batches += 1
+        for future, result in done:
+            future.set_result(result)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is None
+            by_app = {}
+            for item in batch:
+                if item is not None and item[4].set_running_or_notify_cancel():
+                    by_app.setdefault(item[0], []).append(item[1:])
+            for app, units in by_app.items():
+                with app.app_context():
+                    if len(units) == 1:
+                        unit, args, kwargs, future, metrics_state = units[0]
+                        try:
+                            result = self._execute(unit, args, kwargs, metrics_state)
+                        except BaseException as e:
+                            future.set_exception(e)
+                        else:
+                            future.set_result(result)
+                    else:
+                        self._execute_batch(units)
+            if stop:
+                return
+
+    def close(self):
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self._queue.qsize(), 'committed': self.committed, 'failed': self.failed,
+                    'batches': self.batches}
+
+
+write_queue = WriteQueue()
+
+
+def submit_write(unit, *args, **kwargs):
+    return write_queue.submit(unit, *args, **kwargs)
+
+
+_listening = False
+
+
+def init_app(app):
+    global _listening
+    _pragmas.clear()
+    _pragmas.update(app.config.get('SQLITE_PRAGMAS', SQLITE_PRAGMAS))
+    if app.config.get('SQLITE_GROUP_COMMIT', SQLITE_GROUP_COMMIT) and 'SQLITE_PRAGMAS' not in app.config:
+        # A batch is only acknowledged once it is on disk; with one sync per
+        # batch instead of per request, FULL is affordable
+        _pragmas['synchronous'] = 'FULL'
+    if not _listening:
+        # Every new DB-API connection, whenever the pool opens one
+        event.listen(Engine, 'connect', _set_sqlite_pragmas)
+        event.listen(Engine, 'begin', _begin_write_transaction)
+        atexit.register(write_queue.close)
+        _listening = True
+    write_queue.init_app(app)
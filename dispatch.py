@@ -0,0 +1,236 @@
+import heapq
+import threading
+from datetime import datetime
+
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Caregiver, Appointment
+from geo import caregiver_index, load_caregiver_index, geocode
+from availability import availability_index
+from ratings import on_rating_change, RATING_PRIOR_MEAN
+from scheduling import reserve_slot, BookingConflict
+
+# Lower score is better: kilometres away, minus stars of rating, plus
+# upcoming visits already on the caregiver's books
+DISTANCE_WEIGHT = 1.0
+RATING_WEIGHT = 2.0
+LOAD_WEIGHT = 3.0
+
+# Rating assumed for caregivers nobody has reviewed yet (their rating_score)
+DEFAULT_RATING = RATING_PRIOR_MEAN
+
+# How many of the nearest qualified caregivers are scored per appointment
+CANDIDATES_PER_APPOINTMENT = 20
+
+
+class DispatchEngine:
+    # Availability, rating and load for every caregiver, kept in memory so a
+    # dispatch never has to scan the caregiver table. `available` marks the
+    # caregivers taking dispatches at all; whether one is free at the visit
+    # time comes from their schedule. The database stays the source of
+    # truth: a caregiver is only assigned once reserve_slot, in the same
+    # write unit, finds the visit's time free on their books, so two workers
+    # (threads or processes) can never double-book them.
+
+    def __init__(self):
+        self.loaded = False
+        self._available = set()
+        self._rating = {}
+        self._load = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        available = {cid for (cid,) in db.session.query(Caregiver.id).filter(Caregiver.available.is_(True))}
+        # bulk_load marks whole-table reads as intended for query_plans.py
+        rating = dict(db.session.query(Caregiver.id, Caregiver.rating_score).filter(Caregiver.rating_count > 0)
+                      .execution_options(bulk_load=True))
+        load = dict(
+            db.session.query(Appointment.caregiver_id, func.count(Appointment.id))
+            .filter(Appointment.caregiver_id.isnot(None), Appointment.date_time >= datetime.now(),
+                    Appointment.status != 'Completed')
+            .group_by(Appointment.caregiver_id)
+            .execution_options(bulk_load=True)
+        )
+        with self._lock:
+            self._available = available
+            self._rating = {cid: float(value) for cid, value in rating.items()}
+            self._load = load
+            self.loaded = True
+        if not caregiver_index.loaded:
+            load_caregiver_index()
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def is_available(self, caregiver_id):
+        return caregiver_id in self._available
+
+    def set_available(self, caregiver_id, available):
+        with self._lock:
+            if available:
+                self._available.add(caregiver_id)
+            else:
+                self._available.discard(caregiver_id)
+
+    def record_rating(self, caregiver_id, rating):
+        self._rating[caregiver_id] = rating
+
+    def score(self, caregiver_id, distance_km):
+        rating = self._rating.get(caregiver_id, DEFAULT_RATING)
+        load = self._load.get(caregiver_id, 0)
+        return DISTANCE_WEIGHT * distance_km - RATING_WEIGHT * rating + LOAD_WEIGHT * load
+
+    def _appointment_coordinates(self, appointment):
+        coords = geocode(appointment.location)
+        if coords is None and appointment.patient is not None and appointment.patient.latitude is not None:
+            coords = (appointment.patient.latitude, appointment.patient.longitude)
+        return coords
+
+    def candidates(self, appointment, k=CANDIDATES_PER_APPOINTMENT):
+        """Return a heap of ``(score, caregiver_id)`` for an appointment."""
+        coords = self._appointment_coordinates(appointment)
+        if coords is None:
+            return []
+        services_mask = appointment.patient.care_needed_mask if appointment.patient is not None else 0
+
+        # Skip caregivers whose schedule is off or booked at the visit time;
+        # those without a schedule are not filtered
+        def accept(caregiver_id):
+            return self.is_available(caregiver_id) and \
+                availability_index.is_free(caregiver_id, appointment.date_time, appointment.duration) is not False
+
+        nearest = caregiver_index.nearest(coords[0], coords[1], k, services_mask or 0, accept)
+        heap = [(self.score(cid, distance), cid) for distance, cid in nearest]
+        heapq.heapify(heap)
+        return heap
+
+    def _add_load(self, caregiver_id, delta):
+        with self._lock:
+            self._load[caregiver_id] = max(self._load.get(caregiver_id, 0) + delta, 0)
+
+    def _claim(self, appointment, caregiver_id):
+        # The same check as a booking: the caregiver's row stays write-locked
+        # until the caller commits, and the visit must not overlap anything
+        # on their books (this appointment aside)
+        if not self.is_available(caregiver_id):
+            return False
+        try:
+            reserve_slot(caregiver_id, None, appointment.date_time, appointment.duration, ignore_id=appointment.id)
+        except BookingConflict:
+            return False
+        return True
+
+    def _assign(self, appointment, caregiver_id):
+        previous = appointment.caregiver_id
+        appointment.caregiver_id = caregiver_id
+        appointment.status = 'Dispatched'
+        if previous != caregiver_id:
+            # Moved between caregivers' loads; undone if the caller rolls back
+            self._add_load(caregiver_id, 1)
+            if previous is not None:
+                self._add_load(previous, -1)
+            db.session.info.setdefault('dispatch_claims', []).append((caregiver_id, previous))
+
+    def dispatch(self, appointment):
+        """Assign the best available caregiver to ``appointment``.
+
+        Returns the caregiver id, or None when nobody suitable is free. The
+        caller commits; a rollback undoes the change to the caregivers' loads.
+        """
+        self._ensure_loaded()
+        heap = self.candidates(appointment)
+        while heap:
+            _, caregiver_id = heapq.heappop(heap)
+            if self._claim(appointment, caregiver_id):
+                self._assign(appointment, caregiver_id)
+                return caregiver_id
+        return None
+
+    def dispatch_batch(self, appointments):
+        """Greedy bipartite matching of pending appointments to caregivers.
+
+        Every (appointment, candidate) pair is scored, then pairs are taken
+        cheapest first as long as the appointment is not matched yet and the
+        caregiver is free then; a caregiver can take several visits that do
+        not overlap. Returns ``{appointment_id: caregiver_id}`` for the
+        appointments that matched.
+        """
+        self._ensure_loaded()
+        edges = []
+        for appointment in appointments:
+            for score, caregiver_id in self.candidates(appointment):
+                edges.append((score, appointment.id, caregiver_id))
+        edges.sort()
+
+        by_id = {appointment.id: appointment for appointment in appointments}
+        matched = {}
+        for _, appointment_id, caregiver_id in edges:
+            if appointment_id in matched:
+                continue
+            # Visits assigned earlier in the batch are flushed before the check, so they count
+            if self._claim(by_id[appointment_id], caregiver_id):
+                self._assign(by_id[appointment_id], caregiver_id)
+                matched[appointment_id] = caregiver_id
+        return matched
+
+    def release(self, caregiver_id):
+        # Called when a dispatched visit ends, which no longer counts toward
+        # the caregiver's load; undone if the caller rolls back
+        self._add_load(caregiver_id, -1)
+        db.session.info.setdefault('dispatch_claims', []).append((None, caregiver_id))
+
+
+dispatch_engine = DispatchEngine()
+
+# New reviews move a caregiver's rating without reloading
+on_rating_change(dispatch_engine.record_rating)
+
+
+def pending_appointments(limit=500):
+    # Only visits booked without a caregiver; one the patient chose is theirs to keep
+    return Appointment.query.filter(Appointment.status == 'Requested', Appointment.caregiver_id.is_(None),
+                                    Appointment.date_time >= datetime.now()) \
+        .order_by(Appointment.date_time).limit(limit).all()
+
+
+# Newly registered or edited caregivers join the availability set after commit
+@event.listens_for(Caregiver, 'after_insert')
+def _caregiver_inserted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('dispatch_changes', []).append((target.id, bool(target.available)))
+
+
+@event.listens_for(Caregiver, 'after_update')
+def _caregiver_updated(mapper, connection, target):
+    session = object_session(target)
+    if session is not None and inspect(target).attrs.available.history.has_changes():
+        session.info.setdefault('dispatch_changes', []).append((target.id, bool(target.available)))
+
+
+@event.listens_for(Caregiver, 'after_delete')
+def _caregiver_deleted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('dispatch_changes', []).append((target.id, False))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_dispatch_changes(session):
+    session.info.pop('dispatch_claims', None)
+    changes = session.info.pop('dispatch_changes', None)
+    if changes and dispatch_engine.loaded:
+        for caregiver_id, available in changes:
+            dispatch_engine.set_available(caregiver_id, available)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_dispatch_changes(session, previous_transaction):
+    session.info.pop('dispatch_changes', None)
+    for caregiver_id, previous in session.info.pop('dispatch_claims', []):
+        if caregiver_id is not None:
+            dispatch_engine._add_load(caregiver_id, -1)
+        if previous is not None:
+            dispatch_engine._add_load(previous, 1)
@@ -1,7 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, SelectField, SelectMultipleField, SubmitField, PasswordField, IntegerField, DateField, DateTimeField, TextAreaField
-from wtforms.validators import DataRequired, Email, EqualTo, ValidationError
+from wtforms import StringField, SelectField, SelectMultipleField, SubmitField, PasswordField, IntegerField, DateField, DateTimeField, TextAreaField, BooleanField
+from wtforms.validators import DataRequired, Email, EqualTo, Optional, ValidationError
 from models import User
+from availability import parse_ranges
 
 class RegistrationForm(FlaskForm):
     name = StringField('Name', validators=[DataRequired()])
@@ -16,7 +17,7 @@ class RegistrationForm(FlaskForm):
     submit = SubmitField('Sign Up')
 
     def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
+        user = User.find_by_email(email.data)
         if user:
             raise ValidationError('That email is already taken. Please choose a different one.')
 
@@ -69,9 +70,37 @@ class ProfileForm(FlaskForm):
     submit = SubmitField('Update Profile')
 
 class AppointmentForm(FlaskForm):
+    caregiver_id = IntegerField('Caregiver', validators=[Optional()])
+    patient_id = IntegerField('Patient', validators=[Optional()])
     date_time = DateTimeField('Date and Time', validators=[DataRequired()], format='%Y-%m-%d %H:%M:%S')
     duration = IntegerField('Duration (minutes)', validators=[DataRequired()])
     notes = TextAreaField('Additional Notes')
     location = StringField('Location', validators=[DataRequired()])
     submit = SubmitField('Book Appointment')      
-        
\ No newline at end of file
+        
+
+
+def working_hours(form, field):
+    # 'HH:MM-HH:MM, ...' as parsed by availability.parse_ranges; empty means off
+    try:
+        parse_ranges(field.data)
+    except ValueError as e:
+        raise ValidationError(str(e))
+
+class WeeklyScheduleForm(FlaskForm):
+    WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+    monday = StringField('Monday', validators=[working_hours])
+    tuesday = StringField('Tuesday', validators=[working_hours])
+    wednesday = StringField('Wednesday', validators=[working_hours])
+    thursday = StringField('Thursday', validators=[working_hours])
+    friday = StringField('Friday', validators=[working_hours])
+    saturday = StringField('Saturday', validators=[working_hours])
+    sunday = StringField('Sunday', validators=[working_hours])
+    submit = SubmitField('Save Weekly Hours')
+
+class DayExceptionForm(FlaskForm):
+    date = DateField('Date', format='%Y-%m-%d', validators=[DataRequired()])
+    hours = StringField('Hours (empty for a day off)', validators=[working_hours])
+    clear = BooleanField('Use my weekly hours on this date again')
+    submit = SubmitField('Save Date')
@@ -0,0 +1,318 @@
+import csv
+import heapq
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Caregiver, Patient, GeocodeCache
+from services import services_to_mask
+
+# Offline gazetteer shipped with the app: one "name,latitude,longitude" row per place
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gazetteer.csv')
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.19
+
+# Side of a grid cell in degrees, roughly 5.5km at the equator
+CELL_DEGREES = 0.05
+
+# Normalized locations whose coordinates are kept in process, least recently used dropped
+GEOCODE_MEMO_SIZE = 10000
+
+_gazetteer = None
+_gazetteer_names = None
+_gazetteer_patterns = None
+_geocode_memo = OrderedDict()
+_geocode_memo_lock = threading.Lock()
+
+
+def normalize_location(location):
+    parts = (' '.join(part.split()) for part in (location or '').lower().split(','))
+    return ', '.join(part for part in parts if part)
+
+
+def _load_gazetteer():
+    global _gazetteer, _gazetteer_names, _gazetteer_patterns
+    if _gazetteer is None:
+        places = {}
+        names = {}
+        with open(GAZETTEER_PATH, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                places[normalize_location(row['name'])] = (float(row['latitude']), float(row['longitude']))
+                names[normalize_location(row['name'])] = row['name']
+        # Longest names first so "nairobi cbd" wins over "nairobi"
+        _gazetteer_patterns = [(re.compile(r'\b' + re.escape(name) + r'\b'), name)
+                               for name in sorted(places, key=len, reverse=True)]
+        _gazetteer_names = names
+        _gazetteer = places
+    return _gazetteer
+
+
+def _match_place(normalized):
+    # Exact match first, then the most specific comma-separated part
+    # ("westlands, nairobi" -> westlands), then any place named in the text
+    places = _load_gazetteer()
+    if normalized in places:
+        return normalized
+    for part in normalized.split(', '):
+        if part in places:
+            return part
+    for pattern, name in _gazetteer_patterns:
+        if pattern.search(normalized):
+            return name
+    return None
+
+
+def resolve_location(normalized):
+    name = _match_place(normalized)
+    return _gazetteer[name] if name is not None else None
+
+
+def place_name(location):
+    """The gazetteer name of the place a free-text location refers to, or None."""
+    name = _match_place(normalize_location(location))
+    return _gazetteer_names[name] if name is not None else None
+
+
+def geocode(location, connection=None):
+    """Return ``(latitude, longitude)`` for a free-text location, or None."""
+    key = normalize_location(location)
+    if not key:
+        return None
+    with _geocode_memo_lock:
+        if key in _geocode_memo:
+            _geocode_memo.move_to_end(key)
+            return _geocode_memo[key]
+
+    connection = connection or db.session.connection()
+    cache = GeocodeCache.__table__
+    row = connection.execute(
+        db.select(cache.c.latitude, cache.c.longitude).where(cache.c.location == key)
+    ).first()
+    if row is not None:
+        coords = (row.latitude, row.longitude) if row.latitude is not None else None
+    else:
+        coords = resolve_location(key)
+        latitude, longitude = coords if coords else (None, None)
+        connection.execute(
+            cache.insert().prefix_with('OR IGNORE').values(location=key[:255], latitude=latitude, longitude=longitude)
+        )
+    with _geocode_memo_lock:
+        _geocode_memo[key] = coords
+        _geocode_memo.move_to_end(key)
+        while len(_geocode_memo) > GEOCODE_MEMO_SIZE:
+            _geocode_memo.popitem(last=False)
+    return coords
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class CaregiverGrid:
+    # Uniform lat/lon grid of caregiver positions. Cells map to
+    # {caregiver_id: (latitude, longitude, services_mask)} and nearest
+    # queries search outwards ring by ring from the query cell.
+
+    def __init__(self, cell_degrees=CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.loaded = False
+        self._cells = {}
+        self._cell_of = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._cell_of)
+
+    def _cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees))
+
+    def add(self, caregiver_id, latitude, longitude, services_mask=0):
+        with self._lock:
+            self.remove(caregiver_id)
+            cell = self._cell(latitude, longitude)
+            self._cells.setdefault(cell, {})[caregiver_id] = (latitude, longitude, services_mask)
+            self._cell_of[caregiver_id] = cell
+
+    def remove(self, caregiver_id):
+        with self._lock:
+            cell = self._cell_of.pop(caregiver_id, None)
+            if cell is not None:
+                members = self._cells[cell]
+                members.pop(caregiver_id, None)
+                if not members:
+                    del self._cells[cell]
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self._cell_of.clear()
+            self.loaded = False
+
+    def _ring(self, center, radius):
+        ci, cj = center
+        if radius == 0:
+            yield center
+            return
+        for j in range(cj - radius, cj + radius + 1):
+            yield (ci - radius, j)
+            yield (ci + radius, j)
+        for i in range(ci - radius + 1, ci + radius):
+            yield (i, cj - radius)
+            yield (i, cj + radius)
+
+    def nearest(self, latitude, longitude, k=5, services_mask=0, accept=None):
+        """Return up to ``k`` ``(distance_km, caregiver_id)`` pairs, closest first.
+
+        Only caregivers offering every service in ``services_mask`` and, when
+        given, passing ``accept(caregiver_id)`` are considered.
+        """
+        best = []  # max-heap of (-distance, caregiver_id)
+
+        def consider(members):
+            for caregiver_id, (lat, lon, mask) in members.items():
+                if mask & services_mask != services_mask:
+                    continue
+                if accept is not None and not accept(caregiver_id):
+                    continue
+                distance = haversine_km(latitude, longitude, lat, lon)
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, caregiver_id))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, caregiver_id))
+
+        with self._lock:
+            center = self._cell(latitude, longitude)
+            radius = 0
+            while self._cells:
+                if 8 * radius > len(self._cells):
+                    # The ring now has more cells than are occupied, so finish
+                    # by visiting the remaining occupied cells directly
+                    for cell, members in self._cells.items():
+                        if max(abs(cell[0] - center[0]), abs(cell[1] - center[1])) >= radius:
+                            consider(members)
+                    break
+                for cell in self._ring(center, radius):
+                    members = self._cells.get(cell)
+                    if members:
+                        consider(members)
+                # Anything outside the rings searched so far is at least
+                # `radius` cells away from the query point
+                shrink = math.cos(math.radians(min(abs(latitude) + (radius + 1) * self.cell_degrees, 89.0)))
+                if len(best) == k and -best[0][0] <= radius * self.cell_degrees * KM_PER_DEGREE * shrink:
+                    break
+                radius += 1
+
+        return sorted((-distance, caregiver_id) for distance, caregiver_id in best)
+
+
+caregiver_index = CaregiverGrid()
+
+
+def load_caregiver_index():
+    rows = db.session.query(Caregiver.id, Caregiver.latitude, Caregiver.longitude, Caregiver.services_mask) \
+        .filter(Caregiver.latitude.isnot(None), Caregiver.longitude.isnot(None)) \
+        .execution_options(bulk_load=True)
+    with caregiver_index._lock:
+        caregiver_index.clear()
+        for caregiver_id, latitude, longitude, services_mask in rows:
+            caregiver_index.add(caregiver_id, latitude, longitude, services_mask or 0)
+        caregiver_index.loaded = True
+
+
+def nearest_caregivers(patient, k=5, services=None, accept=None):
+    """Return the ``k`` closest caregivers to ``patient`` as ``(caregiver, distance_km)``.
+
+    ``services`` is a list of service names or a mask and defaults to the
+    patient's ``care_needed_mask``.
+    """
+    if patient.latitude is not None and patient.longitude is not None:
+        coords = (patient.latitude, patient.longitude)
+    else:
+        coords = geocode(patient.location)
+    if coords is None:
+        return []
+
+    if services is None:
+        services_mask = patient.care_needed_mask or 0
+    elif isinstance(services, int):
+        services_mask = services
+    else:
+        services_mask = services_to_mask(services)
+
+    if not caregiver_index.loaded:
+        load_caregiver_index()
+    hits = caregiver_index.nearest(coords[0], coords[1], k, services_mask, accept)
+    if not hits:
+        return []
+
+    caregivers = {c.id: c for c in Caregiver.query.filter(Caregiver.id.in_([cid for _, cid in hits]))}
+    return [(caregivers[cid], distance) for distance, cid in hits if cid in caregivers]
+
+
+def geocode_missing_locations():
+    # Backfill coordinates for rows saved before geocoding existed
+    updated = 0
+    for model in (Caregiver, Patient):
+        for row in model.query.filter(model.latitude.is_(None), model.location.isnot(None)):
+            coords = geocode(row.location)
+            if coords:
+                row.latitude, row.longitude = coords
+                updated += 1
+    return updated
+
+
+# Geocode on save, whenever the location is new or has changed
+def _set_coordinates(mapper, connection, target):
+    history = inspect(target).attrs.location.history
+    if target.latitude is None or history.has_changes():
+        coords = geocode(target.location, connection)
+        target.latitude, target.longitude = coords if coords else (None, None)
+
+
+for _model in (Caregiver, Patient):
+    event.listen(_model, 'before_insert', _set_coordinates)
+    event.listen(_model, 'before_update', _set_coordinates)
+
+
+# Caregiver changes reach the in-memory index only once their transaction
+# commits, so a rolled back registration never shows up in lookups
+def _queue_index_change(session, change):
+    if session is not None:
+        session.info.setdefault('caregiver_index_changes', []).append(change)
+
+
+@event.listens_for(Caregiver, 'after_insert')
+@event.listens_for(Caregiver, 'after_update')
+def _caregiver_saved(mapper, connection, target):
+    _queue_index_change(object_session(target),
+                        ('add', target.id, target.latitude, target.longitude, target.services_mask or 0))
+
+
+@event.listens_for(Caregiver, 'after_delete')
+def _caregiver_deleted(mapper, connection, target):
+    _queue_index_change(object_session(target), ('remove', target.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_index_changes(session):
+    changes = session.info.pop('caregiver_index_changes', None)
+    if not changes or not caregiver_index.loaded:
+        return
+    for change in changes:
+        if change[0] == 'add' and change[2] is not None and change[3] is not None:
+            caregiver_index.add(*change[1:])
+        else:
+            caregiver_index.remove(change[1])
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_index_changes(session, previous_transaction):
+    session.info.pop('caregiver_index_changes', None)
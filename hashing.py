@@ -0,0 +1,126 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+# Defaults, overridable through app.config (see init_app)
+PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'  # Werkzeug's default; e.g. 'pbkdf2:sha256:600000'
+PASSWORD_HASH_WORKERS = 4
+PASSWORD_HASH_QUEUE = 64       # hashes allowed to wait for a worker
+PASSWORD_HASH_WAIT = 2.0       # seconds a request waits for a queue slot
+
+# Werkzeug's scrypt n, r and p
+SCRYPT_DEFAULTS = ('32768', '8', '1')
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def _full_method(method):
+    # The method as Werkzeug writes it at the front of a hash, with the
+    # parameters it fills in when they are left out ('pbkdf2:sha256' is
+    # stored as 'pbkdf2:sha256:<iterations>'). Werkzeug only takes scrypt
+    # with all of n, r and p or none, so a partial 'scrypt:16384' gets the
+    # default r and p here ('scrypt:16384:8:1')
+    name, *args = method.split(':')
+    if name == 'scrypt' and len(args) < 3:
+        return ':'.join(['scrypt', *args, *SCRYPT_DEFAULTS[len(args):]])
+    if name == 'pbkdf2' and len(args) < 2:
+        return f"pbkdf2:{args[0] if args else 'sha256'}:{DEFAULT_PBKDF2_ITERATIONS}"
+    return method
+
+
+class HashingPool:
+    # Runs password hashing on a small dedicated thread pool. hashlib's
+    # scrypt and PBKDF2 release the GIL, so the work runs in parallel while
+    # the number of concurrent hashes stays capped at `workers` and the rest
+    # of the process keeps its CPU. Once `queue_size` hashes are waiting,
+    # callers get HashingBusy instead of piling up behind a login storm.
+
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, queue_size=PASSWORD_HASH_QUEUE,
+                 wait=PASSWORD_HASH_WAIT, method=PASSWORD_HASH_METHOD):
+        self.method = _full_method(method)
+        self.wait = wait
+        self.completed = 0
+        self.rejected = 0
+        self._workers = workers
+        self._capacity = workers + queue_size
+        self._slots = threading.BoundedSemaphore(self._capacity)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def configure(self, workers=None, queue_size=None, wait=None, method=None):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if workers is not None:
+            self._workers = workers
+        if queue_size is not None:
+            self._capacity = self._workers + queue_size
+        self._slots = threading.BoundedSemaphore(self._capacity)
+        if wait is not None:
+            self.wait = wait
+        if method is not None:
+            self.method = _full_method(method)
+
+    def _executor_instance(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='hashing')
+        return self._executor
+
+    def run(self, fn, *args):
+        # configure() may swap the semaphore meanwhile; the slot goes back to the one it came from
+        slots = self._slots
+        if not slots.acquire(timeout=self.wait):
+            with self._lock:
+                self.rejected += 1
+            raise HashingBusy('Too many password checks in progress, please try again.')
+        with self._lock:
+            self._pending += 1
+        try:
+            return self._executor_instance().submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self.completed += 1
+            slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': max(self._pending - self._workers, 0),
+                'in_flight': self._pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+
+hashing_pool = HashingPool()
+
+
+def init_app(app):
+    hashing_pool.configure(
+        workers=app.config.get('PASSWORD_HASH_WORKERS', PASSWORD_HASH_WORKERS),
+        queue_size=app.config.get('PASSWORD_HASH_QUEUE', PASSWORD_HASH_QUEUE),
+        wait=app.config.get('PASSWORD_HASH_WAIT', PASSWORD_HASH_WAIT),
+        method=app.config.get('PASSWORD_HASH_METHOD', PASSWORD_HASH_METHOD),
+    )
+
+
+def hash_password(password):
+    return hashing_pool.run(generate_password_hash, password, hashing_pool.method)
+
+
+def verify_password(password_hash, password):
+    if not password_hash:
+        return False
+    return hashing_pool.run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    # Werkzeug hashes look like "<method>$<salt>$<hash>"
+    return password_hash.split('$', 1)[0] != hashing_pool.method
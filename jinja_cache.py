@@ -0,0 +1,54 @@
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache, TemplateError
+
+from applog import log
+
+# Defaults, overridable through app.config (see init_app)
+TEMPLATE_BYTECODE_CACHE = True     # keep compiled templates on disk between processes
+TEMPLATE_CACHE_DIR = None          # None means <instance folder>/jinja_cache
+TEMPLATE_PRECOMPILE = True         # load every template before serving
+
+
+def precompile(app, reload=False):
+    """Load every template into the app's Jinja environment.
+
+    Returns ``[(name, seconds, error)]`` in load order. With the bytecode
+    cache enabled a template only compiles once per change across all
+    processes; later loads unmarshal the code from disk. ``reload`` drops
+    the templates already loaded in this process first.
+    """
+    env = app.jinja_env
+    if reload and env.cache is not None:
+        env.cache.clear()
+    timings = []
+    for name in sorted(env.list_templates()):
+        start = time.perf_counter()
+        try:
+            env.get_template(name)
+            error = None
+        except TemplateError as e:
+            # A broken template fails when it is requested, as it would without precompiling
+            error = str(e)
+        timings.append((name, time.perf_counter() - start, error))
+    return timings
+
+
+def init_app(app):
+    if app.config.get('TEMPLATE_BYTECODE_CACHE', TEMPLATE_BYTECODE_CACHE):
+        directory = app.config.get('TEMPLATE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    if app.config.get('TEMPLATE_PRECOMPILE', TEMPLATE_PRECOMPILE):
+        timings = precompile(app)
+        log.info('Templates precompiled', extra={'fields': {
+            'templates': len(timings),
+            'seconds': round(sum(seconds for _, seconds, _ in timings), 4),
+            'slowest': [(name, round(seconds * 1000, 2)) for name, seconds, _ in
+                        sorted(timings, key=lambda timing: timing[1], reverse=True)[:5]],
+        }})
+        for name, _, error in timings:
+            if error:
+                log.error('Template failed to compile', extra={'fields': {'template': name, 'error': error}})
@@ -0,0 +1,267 @@
+import atexit
+import json
+import random
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from models import db, Job
+from database import submit_write
+from applog import log
+
+# Defaults, overridable through app.config (see init_app)
+JOB_WORKERS = True                 # run worker threads in the web process (False: only `flask run-jobs`)
+JOB_QUEUES = {                     # queue -> worker threads, which is its concurrency limit per process
+    'license': 1,                  # one sweep at a time (licenses.py)
+}
+JOB_MAX_ATTEMPTS = 5
+JOB_VISIBILITY_TIMEOUT = 60        # seconds a claimed job is hidden from other workers
+JOB_BACKOFF_BASE = 2.0             # seconds before the first retry, doubling with each attempt
+JOB_BACKOFF_MAX = 3600.0
+JOB_POLL_INTERVAL = 1.0            # seconds an idle worker sleeps unless woken by a commit
+
+
+class Task:
+    __slots__ = ('name', 'fn', 'queue', 'max_attempts')
+
+    def __init__(self, name, fn, queue, max_attempts):
+        self.name = name
+        self.fn = fn
+        self.queue = queue
+        self.max_attempts = max_attempts
+
+
+_tasks = {}
+
+
+def task(name, queue, max_attempts=JOB_MAX_ATTEMPTS):
+    """Register ``fn(**payload)`` as the handler of jobs called ``name``.
+
+    Only queues listed in JOB_QUEUES get workers. Jobs run at least once: a
+    worker that dies mid-job leaves it to be claimed again after the
+    visibility timeout, so handlers must be safe to repeat. A job whose
+    workers died on every one of its ``max_attempts`` fails.
+    """
+    def decorator(fn):
+        _tasks[name] = Task(name, fn, queue, max_attempts)
+        return fn
+    return decorator
+
+
+def enqueue(name, payload=None, idempotency_key=None, delay=0):
+    """Add a job to the current transaction and return its id.
+
+    Workers see it once the transaction commits, so a job is never run for
+    a write that rolled back. A second enqueue with the same
+    ``idempotency_key`` adds nothing and returns the first job's id.
+    """
+    job_task = _tasks[name]
+    now = datetime.now()
+    statement = insert(Job).values(
+        queue=job_task.queue,
+        name=name,
+        payload=json.dumps(payload or {}),
+        status='queued',
+        attempts=0,
+        max_attempts=job_task.max_attempts,
+        visible_at=now + timedelta(seconds=delay),
+        idempotency_key=idempotency_key,
+        created_at=now,
+    )
+    if idempotency_key is not None:
+        statement = statement.on_conflict_do_nothing(index_elements=['idempotency_key'])
+    job_id = db.session.execute(statement.returning(Job.id)).scalar()
+    if job_id is None:
+        return db.session.execute(select(Job.id).where(Job.idempotency_key == idempotency_key)).scalar_one()
+    db.session.info.setdefault('enqueued_queues', set()).add(job_task.queue)
+    return job_id
+
+
+def _claim(queue, visibility_timeout):
+    # Returns ``(abandoned, claimed)``. The claim is one statement, so two
+    # workers (threads or processes) never claim the same job. Expired
+    # running jobs are visible again and get claimed too, unless their last
+    # attempt was used: those are failed first, or a job that kills its
+    # worker would be claimed forever.
+    now = datetime.now()
+    abandoned = db.session.execute(
+        update(Job).where(
+            Job.queue == queue,
+            Job.status == 'running',
+            Job.visible_at <= now,
+            Job.attempts >= Job.max_attempts,
+        ).values(status='failed', finished_at=now, last_error='Worker stopped during the last attempt')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    candidate = select(Job.id).where(
+        Job.queue == queue,
+        Job.status.in_(('queued', 'running')),
+        Job.visible_at <= now,
+    ).order_by(Job.visible_at).limit(1).scalar_subquery()
+    row = db.session.execute(
+        update(Job).where(Job.id == candidate).values(
+            status='running',
+            attempts=Job.attempts + 1,
+            visible_at=now + timedelta(seconds=visibility_timeout),
+        ).returning(Job.id, Job.name, Job.payload, Job.attempts, Job.max_attempts)
+        .execution_options(synchronize_session=False)
+    ).first()
+    return abandoned, tuple(row) if row is not None else None
+
+
+def _finish(job_id, attempt, error=None, retry_at=None):
+    # Guarded by the attempt, so a worker whose claim expired cannot
+    # overwrite the outcome of a later attempt
+    if error is None:
+        values = {'status': 'done', 'finished_at': datetime.now(), 'last_error': None}
+    elif retry_at is not None:
+        values = {'status': 'queued', 'visible_at': retry_at, 'last_error': error}
+    else:
+        values = {'status': 'failed', 'finished_at': datetime.now(), 'last_error': error}
+    db.session.execute(update(Job).where(Job.id == job_id, Job.attempts == attempt).values(**values)
+                       .execution_options(synchronize_session=False))
+
+
+class JobRunner:
+    # Worker threads for every queue of one app. A worker claims the next
+    # visible job of its queue, runs its task outside any transaction and
+    # records the outcome; all three writes go through the write queue. A
+    # failed job is retried after an exponentially growing, jittered delay
+    # until it has used max_attempts. Idle workers sleep for poll_interval
+    # unless a commit that enqueued work on their queue wakes them.
+
+    def __init__(self, app):
+        self.app = app
+        self.queues = dict(app.config.get('JOB_QUEUES', JOB_QUEUES))
+        self.visibility_timeout = app.config.get('JOB_VISIBILITY_TIMEOUT', JOB_VISIBILITY_TIMEOUT)
+        self.backoff_base = app.config.get('JOB_BACKOFF_BASE', JOB_BACKOFF_BASE)
+        self.backoff_max = app.config.get('JOB_BACKOFF_MAX', JOB_BACKOFF_MAX)
+        self.poll_interval = app.config.get('JOB_POLL_INTERVAL', JOB_POLL_INTERVAL)
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+        self._wake = {queue: threading.Event() for queue in self.queues}
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self, queues=None):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for queue in queues or self.queues:
+                for i in range(self.queues.get(queue, 1)):
+                    thread = threading.Thread(target=self._work, args=(queue,), name=f'jobs-{queue}-{i}', daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for wake in self._wake.values():
+            wake.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def wait(self, timeout=None):
+        # True once stop() has been called
+        return self._stop.wait(timeout)
+
+    def wake(self, queues):
+        for queue in queues:
+            wake = self._wake.get(queue)
+            if wake is not None:
+                wake.set()
+
+    def backoff(self, attempt):
+        delay = min(self.backoff_base * 2 ** (attempt - 1), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _work(self, queue):
+        wake = self._wake.setdefault(queue, threading.Event())
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    ran = self.run_one(queue)
+            except Exception:
+                # e.g. the job table is not there yet; try again later
+                log.exception('Job worker error', extra={'fields': {'queue': queue}})
+                ran = False
+            if not ran and wake.wait(self.poll_interval):
+                wake.clear()
+
+    def run_one(self, queue):
+        """Claim and run one job of ``queue``; False when none was due."""
+        abandoned, claimed = submit_write(_claim, queue, self.visibility_timeout)
+        if abandoned:
+            with self._lock:
+                self.failed += abandoned
+            log.warning('Jobs failed after their workers stopped', extra={'fields': {'queue': queue,
+                                                                                      'jobs': abandoned}})
+        if claimed is None:
+            return False
+        job_id, name, payload, attempt, max_attempts = claimed
+        try:
+            job_task = _tasks.get(name)
+            if job_task is None:
+                raise LookupError(f'No task registered as {name!r}')
+            job_task.fn(**json.loads(payload))
+        except Exception as e:
+            retry_at = None
+            if attempt < max_attempts:
+                retry_at = datetime.now() + timedelta(seconds=self.backoff(attempt))
+            submit_write(_finish, job_id, attempt, repr(e), retry_at)
+            with self._lock:
+                if retry_at is None:
+                    self.failed += 1
+                else:
+                    self.retried += 1
+            log.warning('Job failed', extra={'fields': {'job_id': job_id, 'task': name, 'attempt': attempt,
+                                                        'retry_at': retry_at, 'error': repr(e)}})
+        else:
+            submit_write(_finish, job_id, attempt)
+            with self._lock:
+                self.done += 1
+        finally:
+            # Handlers load rows on this thread's session; start the next job clean
+            db.session.remove()
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {'workers': len(self._threads), 'done': self.done, 'retried': self.retried, 'failed': self.failed}
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_workers(session):
+    queues = session.info.pop('enqueued_queues', None)
+    if queues and has_app_context():
+        runner = current_app.extensions.get('jobs')
+        if runner is not None:
+            runner.wake(queues)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_enqueued(session, previous_transaction):
+    session.info.pop('enqueued_queues', None)
+
+
+def stats():
+    runner = current_app.extensions.get('jobs') if has_app_context() else None
+    return runner.stats() if runner is not None else {}
+
+
+def init_app(app):
+    runner = JobRunner(app)
+    app.extensions['jobs'] = runner
+    if app.config.get('JOB_WORKERS', JOB_WORKERS):
+        # Workers start with the first request rather than in create_app, so
+        # CLI commands such as `flask db upgrade` do not start any
+        app.before_request(runner.start)
+    atexit.register(runner.stop)
+    return runner
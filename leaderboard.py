@@ -0,0 +1,168 @@
+import bisect
+import heapq
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Caregiver
+from geo import place_name
+from ratings import on_rating_change, RATING_PRIOR_MEAN
+from services import mask_to_services
+
+# Caregivers kept per (service, region) bucket, and shown per page
+LEADERBOARD_SIZE = 100
+LEADERBOARD_PER_PAGE = 20
+
+
+class Leaderboard:
+    # The best rated caregivers for every service, both per region (the
+    # gazetteer place their location names) and across all regions (region
+    # None). Each bucket is a list of (-rating_score, caregiver_id) kept
+    # sorted and cut to `size`, so a browse page is a slice. Reviews and
+    # caregiver edits adjust the affected buckets in place; a bucket is only
+    # rebuilt from the full member list when a caregiver drops out of it and
+    # someone below the cut has to move up.
+
+    def __init__(self, size=LEADERBOARD_SIZE):
+        self.size = size
+        self.loaded = False
+        self._members = {}   # caregiver_id -> (services_mask, region, score)
+        self._buckets = {}   # (service, region) -> sorted [(-score, caregiver_id)]
+        self._counts = {}    # (service, region) -> caregivers in the bucket, listed or not
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _keys(services_mask, region):
+        for service in mask_to_services(services_mask):
+            yield service, None
+            if region:
+                yield service, region
+
+    def load(self):
+        rows = db.session.query(Caregiver.id, Caregiver.services_mask, Caregiver.location, Caregiver.rating_score) \
+            .execution_options(bulk_load=True)
+        members = {caregiver_id: (services_mask or 0, place_name(location), score)
+                   for caregiver_id, services_mask, location, score in rows}
+        with self._lock:
+            self._members = members
+            self._buckets = {}
+            self._counts = {}
+            self._rebuild()
+            self.loaded = True
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def _rebuild(self, keys=None):
+        entries = {}
+        for caregiver_id, (services_mask, region, score) in self._members.items():
+            for key in self._keys(services_mask, region):
+                if keys is None or key in keys:
+                    entries.setdefault(key, []).append((-score, caregiver_id))
+        for key in (entries if keys is None else keys):
+            bucket = entries.get(key, [])
+            self._counts[key] = len(bucket)
+            self._buckets[key] = heapq.nsmallest(self.size, bucket)
+
+    def _set(self, caregiver_id, member):
+        # Replace a caregiver's entry (member None removes it); caller holds the lock
+        old = self._members.pop(caregiver_id, None)
+        short = set()
+        if old is not None:
+            entry = (-old[2], caregiver_id)
+            for key in self._keys(old[0], old[1]):
+                self._counts[key] -= 1
+                bucket = self._buckets[key]
+                i = bisect.bisect_left(bucket, entry)
+                if i < len(bucket) and bucket[i] == entry:
+                    del bucket[i]
+                    short.add(key)
+        if member is not None:
+            self._members[caregiver_id] = member
+            entry = (-member[2], caregiver_id)
+            for key in self._keys(member[0], member[1]):
+                self._counts[key] = self._counts.get(key, 0) + 1
+                bucket = self._buckets.setdefault(key, [])
+                if key in short:
+                    # The slot this caregiver left may belong to someone below
+                    # the cut; only take it back when it is certainly ours
+                    if (bucket and entry < bucket[-1]) or self._counts[key] == len(bucket) + 1:
+                        bisect.insort(bucket, entry)
+                elif len(bucket) < self.size or entry < bucket[-1]:
+                    bisect.insort(bucket, entry)
+                    del bucket[self.size:]
+        # Someone below the cut moves up into a bucket that lost an entry
+        self._rebuild({key for key in short if len(self._buckets[key]) < min(self.size, self._counts[key])})
+
+    def set_caregiver(self, caregiver_id, services_mask, region):
+        with self._lock:
+            old = self._members.get(caregiver_id)
+            score = old[2] if old is not None else RATING_PRIOR_MEAN
+            self._set(caregiver_id, (services_mask or 0, region, score))
+
+    def remove_caregiver(self, caregiver_id):
+        with self._lock:
+            self._set(caregiver_id, None)
+
+    def set_score(self, caregiver_id, score):
+        with self._lock:
+            old = self._members.get(caregiver_id)
+            if old is not None:
+                self._set(caregiver_id, (old[0], old[1], score))
+
+    def page(self, service, region=None, page=1, per_page=LEADERBOARD_PER_PAGE):
+        """Return ``(caregiver_ids, total)`` for one page of a bucket, best first."""
+        self._ensure_loaded()
+        start = (max(int(page), 1) - 1) * per_page
+        with self._lock:
+            bucket = self._buckets.get((service, region or None), [])
+            return [caregiver_id for _, caregiver_id in bucket[start:start + per_page]], len(bucket)
+
+    def regions(self):
+        self._ensure_loaded()
+        with self._lock:
+            return sorted({region for _, region in self._buckets if region})
+
+
+leaderboard = Leaderboard()
+
+# New reviews move caregivers up or down without reloading
+on_rating_change(leaderboard.set_score)
+
+
+# Registrations and edits reach the leaderboard once they commit; scores
+# only come from load() and on_rating_change, so a stale rating_score on an
+# edited Caregiver object cannot overwrite a newer one
+@event.listens_for(Caregiver, 'after_insert')
+@event.listens_for(Caregiver, 'after_update')
+def _caregiver_saved(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('leaderboard_changes', []).append(
+            (target.id, target.services_mask or 0, place_name(target.location)))
+
+
+@event.listens_for(Caregiver, 'after_delete')
+def _caregiver_deleted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('leaderboard_changes', []).append((target.id, None, None))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_leaderboard_changes(session):
+    changes = session.info.pop('leaderboard_changes', None)
+    if not changes or not leaderboard.loaded:
+        return
+    for caregiver_id, services_mask, region in changes:
+        if services_mask is None:
+            leaderboard.remove_caregiver(caregiver_id)
+        else:
+            leaderboard.set_caregiver(caregiver_id, services_mask, region)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_leaderboard_changes(session, previous_transaction):
+    session.info.pop('leaderboard_changes', None)
@@ -0,0 +1,299 @@
+import csv
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+from flask import current_app, has_app_context
+from sqlalchemy import false, select
+
+from models import db, Caregiver
+from database import submit_write
+from jobs import task, enqueue
+from applog import log
+
+# Local stand-in for the licensing board's register: one
+# "license_number,holder,status,expires_on" row per license
+LICENSE_REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'license_registry.csv')
+
+# Defaults, overridable through app.config (see init_app)
+LICENSE_REGISTRY = None            # object with lookup(license_numbers); None means FileRegistry(LICENSE_REGISTRY_PATH)
+LICENSE_BATCH_SIZE = 500           # license numbers per registry lookup
+LICENSE_BATCH_WINDOW = 2.0         # seconds registrations are gathered into one verification job
+LICENSE_CACHE_SIZE = 100000
+LICENSE_CACHE_TTL = 86400          # seconds a positive verdict is reused
+LICENSE_NEGATIVE_TTL = 900         # seconds a negative verdict is reused
+LICENSE_BREAKER_THRESHOLD = 5      # consecutive failed lookups that open the circuit breaker
+LICENSE_BREAKER_RESET = 60         # seconds the breaker stays open before a trial lookup
+
+NO_LICENSE = (False, 'No license number given')
+NOT_FOUND = (False, 'License not found in registry')
+
+
+class RegistryUnavailable(Exception):
+    pass
+
+
+def normalize_license_number(license_number):
+    return ''.join((license_number or '').split()).upper()
+
+
+class FileRegistry:
+    # Answers lookups from a CSV file, reloaded whenever it changes on disk.
+    # `latency` adds a delay per lookup to stand in for a remote registry.
+
+    def __init__(self, path=LICENSE_REGISTRY_PATH, latency=0.0):
+        self.path = path
+        self.latency = latency
+        self._licenses = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        mtime = os.path.getmtime(self.path)
+        with self._lock:
+            if self._licenses is None or mtime != self._mtime:
+                licenses = {}
+                with open(self.path, newline='', encoding='utf-8') as f:
+                    for row in csv.DictReader(f):
+                        licenses[normalize_license_number(row['license_number'])] = (
+                            row['status'].strip().lower(), date.fromisoformat(row['expires_on']))
+                self._licenses = licenses
+                self._mtime = mtime
+            return self._licenses
+
+    def lookup(self, license_numbers):
+        """Return ``{license_number: (verified, error)}`` for the numbers on the register."""
+        if self.latency:
+            time.sleep(self.latency)
+        licenses = self._load()
+        today = date.today()
+        verdicts = {}
+        for number in license_numbers:
+            entry = licenses.get(number)
+            if entry is None:
+                continue
+            status, expires_on = entry
+            if status != 'active':
+                verdicts[number] = (False, f'License is {status}')
+            elif expires_on < today:
+                verdicts[number] = (False, f'License expired on {expires_on.isoformat()}')
+            else:
+                verdicts[number] = (True, None)
+        return verdicts
+
+
+class VerdictCache:
+    # Bounded LRU of registry verdicts by normalized license number.
+    # Positive verdicts are kept for `ttl` seconds and negative ones for the
+    # shorter `negative_ttl`, so a renewed or newly issued license is picked
+    # up soon after the registry has it.
+
+    def __init__(self, max_size=LICENSE_CACHE_SIZE, ttl=LICENSE_CACHE_TTL, negative_ttl=LICENSE_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, license_numbers):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for number in license_numbers:
+                entry = self._entries.get(number)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(number)
+                    found[number] = entry[1]
+                elif entry is not None:
+                    del self._entries[number]
+            self.hits += len(found)
+            self.misses += len(license_numbers) - len(found)
+        return found
+
+    def put_many(self, verdicts):
+        now = time.monotonic()
+        with self._lock:
+            for number, verdict in verdicts.items():
+                self._entries[number] = (now + (self.ttl if verdict[0] else self.negative_ttl), verdict)
+                self._entries.move_to_end(number)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class CircuitBreaker:
+    # Closed, calls go through and consecutive failures are counted. After
+    # `threshold` of them the breaker opens and calls fail fast with
+    # RegistryUnavailable for `reset_after` seconds. Then a single trial call
+    # is let through (half open); success closes the breaker, failure opens
+    # it again.
+
+    def __init__(self, threshold=LICENSE_BREAKER_THRESHOLD, reset_after=LICENSE_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def call(self, fn, *args):
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_after:
+                self.state = 'half_open'
+            elif self.state != 'closed':
+                self.rejected += 1
+                raise RegistryUnavailable('License registry unavailable; lookups paused')
+        try:
+            result = fn(*args)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+                if self.state == 'half_open' or self.failures >= self.threshold:
+                    self.state = 'open'
+                    self._opened_at = time.monotonic()
+                    self.opened += 1
+            raise
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures, 'opened': self.opened, 'rejected': self.rejected}
+
+
+class LicenseVerifier:
+    # Verdicts for many license numbers at once: cached ones are answered
+    # from the cache and the rest go to the registry in lookups of up to
+    # `batch_size` numbers, each through the circuit breaker.
+
+    def __init__(self, registry, batch_size=LICENSE_BATCH_SIZE, cache=None, breaker=None):
+        self.registry = registry
+        self.batch_size = batch_size
+        self.cache = cache or VerdictCache()
+        self.breaker = breaker or CircuitBreaker()
+        self.lookups = 0
+        self._lock = threading.Lock()
+
+    def verify(self, license_numbers):
+        """Return ``{license_number: (verified, error)}`` for every number given.
+
+        Raises RegistryUnavailable while the breaker is open, or whatever the
+        registry raised; verdicts of lookups that completed are cached.
+        """
+        keys = {number: normalize_license_number(number) for number in set(license_numbers)}
+        wanted = {key for key in keys.values() if key}
+        found = self.cache.get_many(wanted)
+        missing = sorted(wanted - found.keys())
+        for i in range(0, len(missing), self.batch_size):
+            chunk = missing[i:i + self.batch_size]
+            answers = self.breaker.call(self.registry.lookup, chunk)
+            with self._lock:
+                self.lookups += 1
+            verdicts = {number: answers.get(number, NOT_FOUND) for number in chunk}
+            self.cache.put_many(verdicts)
+            found.update(verdicts)
+        return {number: found[key] if key else NO_LICENSE for number, key in keys.items()}
+
+    def stats(self):
+        with self._lock:
+            lookups = self.lookups
+        return {'lookups': lookups, 'cache': self.cache.stats(), 'breaker': self.breaker.stats()}
+
+
+def schedule_verification():
+    """Enqueue, in the current transaction, a sweep of the pending licenses.
+
+    Registrations within the same LICENSE_BATCH_WINDOW share one job, which
+    runs once the window has passed, so a burst of sign-ups is verified in a
+    few registry lookups.
+    """
+    window = current_app.config.get('LICENSE_BATCH_WINDOW', LICENSE_BATCH_WINDOW)
+    key = f'verify_licenses:{int(time.time() // window)}' if window > 0 else None
+    return enqueue('verify_licenses', idempotency_key=key, delay=window)
+
+
+def _pending_licenses(after_id, limit):
+    # Literal false() rather than a bound False, so the condition matches the
+    # WHERE of the partial index ix_caregiver_license_pending
+    return db.session.execute(
+        select(Caregiver.id, Caregiver.license_number).where(
+            Caregiver.license_verified == false(),
+            Caregiver.verification_error.is_(None),
+            Caregiver.license_number.isnot(None),
+            Caregiver.id > after_id,
+        ).order_by(Caregiver.id).limit(limit)
+    ).all()
+
+
+def _record_verdicts(verdicts):
+    caregivers = {c.id: c for c in Caregiver.query.filter(Caregiver.id.in_([v[0] for v in verdicts]))}
+    for caregiver_id, license_number, verified, error in verdicts:
+        caregiver = caregivers.get(caregiver_id)
+        # Skip caregivers whose license number changed after it was read
+        if caregiver is not None and caregiver.license_number == license_number:
+            caregiver.license_verified = verified
+            caregiver.verification_error = error
+
+
+def verify_pending():
+    """Give every caregiver license awaiting a verdict one; returns ``(caregivers, lookups)``."""
+    verifier = current_app.extensions['licenses']
+    lookups = verifier.lookups
+    checked = 0
+    last_id = 0
+    while True:
+        rows = _pending_licenses(last_id, verifier.batch_size)
+        if not rows:
+            break
+        verdicts = verifier.verify([number for _, number in rows])
+        submit_write(_record_verdicts, [(caregiver_id, number, *verdicts[number]) for caregiver_id, number in rows])
+        checked += len(rows)
+        last_id = rows[-1][0]
+    return checked, verifier.lookups - lookups
+
+
+# Enough attempts for the job's backoff to outlast an open breaker; licenses
+# still pending after that are picked up by the next registration's sweep
+@task('verify_licenses', queue='license', max_attempts=10)
+def verify_licenses_job():
+    checked, lookups = verify_pending()
+    log.info('Licenses verified', extra={'fields': {'caregivers': checked, 'lookups': lookups}})
+
+
+def stats():
+    verifier = current_app.extensions.get('licenses') if has_app_context() else None
+    return verifier.stats() if verifier is not None else {}
+
+
+def init_app(app):
+    registry = app.config.get('LICENSE_REGISTRY', LICENSE_REGISTRY) or FileRegistry(LICENSE_REGISTRY_PATH)
+    verifier = LicenseVerifier(
+        registry,
+        batch_size=app.config.get('LICENSE_BATCH_SIZE', LICENSE_BATCH_SIZE),
+        cache=VerdictCache(
+            max_size=app.config.get('LICENSE_CACHE_SIZE', LICENSE_CACHE_SIZE),
+            ttl=app.config.get('LICENSE_CACHE_TTL', LICENSE_CACHE_TTL),
+            negative_ttl=app.config.get('LICENSE_NEGATIVE_TTL', LICENSE_NEGATIVE_TTL),
+        ),
+        breaker=CircuitBreaker(
+            threshold=app.config.get('LICENSE_BREAKER_THRESHOLD', LICENSE_BREAKER_THRESHOLD),
+            reset_after=app.config.get('LICENSE_BREAKER_RESET', LICENSE_BREAKER_RESET),
+        ),
+    )
+    app.extensions['licenses'] = verifier
+    return verifier
@@ -0,0 +1,220 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = 'careconnect'
+
+
+class EndpointStats:
+    __slots__ = ('requests', 'latency_sum', 'buckets', 'queries', 'db_seconds', 'rows')
+
+    def __init__(self):
+        self.requests = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+
+
+class _RequestState:
+    __slots__ = ('start', 'queries', 'db_seconds', 'rows', 'query_start')
+
+    def __init__(self, start):
+        self.start = start
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.query_start = 0.0
+
+
+# Every thread records into its own shard, so the request path never takes a
+# lock; /metrics adds the shards up when it is scraped. Shards of threads
+# that have exited are folded into _retired then.
+_local = threading.local()
+_shards = []
+_retired = {}
+_shards_lock = threading.Lock()
+_gauges = {}
+_listening = False
+
+
+def _shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = {}
+        with _shards_lock:
+            _shards.append((threading.current_thread(), shard))
+    return shard
+
+
+def add_gauges(name, stats_fn, help_text=''):
+    """Expose the values of ``stats_fn()`` (a dict) as ``careconnect_<name>_<key>`` gauges."""
+    _gauges[name] = (stats_fn, help_text)
+
+
+def _before_request():
+    _local.request = _RequestState(time.perf_counter())
+
+
+def request_state():
+    """The calling thread's in-flight request counters, or None outside a request."""
+    return getattr(_local, 'request', None)
+
+
+@contextmanager
+def recording_into(state):
+    # SQL run inside the block counts toward `state`, the request_state()
+    # of a request waiting on this thread, e.g. for a write unit
+    previous = getattr(_local, 'request', None)
+    _local.request = state
+    try:
+        yield
+    finally:
+        _local.request = previous
+
+
+def _teardown_request(exc):
+    state = getattr(_local, 'request', None)
+    if state is None:
+        return
+    _local.request = None
+    elapsed = time.perf_counter() - state.start
+
+    endpoint = request.endpoint or 'unmatched'
+    shard = _shard()
+    stats = shard.get(endpoint)
+    if stats is None:
+        stats = shard[endpoint] = EndpointStats()
+    stats.requests += 1
+    stats.latency_sum += elapsed
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if elapsed <= bound:
+            stats.buckets[i] += 1
+            break
+    else:
+        stats.buckets[-1] += 1
+    stats.queries += state.queries
+    stats.db_seconds += state.db_seconds
+    stats.rows += state.rows
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = getattr(_local, 'request', None)
+    if state is not None:
+        state.query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = getattr(_local, 'request', None)
+    if state is not None:
+        state.queries += 1
+        state.db_seconds += time.perf_counter() - state.query_start
+        # rowcount covers writes; rows read are counted as ORM objects load
+        if cursor.rowcount > 0:
+            state.rows += cursor.rowcount
+
+
+def _instance_loaded(target, context):
+    state = getattr(_local, 'request', None)
+    if state is not None:
+        state.rows += 1
+
+
+def _merge(totals, shard):
+    for endpoint, stats in list(shard.items()):
+        total = totals.get(endpoint)
+        if total is None:
+            total = totals[endpoint] = EndpointStats()
+        total.requests += stats.requests
+        total.latency_sum += stats.latency_sum
+        total.buckets = [a + b for a, b in zip(total.buckets, stats.buckets)]
+        total.queries += stats.queries
+        total.db_seconds += stats.db_seconds
+        total.rows += stats.rows
+
+
+def _collect():
+    with _shards_lock:
+        live = []
+        for thread, shard in _shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                _merge(_retired, shard)
+        _shards[:] = live
+        totals = {}
+        _merge(totals, _retired)
+    for _, shard in live:
+        _merge(totals, shard)
+    return totals
+
+
+def _label(endpoint):
+    return endpoint.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def render_metrics():
+    """Current metrics in the Prometheus text exposition format."""
+    totals = _collect()
+    lines = [
+        f'# HELP {PREFIX}_request_duration_seconds Request latency by endpoint.',
+        f'# TYPE {PREFIX}_request_duration_seconds histogram',
+    ]
+    for endpoint, stats in sorted(totals.items()):
+        label = _label(endpoint)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), stats.buckets):
+            cumulative += count
+            lines.append(f'{PREFIX}_request_duration_seconds_bucket{{endpoint="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'{PREFIX}_request_duration_seconds_sum{{endpoint="{label}"}} {stats.latency_sum:.6f}')
+        lines.append(f'{PREFIX}_request_duration_seconds_count{{endpoint="{label}"}} {stats.requests}')
+
+    for name, attr, help_text in (
+        ('db_queries_total', 'queries', 'SQL statements executed by endpoint.'),
+        ('db_seconds_total', 'db_seconds', 'Time spent executing SQL by endpoint.'),
+        ('db_rows_total', 'rows', 'Rows written plus ORM objects loaded by endpoint.'),
+    ):
+        lines.append(f'# HELP {PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {PREFIX}_{name} counter')
+        for endpoint, stats in sorted(totals.items()):
+            value = getattr(stats, attr)
+            value = f'{value:.6f}' if isinstance(value, float) else value
+            lines.append(f'{PREFIX}_{name}{{endpoint="{_label(endpoint)}"}} {value}')
+
+    for name, (stats_fn, help_text) in list(_gauges.items()):
+        for key, value in stats_fn().items():
+            if help_text:
+                lines.append(f'# HELP {PREFIX}_{name}_{key} {help_text}')
+            lines.append(f'# TYPE {PREFIX}_{name}_{key} gauge')
+            lines.append(f'{PREFIX}_{name}_{key} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    # With METRICS_ENABLED = False nothing is registered at all
+    global _listening
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    if not _listening:
+        # Process-wide; only requests of an app with metrics enabled record anything
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(db.Model, 'load', _instance_loaded, propagate=True)
+        _listening = True
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
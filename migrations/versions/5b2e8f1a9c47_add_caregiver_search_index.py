@@ -0,0 +1,33 @@
+"""Add full-text search index for caregivers
+
+Revision ID: 5b2e8f1a9c47
+Revises: c331e7053c03
+Create Date: 2026-10-18 09:12:40.118273
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2e8f1a9c47'
+down_revision = 'c331e7053c03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # FTS5 virtual table over the searchable caregiver columns; rowid is the caregiver id
+    op.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS caregiver_fts USING fts5("
+        "qualification, services_offered, experience, location, "
+        "tokenize = 'porter unicode61')"
+    )
+    op.execute(
+        "INSERT INTO caregiver_fts(rowid, qualification, services_offered, experience, location) "
+        "SELECT id, qualification, services_offered, experience, location FROM caregiver"
+    )
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS caregiver_fts")
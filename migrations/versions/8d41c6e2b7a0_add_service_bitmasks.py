@@ -0,0 +1,84 @@
+"""Add service bitmasks and caregiver_service table
+
+Revision ID: 8d41c6e2b7a0
+Revises: 5b2e8f1a9c47
+Create Date: 2026-10-18 10:03:17.542906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41c6e2b7a0'
+down_revision = '5b2e8f1a9c47'
+branch_labels = None
+depends_on = None
+
+# Snapshot of CaregiverRegistrationForm.SERVICES_CHOICES at the time of this
+# revision; the position of each entry is its bit
+SERVICES = [
+    'Post surgery',
+    'Bed-ridden care',
+    'Terminally ill care',
+    'General convalescents',
+    'Palliative care',
+    'Bathing and personal hygiene',
+    'Feeding',
+    'Ambulation',
+    'Administering prescribed medication',
+    'Overnight Elderly Care',
+    'Maternal and child care',
+]
+
+
+def upgrade():
+    with op.batch_alter_table('caregiver', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('services_mask', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.create_index(batch_op.f('ix_caregiver_services_mask'), ['services_mask'], unique=False)
+
+    with op.batch_alter_table('patient', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('care_needed_mask', sa.Integer(), nullable=False, server_default='0'))
+
+    op.create_table('caregiver_service',
+    sa.Column('caregiver_id', sa.Integer(), nullable=False),
+    sa.Column('service_bit', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['caregiver_id'], ['caregiver.id'], ),
+    sa.PrimaryKeyConstraint('caregiver_id', 'service_bit')
+    )
+    with op.batch_alter_table('caregiver_service', schema=None) as batch_op:
+        batch_op.create_index('ix_caregiver_service_bit_caregiver', ['service_bit', 'caregiver_id'], unique=False)
+
+    # Backfill from the existing comma-joined strings
+    bind = op.get_bind()
+    caregivers = bind.execute(sa.text("SELECT id, services_offered FROM caregiver")).fetchall()
+    for caregiver_id, services_offered in caregivers:
+        offered = [service.strip() for service in (services_offered or '').split(',')]
+        bits = [bit for bit, service in enumerate(SERVICES) if service in offered]
+        mask = sum(1 << bit for bit in bits)
+        bind.execute(sa.text("UPDATE caregiver SET services_mask = :mask WHERE id = :id"),
+                     {'mask': mask, 'id': caregiver_id})
+        for bit in bits:
+            bind.execute(sa.text("INSERT INTO caregiver_service (caregiver_id, service_bit) VALUES (:id, :bit)"),
+                         {'id': caregiver_id, 'bit': bit})
+
+    patients = bind.execute(sa.text("SELECT id, care_needed FROM patient")).fetchall()
+    for patient_id, care_needed in patients:
+        text = (care_needed or '').lower()
+        mask = sum(1 << bit for bit, service in enumerate(SERVICES) if service.lower() in text)
+        bind.execute(sa.text("UPDATE patient SET care_needed_mask = :mask WHERE id = :id"),
+                     {'mask': mask, 'id': patient_id})
+
+
+def downgrade():
+    with op.batch_alter_table('caregiver_service', schema=None) as batch_op:
+        batch_op.drop_index('ix_caregiver_service_bit_caregiver')
+
+    op.drop_table('caregiver_service')
+
+    with op.batch_alter_table('patient', schema=None) as batch_op:
+        batch_op.drop_column('care_needed_mask')
+
+    with op.batch_alter_table('caregiver', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_caregiver_services_mask'))
+        batch_op.drop_column('services_mask')
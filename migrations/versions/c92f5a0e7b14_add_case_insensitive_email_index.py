@@ -0,0 +1,26 @@
+"""Normalize user emails and add a case-insensitive unique index
+
+Revision ID: c92f5a0e7b14
+Revises: b84d27e19f05
+Create Date: 2026-10-18 16:48:21.603557
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c92f5a0e7b14'
+down_revision = 'b84d27e19f05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fails if two accounts differ only by case; merge those by hand first
+    op.execute("UPDATE user SET email = lower(trim(email)) WHERE email IS NOT NULL")
+    op.create_index('ix_user_email_lower', 'user', [sa.text('lower(email)')], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_user_email_lower', table_name='user')
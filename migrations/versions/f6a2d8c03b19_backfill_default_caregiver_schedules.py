@@ -0,0 +1,40 @@
+"""Give caregivers without a weekly schedule the default one
+
+Revision ID: f6a2d8c03b19
+Revises: e2b7c41f9a06
+Create Date: 2026-10-18 17:20:36.915402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6a2d8c03b19'
+down_revision = 'e2b7c41f9a06'
+branch_labels = None
+depends_on = None
+
+# availability.DEFAULT_WORKING_HOURS as stored: 08:00-18:00 (slots 32 to 71)
+# every day, seven 12-byte big-endian day bitmaps, Monday first
+DEFAULT_WEEKLY_SLOTS = (((1 << 40) - 1) << 32).to_bytes(12, 'big') * 7
+
+
+def upgrade():
+    # Without a template a caregiver is never free in /free_caregivers
+    op.get_bind().execute(
+        sa.text(
+            "INSERT INTO caregiver_schedule (caregiver_id, weekly_slots) "
+            "SELECT id, :slots FROM caregiver "
+            "WHERE id NOT IN (SELECT caregiver_id FROM caregiver_schedule)"
+        ),
+        {'slots': DEFAULT_WEEKLY_SLOTS},
+    )
+
+
+def downgrade():
+    # Templates still at the default; ones a caregiver changed are kept
+    op.get_bind().execute(
+        sa.text("DELETE FROM caregiver_schedule WHERE weekly_slots = :slots"),
+        {'slots': DEFAULT_WEEKLY_SLOTS},
+    )
@@ -1,12 +1,17 @@
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash
+from hashing import hash_password
 from datetime import datetime
 
 
 db = SQLAlchemy()
 
+def _age(date_of_birth):
+    # Whole years, one fewer until this year's birthday has passed
+    today = datetime.today().date()
+    return today.year - date_of_birth.year - ((today.month, today.day) < (date_of_birth.month, date_of_birth.day))
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100))
@@ -17,6 +22,18 @@ class User(db.Model, UserMixin):
     date_of_birth = db.Column(db.Date)
     gender = db.Column(db.String(10))
     location = db.Column(db.String(255))
+
+    # Emails are stored normalized; the expression index keeps them unique regardless of case
+    __table_args__ = (db.Index('ix_user_email_lower', func.lower(email), unique=True),)
+
+    @staticmethod
+    def normalize_email(email):
+        return (email or '').strip().lower()
+
+    @classmethod
+    def find_by_email(cls, email):
+        # Matches the expression of ix_user_email_lower so the lookup is an index probe
+        return cls.query.filter(func.lower(cls.email) == cls.normalize_email(email)).first()
     
     # Define the relationship with Patient and Caregiver models
     def create_patient_profile(self):
@@ -32,18 +49,16 @@ class User(db.Model, UserMixin):
             db.session.commit()
 
     def set_password(self, password):
-        self.password = generate_password_hash(password)
+        self.password = hash_password(password)
 
     def update_profile(self, name, email, date_of_birth, gender, location, phone_number):
-        from dateutil.relativedelta import relativedelta    
-
         self.name = name
-        self.email = email
+        self.email = User.normalize_email(email)
         self.phone_number = phone_number
         self.date_of_birth = date_of_birth
         self.gender = gender
         self.location = location
-        self.age = relativedelta(datetime.today(), self.date_of_birth).years if self.date_of_birth else None         
+        self.age = _age(self.date_of_birth) if self.date_of_birth else None
 
     def is_profile_complete(self):
         # Logic to check if the user's profile is complete
@@ -57,14 +72,17 @@ class User(db.Model, UserMixin):
 
 class Patient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(100), nullable=False)
     phone_number = db.Column(db.String(20), nullable=False)
     condition = db.Column(db.String(100), nullable=False)
     location = db.Column(db.String(100), nullable=False)
+    latitude = db.Column(db.Float)  # Geocoded from location
+    longitude = db.Column(db.Float)
     gender = db.Column(db.String(10), nullable=False)  
     care_needed = db.Column(db.String(100), nullable=False)  # Changing care_needed to a single field
+    care_needed_mask = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Services named in care_needed, same bits as Caregiver.services_mask
     preferences = db.Column(db.String(100))  
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
 
@@ -73,34 +91,101 @@ class Patient(db.Model):
 
 class Caregiver(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     name = db.Column(db.String(100))
     email = db.Column(db.String(100))
     phone_number = db.Column(db.String(20), nullable=False)
     location = db.Column(db.String(100))
+    latitude = db.Column(db.Float)  # Geocoded from location
+    longitude = db.Column(db.Float)
     qualification = db.Column(db.String(100))
     experience = db.Column(db.String(100))
     gender = db.Column(db.String(10))
     license_number = db.Column(db.String(100))
     services_offered = db.Column(db.String(100))
+    services_mask = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)  # One bit per SERVICES_CHOICES entry
     license_verified = db.Column(db.Boolean, default=False)  # New field for license verification status
+    available = db.Column(db.Boolean, nullable=False, default=True, server_default='1', index=True)  # False takes the caregiver out of dispatch
     verification_error = db.Column(db.String(255))  # New field for storing verification error message
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Kept in step with review by ratings.py
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_score = db.Column(db.Float, nullable=False, default=3.0, server_default='3.0', index=True)  # Bayesian average used for ranking
 
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
 
+    # Licenses awaiting a registry verdict (licenses.py)
+    __table_args__ = (db.Index('ix_caregiver_license_pending', 'id', sqlite_where=db.text(
+        'license_verified = 0 AND verification_error IS NULL AND license_number IS NOT NULL')),)
+
+    services = db.relationship('CaregiverService', backref='caregiver', cascade='all, delete-orphan')
+    reviews = db.relationship('Review', backref='caregiver', order_by='Review.id.desc()')
+
+    @property
+    def rating(self):
+        # Plain average for display; rankings use rating_score
+        return round(self.rating_sum / self.rating_count, 1) if self.rating_count else None
+
     def __repr__(self):
         return f'<Caregiver {self.name}>'
 
+class CaregiverService(db.Model):
+    # Normalized form of Caregiver.services_mask, one row per offered service
+    caregiver_id = db.Column(db.Integer, db.ForeignKey('caregiver.id'), primary_key=True)
+    service_bit = db.Column(db.Integer, primary_key=True)  # Position of the service in SERVICES_CHOICES
+
+    __table_args__ = (db.Index('ix_caregiver_service_bit_caregiver', 'service_bit', 'caregiver_id'),)
+
+    def __repr__(self):
+        return f'<CaregiverService {self.caregiver_id}:{self.service_bit}>'
+
+class CaregiverSchedule(db.Model):
+    # Weekly working template: seven 12-byte bitmaps, Monday first, one bit
+    # per 15-minute slot of the day (see availability.py)
+    caregiver_id = db.Column(db.Integer, db.ForeignKey('caregiver.id'), primary_key=True)
+    weekly_slots = db.Column(db.LargeBinary(84), nullable=False)
+
+    def __repr__(self):
+        return f'<CaregiverSchedule {self.caregiver_id}>'
+
+class AvailabilityException(db.Model):
+    # Replaces the weekly template for one date; all-zero slots is a day off
+    caregiver_id = db.Column(db.Integer, db.ForeignKey('caregiver.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    slots = db.Column(db.LargeBinary(12), nullable=False)
+
+    def __repr__(self):
+        return f'<AvailabilityException {self.caregiver_id} {self.date}>'
+
+class GeocodeCache(db.Model):
+    # Resolved locations, keyed by the normalized location text. A row with no
+    # coordinates records a location the gazetteer could not resolve.
+    location = db.Column(db.String(255), primary_key=True)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f'<GeocodeCache {self.location}>'
+
 class Appointment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
-    caregiver_id = db.Column(db.Integer, db.ForeignKey('caregiver.id'), nullable=False)
+    # None while a requested visit waits for dispatch to pick its caregiver
+    caregiver_id = db.Column(db.Integer, db.ForeignKey('caregiver.id'), nullable=True)
     patient = db.relationship('Patient', backref='appointments_as_patient', foreign_keys=[patient_id])
     caregiver = db.relationship('Caregiver', backref='appointments_as_caregiver', foreign_keys=[caregiver_id])
     date_time = db.Column(db.DateTime, nullable=False)
     duration = db.Column(db.Integer, nullable=False)
     notes = db.Column(db.Text, nullable=True)
     location = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='Scheduled', server_default='Scheduled')  # 'Requested', 'Scheduled', 'Dispatched' or 'Completed'
+
+    __table_args__ = (
+        db.Index('ix_appointment_caregiver_date_time', 'caregiver_id', 'date_time'),
+        db.Index('ix_appointment_patient_date_time', 'patient_id', 'date_time'),
+        db.Index('ix_appointment_date_time', 'date_time'),
+        db.Index('ix_appointment_status_date_time', 'status', 'date_time'),
+    )
 
     def __repr__(self):
         return f'<Appointment {self.id}>'
@@ -112,6 +197,55 @@ class Review(db.Model):
     rating = db.Column(db.Integer, nullable=False)
     comments = db.Column(db.Text, nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_review_caregiver_rating', 'caregiver_id', 'rating'),
+        db.Index('ix_review_reviewer_id', 'reviewer_id'),
+    )
+
     def __repr__(self):
         return f'<Review {self.id}>'
-    
\ No newline at end of file
+    
+class Job(db.Model):
+    # A unit of background work (jobs.py). visible_at is when a worker may
+    # next claim it: its run time while queued, the end of its visibility
+    # timeout while running.
+    id = db.Column(db.Integer, primary_key=True)
+    queue = db.Column(db.String(50), nullable=False)
+    name = db.Column(db.String(100), nullable=False)  # Task the job runs
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON keyword arguments of the task
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'running', 'done' or 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    visible_at = db.Column(db.DateTime, nullable=False)
+    idempotency_key = db.Column(db.String(255), unique=True)  # Enqueueing the same key again adds nothing
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index('ix_job_queue_status_visible_at', 'queue', 'status', 'visible_at'),)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.name}>'
+
+class LedgerEntry(db.Model):
+    # Append-only payment ledger (payments.py); rows are never updated or
+    # deleted. A payment is one 'payment' row. Settling it appends a
+    # 'submitted' row when it is sent to the processor, then a 'settled' or
+    # 'declined' one, each pointing back at the payment.
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'payment', 'submitted', 'settled' or 'declined'
+    payment_id = db.Column(db.Integer, db.ForeignKey('ledger_entry.id'))  # None on 'payment' rows
+    amount_cents = db.Column(db.Integer, nullable=False)
+    idempotency_key = db.Column(db.String(255), unique=True)  # Payments only; a retried request adds nothing
+    appointment_id = db.Column(db.Integer)  # Kept as is after the appointment is cancelled
+    batch_ref = db.Column(db.String(64))  # Settlement batch the row belongs to
+    description = db.Column(db.String(255))  # What was paid for, or why it was declined
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_ledger_entry_payment_id_kind', 'payment_id', 'kind', unique=True),
+        db.Index('ix_ledger_entry_kind_payment_id', 'kind', 'payment_id'),
+    )
+
+    def __repr__(self):
+        return f'<LedgerEntry {self.id} {self.kind}>'
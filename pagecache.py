@@ -0,0 +1,216 @@
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, make_response, Response
+from flask_login import current_user
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Defaults, overridable through app.config (see init_app)
+PAGE_CACHE_TTL = 300              # seconds a cached page or fragment is served; 0 turns caching off
+PAGE_CACHE_SIZE = 1000            # anonymous pages kept, least recently used dropped
+FRAGMENT_CACHE_SIZE = 10000       # rendered fragments kept, least recently used dropped
+
+# Tells this process's ETags apart from another's or a previous run's,
+# whose data versions count from zero too
+_boot = os.urandom(4).hex()
+
+
+class DataVersion:
+    # A counter bumped after every commit that wrote something, from any
+    # session in the process. Cached fragments and per-user ETags include
+    # it, so any committed change makes them miss instead of having to say
+    # which pages it touched. Writes from other processes are not seen;
+    # the TTL bounds how stale that can get.
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.value += 1
+
+
+data_version = DataVersion()
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_write(session, flush_context):
+    tables = session.info.setdefault('written_tables', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        tables.add(type(obj).__tablename__)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_data_version(session):
+    if session.info.pop('written_tables', None):
+        data_version.bump()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_writes(session, previous_transaction):
+    session.info.pop('written_tables', None)
+
+
+class PageCache:
+    # Rendered output in two forms: whole anonymous pages (body, ETag and
+    # Last-Modified, keyed by path and the query arguments the view reads)
+    # and per-user template fragments (keyed by user, fragment name and data
+    # version). Both expire after `ttl` and are bounded LRUs.
+
+    def __init__(self, ttl=PAGE_CACHE_TTL, max_pages=PAGE_CACHE_SIZE, max_fragments=FRAGMENT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self.max_fragments = max_fragments
+        self.page_hits = 0
+        self.page_misses = 0
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+        self.not_modified = 0
+        self._pages = OrderedDict()
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_page(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is not None and entry[0] > now:
+                self._pages.move_to_end(key)
+                self.page_hits += 1
+                return entry[1:]
+            self.page_misses += 1
+            return None
+
+    def put_page(self, key, body, mimetype, etag, last_modified):
+        with self._lock:
+            self._pages[key] = (time.monotonic() + self.ttl, body, mimetype, etag, last_modified)
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+
+    def fragment(self, key, render):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._fragments.get(key)
+            if entry is not None and entry[0] > now:
+                self._fragments.move_to_end(key)
+                self.fragment_hits += 1
+                return entry[1]
+            self.fragment_misses += 1
+        html = render()
+        with self._lock:
+            self._fragments[key] = (now + self.ttl, html)
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.max_fragments:
+                self._fragments.popitem(last=False)
+        return html
+
+    def count_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._fragments.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'pages': len(self._pages), 'page_hits': self.page_hits, 'page_misses': self.page_misses,
+                    'fragments': len(self._fragments), 'fragment_hits': self.fragment_hits,
+                    'fragment_misses': self.fragment_misses, 'not_modified': self.not_modified}
+
+
+page_cache = PageCache()
+
+
+def _conditional(response):
+    # Turns the response into a 304 when the request's If-None-Match or
+    # If-Modified-Since already matches it
+    response.make_conditional(request)
+    if response.status_code == 304:
+        page_cache.count_not_modified()
+    return response
+
+
+def cached_page(view=None, *, query_args=()):
+    """Serve ``view`` to anonymous visitors from the page cache, with ETag and Last-Modified.
+
+    Pages are cached per path and per value of the ``query_args`` the view
+    reads; other query arguments share the page, so they cannot fill the
+    cache. Used bare, or as ``@cached_page(query_args=('page',))``.
+    """
+    if view is None:
+        return functools.partial(cached_page, query_args=query_args)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_user.is_authenticated or request.method != 'GET' or page_cache.ttl <= 0:
+            return view(*args, **kwargs)
+        key = (request.path, *(tuple(request.args.getlist(name)) for name in query_args))
+        entry = page_cache.get_page(key)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            etag = hashlib.md5(body).hexdigest()
+            last_modified = time.time()
+            page_cache.put_page(key, body, response.mimetype, etag, last_modified)
+        else:
+            body, mimetype, etag, last_modified = entry
+            response = Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # Browsers keep the page but ask again each time; a match costs a 304
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return _conditional(response)
+    return wrapper
+
+
+def per_user_page(view):
+    """Answer a signed-in user's repeat GET with 304 while nothing has been committed since."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated or request.method != 'GET' or page_cache.ttl <= 0:
+            return view(*args, **kwargs)
+        window = int(time.time() // page_cache.ttl)
+        etag = f'{_boot}-{current_user.id}-{data_version.value}-{window}'
+        if etag in request.if_none_match:
+            page_cache.count_not_modified()
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+
+def cache_fragment(name, caller):
+    # Used from templates as {% call cache_fragment('name') %}...{% endcall %};
+    # the block is rendered once per user and data version
+    if page_cache.ttl <= 0:
+        return Markup(caller())
+    user_id = current_user.id if current_user.is_authenticated else None
+    key = (user_id, name, data_version.value)
+    return Markup(page_cache.fragment(key, caller))
+
+
+def init_app(app):
+    page_cache.ttl = app.config.get('PAGE_CACHE_TTL', PAGE_CACHE_TTL)
+    page_cache.max_pages = app.config.get('PAGE_CACHE_SIZE', PAGE_CACHE_SIZE)
+    page_cache.max_fragments = app.config.get('FRAGMENT_CACHE_SIZE', FRAGMENT_CACHE_SIZE)
+    app.jinja_env.globals['cache_fragment'] = cache_fragment
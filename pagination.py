@@ -0,0 +1,54 @@
+import base64
+from datetime import datetime
+
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
+
+from models import Appointment
+
+APPOINTMENTS_PER_PAGE = 25
+
+
+def encode_cursor(date_time, appointment_id):
+    raw = f'{date_time.isoformat()}|{appointment_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """``(date_time, id)`` from a cursor token; raises ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        date_time, appointment_id = raw.split('|')
+        date_time = datetime.fromisoformat(date_time)
+        appointment_id = int(appointment_id)
+    except (TypeError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError('Invalid page cursor.') from e
+    # Appointment times are naive; an offset can only come from a tampered
+    # token, and comparing it with them would raise TypeError
+    if date_time.tzinfo is not None:
+        raise ValueError('Invalid page cursor.')
+    return date_time, appointment_id
+
+
+def upcoming_appointments(owner_column, owner_id, cursor=None, per_page=APPOINTMENTS_PER_PAGE, now=None):
+    """One page of future appointments ordered by (date_time, id), and the cursor of the next page.
+
+    Each page seeks straight to the row after ``cursor`` through the
+    (owner, date_time) index, so page 100 costs the same as page 1. The
+    patient and caregiver come in the same query rather than one lazy load
+    per row.
+    """
+    now = now or datetime.now()
+    query = Appointment.query.options(joinedload(Appointment.patient), joinedload(Appointment.caregiver)) \
+        .filter(owner_column == owner_id)
+    after = decode_cursor(cursor) if cursor else None
+    if after is not None and after[0] > now:
+        # Rows at the cursor's time sort by id, so only later ids of that time are left
+        query = query.filter(Appointment.date_time >= after[0],
+                             or_(Appointment.date_time > after[0], Appointment.id > after[1]))
+    else:
+        query = query.filter(Appointment.date_time > now)
+
+    rows = query.order_by(Appointment.date_time, Appointment.id).limit(per_page + 1).all()
+    next_cursor = encode_cursor(rows[per_page - 1].date_time, rows[per_page - 1].id) if len(rows) > per_page else None
+    return rows[:per_page], next_cursor
@@ -0,0 +1,362 @@
+import atexit
+import threading
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, exists, func, literal, or_, select, true
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session, aliased
+
+from models import db, Appointment, LedgerEntry
+from database import submit_write
+from applog import log
+
+# Defaults, overridable through app.config (see init_app)
+PAYMENT_PROCESSOR = None           # object with settle(batch_ref, payments); None means FakeProcessor()
+PAYMENT_SETTLEMENT = True          # settle from web processes from their first payment request on
+PAYMENT_SETTLE_INTERVAL = 30       # seconds between settlement runs
+PAYMENT_BATCH_SIZE = 500           # payments per settlement batch; this many pending starts a run early
+
+OUTCOMES = ('settled', 'declined')
+
+
+def to_cents(amount):
+    """Parse an amount such as ``'1,500.50'`` into whole cents; ValueError unless positive."""
+    try:
+        value = Decimal(str(amount).replace(',', '').strip()).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError(f'Not an amount: {amount!r}')
+    if value <= 0:
+        raise ValueError('Amount must be positive')
+    return int(value * 100)
+
+
+class FakeProcessor:
+    # Local stand-in for the payment processor. A batch reference seen
+    # before gets its earlier answer again, as a real processor's
+    # idempotent settlement call would give. Payments over `limit_cents`
+    # are declined.
+
+    def __init__(self, limit_cents=10_000_000, latency=0.0):
+        self.limit_cents = limit_cents
+        self.latency = latency
+        self.batches = {}
+        self._lock = threading.Lock()
+
+    def settle(self, batch_ref, payments):
+        """Return ``{payment_id: (settled, reason)}`` for ``[(payment_id, amount_cents)]``."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if batch_ref not in self.batches:
+                self.batches[batch_ref] = {
+                    payment_id: (True, None) if amount_cents <= self.limit_cents else (False, 'Over the card limit')
+                    for payment_id, amount_cents in payments
+                }
+            return dict(self.batches[batch_ref])
+
+
+def record_payment(amount_cents, idempotency_key, appointment_id=None, description=None):
+    """Append a payment to the ledger; returns ``(payment_id, created)``.
+
+    A single INSERT, kept to one probe of the idempotency key index: a key
+    already used returns the first payment with ``created`` False. With an
+    ``appointment_id`` the row is only inserted if the appointment exists;
+    ``payment_id`` is None when it does not.
+    """
+    values = {
+        'kind': 'payment',
+        'amount_cents': amount_cents,
+        'idempotency_key': idempotency_key,
+        'description': description and description[:255],
+        'created_at': datetime.now(),
+    }
+    if appointment_id is None:
+        statement = insert(LedgerEntry).values(**values)
+    else:
+        columns = LedgerEntry.__table__.c
+        statement = insert(LedgerEntry).from_select(
+            list(values) + ['appointment_id'],
+            select(*[literal(value, columns[name].type) for name, value in values.items()], Appointment.id)
+            .where(Appointment.id == appointment_id),
+        )
+    payment_id = db.session.execute(
+        statement.on_conflict_do_nothing(index_elements=['idempotency_key']).returning(LedgerEntry.id)
+    ).scalar()
+    if payment_id is not None:
+        db.session.info.setdefault('ledger_payments', []).append(payment_id)
+        return payment_id, True
+    existing = db.session.execute(select(LedgerEntry.id).where(LedgerEntry.idempotency_key == idempotency_key)).scalar()
+    return existing, False
+
+
+def payment_state(payment_id):
+    """'pending', 'submitted', 'settled' or 'declined'; None for an unknown payment."""
+    kinds = set(db.session.execute(
+        select(LedgerEntry.kind).where(or_(LedgerEntry.id == payment_id, LedgerEntry.payment_id == payment_id))
+    ).scalars())
+    if 'payment' not in kinds:
+        return None
+    for kind in OUTCOMES + ('submitted',):
+        if kind in kinds:
+            return kind
+    return 'pending'
+
+
+def _last_payment_id(kind):
+    # Highest payment with a row of this kind, read off the end of ix_ledger_entry_kind_payment_id
+    return db.session.execute(
+        select(LedgerEntry.payment_id).where(LedgerEntry.kind == kind)
+        .order_by(LedgerEntry.payment_id.desc()).limit(1)
+    ).scalar() or 0
+
+
+def _unanswered_batch(after, limit, skip=()):
+    # A submitted payment with neither a settled nor a declined row was sent
+    # without its answer being recorded, or the processor left it out of its
+    # answer. The first batch with such payments is returned, just those
+    # payments, to be sent again under the same reference. Read outside the
+    # writer thread: a batch answered meanwhile is answered again the same
+    # way, and its outcomes are only recorded once (see _record_outcomes).
+    outcome = aliased(LedgerEntry)
+    rows = db.session.execute(
+        select(LedgerEntry.payment_id, LedgerEntry.amount_cents, LedgerEntry.batch_ref).where(
+            LedgerEntry.kind == 'submitted', LedgerEntry.payment_id >= after,
+            LedgerEntry.batch_ref.notin_(skip) if skip else true(),
+            ~exists().where(outcome.payment_id == LedgerEntry.payment_id, outcome.kind.in_(OUTCOMES)),
+        ).order_by(LedgerEntry.payment_id).limit(limit)
+    ).all()
+    if not rows:
+        return None, []
+    batch_ref = rows[0].batch_ref
+    return batch_ref, [(row.payment_id, row.amount_cents) for row in rows if row.batch_ref == batch_ref]
+
+
+def _next_batch(limit):
+    # The next pending payments, in id order, marked as submitted in a new batch
+    payments = db.session.execute(
+        select(LedgerEntry.id, LedgerEntry.amount_cents).where(
+            LedgerEntry.kind == 'payment', LedgerEntry.payment_id.is_(None),
+            LedgerEntry.id > _last_payment_id('submitted'),
+        ).order_by(LedgerEntry.id).limit(limit)
+    ).all()
+    if not payments:
+        return None, []
+    batch_ref = uuid.uuid4().hex
+    now = datetime.now()
+    db.session.execute(insert(LedgerEntry), [
+        {'kind': 'submitted', 'payment_id': payment_id, 'amount_cents': amount_cents, 'batch_ref': batch_ref,
+         'created_at': now}
+        for payment_id, amount_cents in payments
+    ])
+    return batch_ref, [tuple(payment) for payment in payments]
+
+
+def _record_outcomes(batch_ref, payments, outcomes):
+    # Ignored when already recorded, e.g. by another process settling the same batch
+    now = datetime.now()
+    entries = [
+        {'kind': 'settled' if outcomes[payment_id][0] else 'declined', 'payment_id': payment_id,
+         'amount_cents': amount_cents, 'batch_ref': batch_ref, 'description': outcomes[payment_id][1],
+         'created_at': now}
+        for payment_id, amount_cents in payments if payment_id in outcomes
+    ]
+    if entries:
+        db.session.execute(insert(LedgerEntry).prefix_with('OR IGNORE'), entries)
+    return sum(1 for entry in entries if entry['kind'] == 'settled'), sum(1 for entry in entries if entry['kind'] == 'declined')
+
+
+def settle_pending():
+    """Settle every pending payment, a batch per processor call; returns ``(batches, settled, declined)``.
+
+    Batches left partly unanswered are sent again first, once per run, and
+    then the pending payments in new batches.
+    """
+    batcher = current_app.extensions['payments']
+    batches = settled = declined = 0
+    attempted = []
+    while True:
+        if not attempted:
+            # Every submitted payment below the first unanswered one has its
+            # answer for good, so later runs start their search there.
+            # Submitted is read first: batches sent meanwhile come after it.
+            last_submitted = _last_payment_id('submitted')
+        batch_ref, payments = _unanswered_batch(batcher.answered_below, batcher.batch_size, attempted)
+        if not attempted:
+            batcher.answered_below = payments[0][0] if payments else last_submitted + 1
+        if not payments:
+            batch_ref, payments = submit_write(_next_batch, batcher.batch_size)
+        if not payments:
+            break
+        attempted.append(batch_ref)
+        outcomes = batcher.processor.settle(batch_ref, payments)
+        batch_settled, batch_declined = submit_write(_record_outcomes, batch_ref, payments, outcomes)
+        batches += 1
+        settled += batch_settled
+        declined += batch_declined
+        log.info('Settlement batch recorded', extra={'fields': {
+            'batch_ref': batch_ref, 'payments': len(payments), 'settled': batch_settled, 'declined': batch_declined,
+            'amount_cents': sum(amount_cents for _, amount_cents in payments),
+        }})
+    batcher.counted(batches, settled, declined)
+    return batches, settled, declined
+
+
+def reconciliation_report(since=None, until=None):
+    """Ledger totals by kind and the figures of every settlement batch for entries in ``[since, until)``.
+
+    Two grouped queries over the ledger, whatever its size. A batch is
+    balanced once its settled and declined amounts add up to what was
+    submitted.
+    """
+    conditions = []
+    if since is not None:
+        conditions.append(LedgerEntry.created_at >= since)
+    if until is not None:
+        conditions.append(LedgerEntry.created_at < until)
+
+    totals = {kind: {'count': 0, 'amount_cents': 0} for kind in ('payment', 'submitted') + OUTCOMES}
+    rows = db.session.execute(
+        select(LedgerEntry.kind, func.count(), func.sum(LedgerEntry.amount_cents))
+        .where(*conditions).group_by(LedgerEntry.kind).execution_options(bulk_load=True)
+    )
+    for kind, count, amount_cents in rows:
+        totals[kind] = {'count': count, 'amount_cents': amount_cents or 0}
+
+    batches = {}
+    rows = db.session.execute(
+        select(LedgerEntry.batch_ref, LedgerEntry.kind, func.count(), func.sum(LedgerEntry.amount_cents),
+               func.min(LedgerEntry.created_at))
+        .where(LedgerEntry.batch_ref.isnot(None), *conditions)
+        .group_by(LedgerEntry.batch_ref, LedgerEntry.kind).execution_options(bulk_load=True)
+    )
+    for batch_ref, kind, count, amount_cents, first_at in rows:
+        batch = batches.setdefault(batch_ref, {'batch_ref': batch_ref, 'submitted_at': first_at,
+                                               **{f'{k}_{m}': 0 for k in ('submitted',) + OUTCOMES
+                                                  for m in ('count', 'cents')}})
+        batch[f'{kind}_count'] = count
+        batch[f'{kind}_cents'] = amount_cents or 0
+        batch['submitted_at'] = min(batch['submitted_at'], first_at)
+    for batch in batches.values():
+        batch['unanswered_count'] = batch['submitted_count'] - batch['settled_count'] - batch['declined_count']
+        batch['balanced'] = batch['submitted_cents'] == batch['settled_cents'] + batch['declined_cents']
+
+    return {
+        'totals': totals,
+        'outstanding': {'count': totals['payment']['count'] - totals['submitted']['count'],
+                        'amount_cents': totals['payment']['amount_cents'] - totals['submitted']['amount_cents']},
+        'batches': sorted(batches.values(), key=lambda batch: batch['submitted_at']),
+    }
+
+
+class SettlementBatcher:
+    # Settles pending payments on a background thread every
+    # `interval` seconds, or as soon as `batch_size` new payments have been
+    # committed in this process. A run that fails leaves its payments for
+    # the next one; a batch sent without its answer recorded is sent again
+    # under the same reference, so the processor never settles it twice.
+
+    def __init__(self, app):
+        self.app = app
+        self.processor = app.config.get('PAYMENT_PROCESSOR', PAYMENT_PROCESSOR) or FakeProcessor()
+        self.interval = app.config.get('PAYMENT_SETTLE_INTERVAL', PAYMENT_SETTLE_INTERVAL)
+        self.batch_size = app.config.get('PAYMENT_BATCH_SIZE', PAYMENT_BATCH_SIZE)
+        self.runs = 0
+        self.batches = 0
+        self.settled = 0
+        self.declined = 0
+        self.failures = 0
+        self.answered_below = 0  # see settle_pending
+        self._new_payments = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name='settlement', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def notify(self, new_payments):
+        with self._lock:
+            self._new_payments += new_payments
+            full = self._new_payments >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def counted(self, batches, settled, declined):
+        with self._lock:
+            self.runs += 1
+            self.batches += batches
+            self.settled += settled
+            self.declined += declined
+
+    def _work(self):
+        while not self._stop.is_set():
+            if self._wake.wait(self.interval):
+                self._wake.clear()
+            if self._stop.is_set():
+                break
+            with self._lock:
+                self._new_payments = 0
+            try:
+                with self.app.app_context():
+                    settle_pending()
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                log.exception('Settlement run failed')
+
+    def stats(self):
+        with self._lock:
+            return {'runs': self.runs, 'batches': self.batches, 'settled': self.settled, 'declined': self.declined,
+                    'failures': self.failures, 'waiting': self._new_payments}
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_batcher(session):
+    payments = session.info.pop('ledger_payments', None)
+    if payments and has_app_context():
+        batcher = current_app.extensions.get('payments')
+        if batcher is not None:
+            batcher.notify(len(payments))
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_payments(session, previous_transaction):
+    session.info.pop('ledger_payments', None)
+
+
+def stats():
+    batcher = current_app.extensions.get('payments') if has_app_context() else None
+    return batcher.stats() if batcher is not None else {}
+
+
+_setup_lock = threading.Lock()
+
+
+def init_app(app):
+    # Not called by create_app: app.py imports this module and sets it up on
+    # the first payment request or command, and starts settlement from
+    # requests only (see app._payments). Later calls return the same batcher.
+    batcher = app.extensions.get('payments')
+    if batcher is None:
+        with _setup_lock:
+            batcher = app.extensions.get('payments')
+            if batcher is None:
+                batcher = app.extensions['payments'] = SettlementBatcher(app)
+                atexit.register(batcher.stop)
+    return batcher
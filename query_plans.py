@@ -0,0 +1,225 @@
+import os
+import sys
+import tempfile
+import threading
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Run as `python query_plans.py`: drives the routes against a scratch
+# database, records every statement they send and runs EXPLAIN QUERY PLAN
+# on each one. Exits with status 1 if any statement scans a whole table
+# below, so a dropped or unusable index is caught, or if a driven route
+# fails, since its plan would then go unchecked. Queries that read whole
+# tables on purpose (the in-memory dispatch, geo and availability indexes
+# load that way) say so with .execution_options(bulk_load=True).
+LARGE_TABLES = {
+    'user', 'patient', 'caregiver', 'caregiver_service', 'caregiver_schedule',
+    'availability_exception', 'appointment', 'review', 'geocode_cache', 'ledger_entry',
+}
+SKIPPED_STATEMENTS = ('PRAGMA', 'EXPLAIN', 'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE',
+                      'CREATE', 'DROP', 'INSERT')
+
+
+class QueryRecorder:
+    # Collects each distinct statement (with the parameters it was first
+    # run with) sent through any engine while active, from every thread
+
+    def __init__(self):
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(SKIPPED_STATEMENTS):
+            return
+        if context is not None and context.execution_options.get('bulk_load'):
+            return
+        if executemany:
+            parameters = parameters[0]
+        with self._lock:
+            self.statements.setdefault(statement, parameters)
+
+    def __enter__(self):
+        event.listen(Engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, 'before_cursor_execute', self._record)
+
+
+def full_scans(connection, statement, parameters):
+    """The EXPLAIN QUERY PLAN lines of ``statement`` that scan a whole large table."""
+    plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        words = detail.split()
+        if words[0] == 'SCAN' and words[1] in LARGE_TABLES:
+            scans.append(detail)
+    return scans
+
+
+def check(connection, statements):
+    """Return ``[(statement, scans)]`` for the statements that scan a large table."""
+    problems = []
+    for statement, parameters in statements.items():
+        scans = full_scans(connection, statement, parameters)
+        if scans:
+            problems.append((statement, scans))
+    return problems
+
+
+def _seed(db, models):
+    from werkzeug.security import generate_password_hash
+    from services import set_caregiver_services
+    from availability import set_weekly_schedule
+
+    password = generate_password_hash('password', 'pbkdf2:sha256:1000')
+    patient_user = models.User(name='Pat', email='patient@example.com', password=password, user_type='patient',
+                               phone_number='0700000001', location='Karen')
+    caregiver_user = models.User(name='Cara', email='caregiver@example.com', password=password,
+                                 user_type='caregiver', phone_number='0700000002', location='Karen')
+    db.session.add_all([patient_user, caregiver_user])
+    db.session.flush()
+
+    patient = models.Patient(user_id=patient_user.id, name='Pat', email='patient@example.com',
+                             phone_number='0700000001', condition='Recovery', location='Karen', gender='Female',
+                             care_needed='Post surgery')
+    db.session.add(patient)
+    for i in range(5):
+        caregiver = models.Caregiver(user_id=caregiver_user.id if i == 0 else None, name=f'Caregiver {i}',
+                                     phone_number='0700000100', location='Karen', qualification='Nurse',
+                                     experience='5 years', gender='Female')
+        set_caregiver_services(caregiver, ['Post surgery', 'Feeding'])
+        db.session.add(caregiver)
+    db.session.flush()
+
+    set_weekly_schedule(1, {weekday: [(time(8), time(18))] for weekday in range(7)})
+    start = datetime.combine(datetime.now().date() + timedelta(days=1), time(9))
+    for i in range(3):
+        db.session.add(models.Appointment(patient_id=patient.id, caregiver_id=1, date_time=start + timedelta(days=i),
+                                          duration=60, location='Karen'))
+    db.session.add(models.Review(reviewer_id=patient.id, caregiver_id=1, rating=5, comments='Great'))
+    db.session.commit()
+    return start
+
+
+def _drive(app, start):
+    # One pass over the routes as a patient and as a caregiver. Responses
+    # are not checked beyond failing; returns ``[(method, url, error)]`` for
+    # the requests that raised or answered with a 5xx
+    when = start + timedelta(days=7)
+    slot = when.strftime('%Y-%m-%d %H:%M')
+    patient_requests = [
+        ('get', '/patient_dashboard', None),
+        ('get', '/profile', None),
+        ('post', '/profile', {'name': 'Pat', 'email': 'patient@example.com', 'phone_number': '0700000001',
+                              'date_of_birth': '1990-01-01', 'gender': 'female', 'location': 'Karen'}),
+        ('get', '/appointments', None),
+        ('get', '/search_caregivers?requirements=surgery', None),
+        ('get', '/search_caregivers?requirements=surgery&sort=rating', None),
+        ('get', '/top_caregivers?service=Post surgery&region=Karen', None),
+        ('get', f'/free_caregivers?date_time={slot}&duration=60', None),
+        ('post', '/book_appointment', {'caregiver_id': 2, 'patient_id': 1, 'date_time': slot + ':00',
+                                       'duration': 60, 'location': 'Karen', 'notes': ''}),
+        ('post', '/book_appointment', {'patient_id': 1, 'date_time': (when + timedelta(hours=6)).strftime('%Y-%m-%d %H:%M:%S'),
+                                       'duration': 60, 'location': 'Karen', 'notes': ''}),
+        ('post', '/schedule_appointment', {'patient_id': 1, 'caregiver_id': 3, 'date_time': slot, 'duration': 60,
+                                           'notes': '', 'location': 'Karen'}),
+        ('get', '/view_appointment/1', None),
+        ('post', '/reschedule_appointment/2', {'date_time': (when + timedelta(hours=3)).strftime('%Y-%m-%d %H:%M:%S'),
+                                               'duration': 60, 'location': 'Karen', 'notes': ''}),
+        ('post', '/dispatch_caregiver/1', None),
+        ('get', '/caregiving_session/1', None),
+        ('post', '/select_caregiver', {'caregiver_id': 1}),
+        ('post', '/cancel_appointment/3', None),
+        ('post', '/complete_and_feedback/1', {'rating': 4, 'comments': 'Kind and punctual'}),
+        ('get', '/confirm_and_pay?appointment_id=1', None),
+        ('post', '/confirm_payment', {'appointment_id': 1, 'payment_amount': '1500', 'idempotency_key': 'plans-1'}),
+        ('post', '/confirm_payment', {'appointment_id': 1, 'payment_amount': '1500', 'idempotency_key': 'plans-1'}),
+        ('post', '/confirm_and_pay', {'patient_name': 'Pat', 'caregiver_name': 'Cara', 'appointment_date': '2030-01-01',
+                                      'appointment_time': '10:00', 'appointment_duration': '1h',
+                                      'payment_amount': '1500', 'idempotency_key': 'plans-2'}),
+        ('get', '/payment_status?payment_id=1', None),
+    ]
+    caregiver_requests = [
+        ('get', '/caregiver_dashboard', None),
+        ('get', '/appointments', None),
+        ('get', '/availability', None),
+        ('post', '/availability', {f'weekly-{day}': '08:00-12:00, 13:00-18:00' for day in
+                                   ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')}),
+        ('post', '/availability/exception', {'exception-date': (when + timedelta(days=1)).strftime('%Y-%m-%d'),
+                                             'exception-hours': ''}),
+    ]
+    signup = {'name': 'New', 'email': 'new@example.com', 'password': 'pw', 'confirm_password': 'pw',
+              'user_type': 'patient', 'gender': 'male', 'date_of_birth': '2000-01-01', 'location': 'Karen',
+              'phone_number': '0700000003'}
+    failures = []
+    for email, requests in (('patient@example.com', patient_requests), ('caregiver@example.com', caregiver_requests),
+                            (None, [('post', '/signup', signup)])):
+        client = app.test_client()
+        if email is not None:
+            client.post('/login', data={'email': email, 'password': 'password'})
+        for method, url, data in requests:
+            # Keep going after a failure: later routes still get their plans checked
+            try:
+                response = getattr(client, method)(url, data=data)
+            except Exception as e:
+                failures.append((method, url, f'{type(e).__name__}: {e}'))
+                continue
+            if response.status_code >= 500:
+                failures.append((method, url, f'HTTP {response.status_code}'))
+    return failures
+
+
+def main():
+    scratch = tempfile.mkdtemp(prefix='careconnect-plans-')
+    import models
+    from app import create_app
+    from models import db
+    from search import ensure_search_index
+    from dispatch import dispatch_engine, pending_appointments
+    from geo import load_caregiver_index, nearest_caregivers
+    from payments import settle_pending
+    from reminders import reminder_schedule
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(scratch, 'plans.db'),
+        'SECRET_KEY': 'query-plans',
+        'WTF_CSRF_ENABLED': False,
+    })
+    with app.app_context():
+        db.create_all()
+        ensure_search_index()
+        db.session.commit()
+        start = _seed(db, models)
+
+    with QueryRecorder() as recorder:
+        with app.app_context():
+            dispatch_engine.load()
+            load_caregiver_index()
+            pending_appointments()
+            nearest_caregivers(db.session.get(models.Patient, 1), k=5)
+        failures = _drive(app, start)
+        with app.app_context():
+            settle_pending()
+            if not reminder_schedule.loaded:
+                reminder_schedule.load()
+            app.extensions['reminders'].send_due((start + timedelta(days=30)).timestamp())
+
+    with app.app_context():
+        with db.engine.connect() as connection:
+            problems = check(connection, recorder.statements)
+
+    print(f'{len(recorder.statements)} distinct statements checked.')
+    for statement, scans in problems:
+        print('\nFull scan:', '; '.join(scans))
+        print(' '.join(statement.split()))
+    for method, url, error in failures:
+        print(f'\nRoute failed: {method.upper()} {url}: {error}')
+    return 1 if problems or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
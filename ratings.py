@@ -0,0 +1,96 @@
+from sqlalchemy import event, func, inspect, select, update
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Caregiver, Review
+
+# Bayesian average: every caregiver starts with RATING_PRIOR_WEIGHT
+# imaginary reviews of RATING_PRIOR_MEAN stars, so a single 5-star review
+# does not outrank fifty 4.8s. Keep in step with Caregiver.rating_score's
+# server default.
+RATING_PRIOR_MEAN = 3.0
+RATING_PRIOR_WEIGHT = 5
+
+_listeners = []
+
+
+def bayesian_score(rating_sum, rating_count):
+    return (RATING_PRIOR_WEIGHT * RATING_PRIOR_MEAN + rating_sum) / (RATING_PRIOR_WEIGHT + rating_count)
+
+
+def on_rating_change(fn):
+    """Call ``fn(caregiver_id, rating_score)`` after each commit that changes a caregiver's rating."""
+    _listeners.append(fn)
+    return fn
+
+
+def _score_expression(rating_sum, rating_count):
+    return (float(RATING_PRIOR_WEIGHT * RATING_PRIOR_MEAN) + rating_sum) / (RATING_PRIOR_WEIGHT + rating_count)
+
+
+def _adjust(connection, session, caregiver_id, count_delta, sum_delta):
+    # Relative UPDATE, so concurrent reviews of one caregiver cannot lose counts
+    caregiver = Caregiver.__table__
+    rating_count = caregiver.c.rating_count + count_delta
+    rating_sum = caregiver.c.rating_sum + sum_delta
+    connection.execute(
+        update(caregiver).where(caregiver.c.id == caregiver_id)
+        .values(rating_count=rating_count, rating_sum=rating_sum,
+                rating_score=_score_expression(rating_sum, rating_count))
+    )
+    score = connection.execute(select(caregiver.c.rating_score).where(caregiver.c.id == caregiver_id)).scalar()
+    if session is not None and score is not None:
+        session.info.setdefault('rating_changes', {})[caregiver_id] = score
+
+
+def backfill_ratings(connection=None):
+    """Recompute every caregiver's count, sum and score from the review table."""
+    connection = connection or db.session.connection()
+    caregiver, review = Caregiver.__table__, Review.__table__
+    connection.execute(update(caregiver).values(
+        rating_count=select(func.count(review.c.id)).where(review.c.caregiver_id == caregiver.c.id)
+        .scalar_subquery(),
+        rating_sum=select(func.coalesce(func.sum(review.c.rating), 0)).where(review.c.caregiver_id == caregiver.c.id)
+        .scalar_subquery(),
+    ))
+    # A second statement, since SET expressions see the old counts
+    connection.execute(update(caregiver).values(
+        rating_score=_score_expression(caregiver.c.rating_sum, caregiver.c.rating_count)))
+
+
+# Keep the aggregates in the same transaction as the review itself
+@event.listens_for(Review, 'after_insert')
+def _review_inserted(mapper, connection, target):
+    _adjust(connection, object_session(target), target.caregiver_id, 1, target.rating)
+
+
+@event.listens_for(Review, 'after_update')
+def _review_updated(mapper, connection, target):
+    state = inspect(target)
+    caregiver_history = state.attrs.caregiver_id.history
+    rating_history = state.attrs.rating.history
+    if not caregiver_history.has_changes() and not rating_history.has_changes():
+        return
+    old_caregiver = (caregiver_history.deleted or [target.caregiver_id])[0]
+    old_rating = (rating_history.deleted or [target.rating])[0]
+    session = object_session(target)
+    _adjust(connection, session, old_caregiver, -1, -old_rating)
+    _adjust(connection, session, target.caregiver_id, 1, target.rating)
+
+
+@event.listens_for(Review, 'after_delete')
+def _review_deleted(mapper, connection, target):
+    _adjust(connection, object_session(target), target.caregiver_id, -1, -target.rating)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_rating_changes(session):
+    changes = session.info.pop('rating_changes', None)
+    if changes:
+        for caregiver_id, score in changes.items():
+            for fn in _listeners:
+                fn(caregiver_id, score)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_rating_changes(session, previous_transaction):
+    session.info.pop('rating_changes', None)
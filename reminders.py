@@ -0,0 +1,427 @@
+import atexit
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, aliased, object_session
+
+from models import db, Appointment, Patient, Caregiver
+from applog import log
+
+# Defaults, overridable through app.config (see init_app)
+REMINDERS = True                   # send reminders from web processes from their first request on; keep it
+                                   # to one process per database (False, plus `flask run-reminders`, elsewhere)
+REMINDER_OFFSETS = (24 * 3600, 3600)  # seconds before an appointment that reminders go out
+REMINDER_TICK = 10                 # seconds per turn of the innermost wheel; reminders due within one go together
+REMINDER_SENDER = None             # object with send(reminders); None means LogSender()
+REMINDER_BATCH_SIZE = 500          # reminders per send() call
+REMINDER_RETRY_DELAY = 60          # seconds before reminders a sender failed on are tried again
+REMINDER_MAX_ATTEMPTS = 3
+
+# Wheel shape: 4 levels of 64 buckets cover 64**4 ticks (about 5 years at
+# 10 seconds); reminders further out wait in the outermost level
+WHEEL_SLOTS = 64
+WHEEL_LEVELS = 4
+
+# Reminder keys pack the appointment id and the offset's position in REMINDER_OFFSETS
+MAX_OFFSETS = 8
+
+
+class TimingWheel:
+    # Hierarchical timing wheel (Varghese & Lauck, as in the classic Linux
+    # timer code). Level 0 has one bucket per tick; each bucket of level n
+    # spans a whole turn of level n - 1. A timer goes into the level whose
+    # span covers its distance from now, and when a lower level wraps
+    # around, the next bucket of the level above is emptied and its timers
+    # placed again, closer in. Buckets are dicts of key -> deadline, and
+    # every key remembers its bucket, so adding and cancelling a timer are
+    # O(1) whatever the number pending; advancing costs O(1) per tick plus
+    # the timers that move down or expire.
+
+    def __init__(self, now=0, slots=WHEEL_SLOTS, levels=WHEEL_LEVELS):
+        self.bits = slots.bit_length() - 1
+        if 1 << self.bits != slots:
+            raise ValueError('slots must be a power of two')
+        self.mask = slots - 1
+        self.levels = levels
+        self.base = now  # next tick to expire
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._bucket_of = {}
+
+    def __len__(self):
+        return len(self._bucket_of)
+
+    def __contains__(self, key):
+        return key in self._bucket_of
+
+    def _bucket(self, deadline):
+        delta = deadline - self.base
+        if delta < 0:
+            # Already due: expires with the next tick
+            return self._wheels[0][self.base & self.mask]
+        for level in range(self.levels):
+            if delta < 1 << (self.bits * (level + 1)):
+                return self._wheels[level][(deadline >> (self.bits * level)) & self.mask]
+        # Beyond the outermost level: park at its far end and place again when it comes round
+        furthest = self.base + (1 << (self.bits * self.levels)) - 1
+        return self._wheels[-1][(furthest >> (self.bits * (self.levels - 1))) & self.mask]
+
+    def add(self, key, deadline):
+        self.cancel(key)
+        bucket = self._bucket(deadline)
+        bucket[key] = deadline
+        self._bucket_of[key] = bucket
+
+    def cancel(self, key):
+        bucket = self._bucket_of.pop(key, None)
+        if bucket is not None:
+            del bucket[key]
+
+    def _cascade(self, level, index):
+        bucket = self._wheels[level][index]
+        self._wheels[level][index] = {}
+        for key, deadline in bucket.items():
+            moved = self._bucket(deadline)
+            moved[key] = deadline
+            self._bucket_of[key] = moved
+
+    def advance(self, to_tick):
+        """Turn the wheel up to and including ``to_tick``; returns the expired ``[(key, deadline)]``."""
+        expired = []
+        while self.base <= to_tick:
+            if not self._bucket_of:
+                self.base = to_tick + 1
+                break
+            index = self.base & self.mask
+            if index == 0:
+                for level in range(1, self.levels):
+                    level_index = (self.base >> (self.bits * level)) & self.mask
+                    self._cascade(level, level_index)
+                    if level_index != 0:
+                        break
+            bucket = self._wheels[0][index]
+            if bucket:
+                self._wheels[0][index] = {}
+                for key, deadline in bucket.items():
+                    del self._bucket_of[key]
+                    expired.append((key, deadline))
+            self.base += 1
+        return expired
+
+
+class ReminderSchedule:
+    # Every pending reminder of every upcoming appointment, in a timing
+    # wheel loaded from the appointment table at startup and then kept up to
+    # date from committed appointment changes, so nothing polls the table.
+    # The database stays the source of truth: reminders are checked against
+    # their appointment before they are sent (see send_due).
+
+    def __init__(self, tick=REMINDER_TICK, offsets=REMINDER_OFFSETS):
+        self.tick = tick
+        self.offsets = tuple(offsets)
+        self.loaded = False
+        self._wheel = TimingWheel(self._tick_of(time.time()))
+        self._loading = None  # changes committed while load() runs, replayed onto its wheel
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def configure(self, tick=None, offsets=None):
+        if tick is not None:
+            self.tick = tick
+        if offsets is not None:
+            if len(offsets) > MAX_OFFSETS:
+                raise ValueError(f'At most {MAX_OFFSETS} reminder offsets')
+            self.offsets = tuple(offsets)
+        self.clear()
+
+    def _tick_of(self, timestamp):
+        return int(timestamp // self.tick)
+
+    def fire_tick(self, date_time, offset_index):
+        """The tick a reminder of an appointment at ``date_time`` is due in."""
+        return self._tick_of(date_time.timestamp() - self.offsets[offset_index])
+
+    def _add(self, wheel, appointment_id, date_time):
+        timestamp = date_time.timestamp()
+        for i, offset in enumerate(self.offsets):
+            deadline = self._tick_of(timestamp - offset)
+            # Reminders whose time has passed are not sent late
+            if deadline >= wheel.base:
+                wheel.add(appointment_id * MAX_OFFSETS + i, deadline)
+
+    def load(self):
+        # Changes committed from here on are kept until the new wheel is in
+        # place, so an appointment booked while the table is read still gets
+        # its reminders
+        loading = []
+        with self._lock:
+            self._loading = loading
+        rows = db.session.execute(
+            select(Appointment.id, Appointment.date_time)
+            .where(Appointment.date_time > datetime.now(), Appointment.status != 'Completed')
+            .execution_options(bulk_load=True)
+        )
+        # Filled outside the lock, so commits applying their changes meanwhile do not wait
+        wheel = TimingWheel(self._tick_of(time.time()))
+        for appointment_id, date_time in rows:
+            self._add(wheel, appointment_id, date_time)
+        with self._lock:
+            if self._loading is not loading:
+                return  # Cleared meanwhile
+            for change in loading:
+                self._apply(wheel, change)
+            self._wheel = wheel
+            self._loading = None
+            self.loaded = True
+
+    def schedule(self, appointment_id, date_time):
+        with self._lock:
+            self._apply(self._wheel, ('schedule', appointment_id, date_time))
+
+    def cancel(self, appointment_id):
+        with self._lock:
+            self._apply(self._wheel, ('cancel', appointment_id))
+
+    def apply(self, changes):
+        """Apply committed ``('schedule', id, date_time)`` and ``('cancel', id)`` changes.
+
+        Ignored until the schedule is loaded, which reads them from the table.
+        """
+        with self._lock:
+            if self._loading is not None:
+                self._loading.extend(changes)
+            elif self.loaded:
+                for change in changes:
+                    self._apply(self._wheel, change)
+
+    def _apply(self, wheel, change):
+        appointment_id = change[1]
+        for i in range(len(self.offsets)):
+            wheel.cancel(appointment_id * MAX_OFFSETS + i)
+        if change[0] == 'schedule':
+            self._add(wheel, appointment_id, change[2])
+
+    def retry(self, reminders, delay):
+        # Back in the wheel as if due `delay` seconds from now
+        deadline = self._tick_of(time.time() + delay)
+        with self._lock:
+            for appointment_id, offset_index, _ in reminders:
+                self._wheel.add(appointment_id * MAX_OFFSETS + offset_index, deadline)
+
+    def due(self, now=None):
+        """Take the reminders due by ``now`` out of the wheel as ``[(appointment_id, offset_index, tick)]``."""
+        with self._lock:
+            expired = self._wheel.advance(self._tick_of(time.time() if now is None else now))
+        return [(key // MAX_OFFSETS, key % MAX_OFFSETS, deadline) for key, deadline in expired]
+
+    def clear(self):
+        with self._lock:
+            self._wheel = TimingWheel(self._tick_of(time.time()))
+            self._loading = None
+            self.loaded = False
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._wheel), 'loaded': self.loaded}
+
+
+reminder_schedule = ReminderSchedule()
+
+
+class LogSender:
+    # Stand-in sender that writes each reminder to the log
+
+    def send(self, reminders):
+        for reminder in reminders:
+            log.info('Appointment reminder', extra={'fields': {
+                'appointment_id': reminder['appointment_id'],
+                'date_time': reminder['date_time'],
+                'minutes_before': reminder['minutes_before'],
+            }})
+
+
+def _reminder_rows(appointment_ids):
+    patient = aliased(Patient)
+    caregiver = aliased(Caregiver)
+    return db.session.execute(
+        select(Appointment.id, Appointment.date_time, Appointment.duration, Appointment.location, Appointment.status,
+               patient.name, patient.email, patient.phone_number,
+               caregiver.name, caregiver.email, caregiver.phone_number)
+        .join(patient, patient.id == Appointment.patient_id)
+        .outerjoin(caregiver, caregiver.id == Appointment.caregiver_id)
+        .where(Appointment.id.in_(appointment_ids))
+    ).all()
+
+
+def _contact(name, email, phone_number):
+    return {'name': name, 'email': email, 'phone_number': phone_number}
+
+
+class ReminderRunner:
+    # Takes due reminders out of the schedule once per tick and hands them
+    # to the sender, up to `batch_size` per call. Reminders the sender
+    # fails on are tried again after `retry_delay`, up to `max_attempts`.
+
+    def __init__(self, app):
+        self.app = app
+        self.sender = app.config.get('REMINDER_SENDER', REMINDER_SENDER) or LogSender()
+        self.batch_size = app.config.get('REMINDER_BATCH_SIZE', REMINDER_BATCH_SIZE)
+        self.retry_delay = app.config.get('REMINDER_RETRY_DELAY', REMINDER_RETRY_DELAY)
+        self.max_attempts = app.config.get('REMINDER_MAX_ATTEMPTS', REMINDER_MAX_ATTEMPTS)
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+        self.batches = 0
+        self._attempts = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name='reminders', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def wait(self, timeout=None):
+        # True once stop() has been called
+        return self._stop.wait(timeout)
+
+    def _work(self):
+        with self.app.app_context():
+            if not reminder_schedule.loaded:
+                reminder_schedule.load()
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self.send_due()
+            except Exception:
+                log.exception('Reminder run failed')
+            tick = reminder_schedule.tick
+            self._stop.wait(tick - time.time() % tick)
+
+    def send_due(self, now=None):
+        """Send every reminder due by ``now``; returns how many were sent."""
+        due = reminder_schedule.due(now)
+        sent = 0
+        for start in range(0, len(due), self.batch_size):
+            sent += self._send_batch(due[start:start + self.batch_size])
+        return sent
+
+    def _send_batch(self, batch):
+        rows = {row[0]: row for row in _reminder_rows({appointment_id for appointment_id, _, _ in batch})}
+        reminders = []
+        ready = []
+        for appointment_id, offset_index, tick in batch:
+            row = rows.get(appointment_id)
+            if row is None or row.status == 'Completed':
+                # Cancelled or finished since it was scheduled, e.g. by another process
+                self.skipped += 1
+                continue
+            # A retried reminder comes back later than the tick it was scheduled for
+            scheduled = self._attempts.get((appointment_id, offset_index), (0, tick))[1]
+            if reminder_schedule.fire_tick(row.date_time, offset_index) != scheduled:
+                # Moved by another process: scheduled again for its new time
+                self._attempts.pop((appointment_id, offset_index), None)
+                reminder_schedule.schedule(appointment_id, row.date_time)
+                self.skipped += 1
+                continue
+            ready.append((appointment_id, offset_index, scheduled))
+            reminders.append({
+                'appointment_id': appointment_id,
+                'date_time': row.date_time,
+                'duration': row.duration,
+                'location': row.location,
+                'minutes_before': reminder_schedule.offsets[offset_index] // 60,
+                'patient': _contact(*row[5:8]),
+                # None for a requested visit that has no caregiver yet
+                'caregiver': _contact(*row[8:11]) if row[8] is not None else None,
+            })
+        if not reminders:
+            return 0
+        try:
+            self.sender.send(reminders)
+        except Exception:
+            log.exception('Reminder batch failed', extra={'fields': {'reminders': len(reminders)}})
+            again = []
+            for reminder in ready:
+                attempts = self._attempts.get(reminder[:2], (0, None))[0] + 1
+                if attempts < self.max_attempts:
+                    self._attempts[reminder[:2]] = (attempts, reminder[2])
+                    again.append(reminder)
+                else:
+                    self._attempts.pop(reminder[:2], None)
+                    self.failed += 1
+            reminder_schedule.retry(again, self.retry_delay)
+            return 0
+        for reminder in ready:
+            self._attempts.pop(reminder[:2], None)
+        with self._lock:
+            self.sent += len(reminders)
+            self.batches += 1
+        return len(reminders)
+
+    def stats(self):
+        with self._lock:
+            return {**reminder_schedule.stats(), 'sent': self.sent, 'batches': self.batches, 'skipped': self.skipped,
+                    'failed': self.failed}
+
+
+# Appointment changes reach the schedule once their transaction commits
+@event.listens_for(Appointment, 'after_insert')
+@event.listens_for(Appointment, 'after_update')
+def _appointment_saved(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    history = inspect(target).attrs
+    if history.date_time.history.has_changes() or history.status.history.has_changes():
+        change = ('cancel', target.id) if target.status == 'Completed' else ('schedule', target.id, target.date_time)
+        session.info.setdefault('reminder_changes', []).append(change)
+
+
+@event.listens_for(Appointment, 'after_delete')
+def _appointment_deleted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('reminder_changes', []).append(('cancel', target.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_reminder_changes(session):
+    changes = session.info.pop('reminder_changes', None)
+    if changes:
+        reminder_schedule.apply(changes)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_reminder_changes(session, previous_transaction):
+    session.info.pop('reminder_changes', None)
+
+
+def stats():
+    runner = current_app.extensions.get('reminders') if has_app_context() else None
+    return runner.stats() if runner is not None else reminder_schedule.stats()
+
+
+def init_app(app):
+    reminder_schedule.configure(tick=app.config.get('REMINDER_TICK', REMINDER_TICK),
+                                offsets=app.config.get('REMINDER_OFFSETS', REMINDER_OFFSETS))
+    runner = ReminderRunner(app)
+    app.extensions['reminders'] = runner
+    if app.config.get('REMINDERS', REMINDERS):
+        # Loaded and started by the first request, like the job workers, so CLI commands skip it
+        app.before_request(runner.start)
+    atexit.register(runner.stop)
+    return runner
@@ -0,0 +1,74 @@
+from datetime import timedelta
+
+from sqlalchemy import update
+from sqlalchemy.exc import OperationalError
+
+from models import db, Appointment, Caregiver, Patient
+
+# Longest visit we accept; it bounds how far back an overlap check has to look
+MAX_DURATION_MINUTES = 24 * 60
+
+
+class BookingConflict(Exception):
+    def __init__(self, message, appointment_id=None):
+        super().__init__(message)
+        self.appointment_id = appointment_id
+
+
+def _end(start, duration):
+    return start + timedelta(minutes=float(duration))
+
+
+def _conflict_in_db(column, owner_id, start, end, ignore_id):
+    # Range scan on the (owner, date_time) index, bounded by the longest visit
+    query = db.session.query(Appointment.id, Appointment.date_time, Appointment.duration).filter(
+        column == owner_id,
+        Appointment.date_time < end,
+        Appointment.date_time > start - timedelta(minutes=MAX_DURATION_MINUTES)
+    )
+    if ignore_id is not None:
+        query = query.filter(Appointment.id != ignore_id)
+    for appointment_id, other_start, other_duration in query:
+        if _end(other_start, other_duration) > start:
+            return appointment_id
+    return None
+
+
+def reserve_slot(caregiver_id, patient_id, start, duration, ignore_id=None):
+    """Make sure the slot is free for both sides before it is written.
+
+    Raises ``BookingConflict`` when it is not. Otherwise the caregiver and
+    patient rows stay write-locked until the caller commits, so a second
+    worker booking either of them waits and then sees this booking.
+    """
+    caregiver_id = int(caregiver_id) if caregiver_id is not None else None
+    patient_id = int(patient_id) if patient_id is not None else None
+    if duration is None or float(duration) <= 0 or float(duration) > MAX_DURATION_MINUTES:
+        raise BookingConflict('Appointments must last between 1 minute and 24 hours.')
+
+    end = _end(start, duration)
+    owners = [(Caregiver, Appointment.caregiver_id, caregiver_id), (Patient, Appointment.patient_id, patient_id)]
+
+    # Take the write lock before checking (SELECT ... FOR UPDATE for
+    # databases that have it, the database write lock on SQLite). Changes
+    # still pending in the session are flushed by the check, under the lock.
+    # A transaction that already read cannot wait for SQLite's lock if
+    # another process wrote since; that race is a conflict too, not an error.
+    try:
+        with db.session.no_autoflush:
+            for model, _, owner_id in owners:
+                if owner_id is not None:
+                    db.session.execute(
+                        update(model).where(model.id == owner_id).values(id=model.id)
+                        .execution_options(synchronize_session=False)
+                    )
+    except OperationalError as e:
+        if 'locked' not in str(e.orig):
+            raise
+        raise BookingConflict('Someone else is booking at the same time; please try again.') from e
+    for _, column, owner_id in owners:
+        if owner_id is not None:
+            appointment_id = _conflict_in_db(column, owner_id, start, end, ignore_id)
+            if appointment_id is not None:
+                raise BookingConflict('That time overlaps another appointment.', appointment_id)
+
@@ -0,0 +1,122 @@
+import re
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import selectinload
+
+from models import db, Caregiver
+
+# Columns of the caregiver table mirrored into the full-text index, in the
+# order they are declared on the FTS5 virtual table
+INDEXED_COLUMNS = ('qualification', 'services_offered', 'experience', 'location')
+
+# bm25() weights for the columns above: a hit on the qualification counts
+# more than one on the free-text experience or location
+COLUMN_WEIGHTS = (3.0, 2.0, 1.0, 1.0)
+
+DEFAULT_PER_PAGE = 20
+
+# Result orders: best text match first, or best rated match first
+SORT_ORDERS = ('relevance', 'rating')
+
+CREATE_INDEX_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS caregiver_fts USING fts5("
+    + ", ".join(INDEXED_COLUMNS)
+    + ", tokenize = 'porter unicode61')"
+)
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def ensure_search_index(connection=None):
+    # Create the FTS5 table if it is missing and fill it from the caregiver
+    # table the first time round
+    connection = connection or db.session.connection()
+    connection.execute(text(CREATE_INDEX_SQL))
+    indexed = connection.execute(text("SELECT count(*) FROM caregiver_fts")).scalar()
+    if not indexed:
+        rebuild_search_index(connection)
+
+
+def rebuild_search_index(connection=None):
+    connection = connection or db.session.connection()
+    columns = ", ".join(INDEXED_COLUMNS)
+    connection.execute(text("DELETE FROM caregiver_fts"))
+    connection.execute(text(
+        f"INSERT INTO caregiver_fts(rowid, {columns}) SELECT id, {columns} FROM caregiver"
+    ))
+
+
+def _index_row(connection, caregiver):
+    values = {column: getattr(caregiver, column) or '' for column in INDEXED_COLUMNS}
+    values['rowid'] = caregiver.id
+    placeholders = ", ".join(':' + column for column in INDEXED_COLUMNS)
+    connection.execute(
+        text(f"INSERT INTO caregiver_fts(rowid, {', '.join(INDEXED_COLUMNS)}) "
+             f"VALUES (:rowid, {placeholders})"),
+        values
+    )
+
+
+def _unindex_row(connection, caregiver_id):
+    connection.execute(text("DELETE FROM caregiver_fts WHERE rowid = :rowid"), {'rowid': caregiver_id})
+
+
+# Keep the index in step with the caregiver table. The listeners run on the
+# flush connection, so index writes commit or roll back with the row itself.
+@event.listens_for(Caregiver, 'after_insert')
+def _caregiver_inserted(mapper, connection, target):
+    _index_row(connection, target)
+
+
+@event.listens_for(Caregiver, 'after_update')
+def _caregiver_updated(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[column].history.has_changes() for column in INDEXED_COLUMNS):
+        _unindex_row(connection, target.id)
+        _index_row(connection, target)
+
+
+@event.listens_for(Caregiver, 'after_delete')
+def _caregiver_deleted(mapper, connection, target):
+    _unindex_row(connection, target.id)
+
+
+def build_match_query(requirements):
+    # Turn free text into an FTS5 expression. Every word is quoted so user
+    # input can never be parsed as FTS syntax, and prefix-matched so
+    # "nurs" finds "nurse" and "nursing". Words are OR'ed together and the
+    # ranking puts caregivers matching more of them first.
+    tokens = _TOKEN_RE.findall(requirements or '')
+    return " OR ".join('"{}"*'.format(token) for token in tokens)
+
+
+def find_caregivers(requirements, page=1, per_page=DEFAULT_PER_PAGE, sort='relevance'):
+    """Return ``(caregivers, total)`` for one page of ranked search results."""
+    match = build_match_query(requirements)
+    if not match:
+        return [], 0
+
+    page = max(int(page), 1)
+    weights = ", ".join(str(weight) for weight in COLUMN_WEIGHTS)
+    params = {'match': match, 'limit': per_page, 'offset': (page - 1) * per_page}
+
+    total = db.session.execute(
+        text("SELECT count(*) FROM caregiver_fts WHERE caregiver_fts MATCH :match"),
+        params
+    ).scalar()
+    if sort == 'rating':
+        # rating_score is stored on the caregiver row, so no reviews are aggregated
+        query = (f"SELECT caregiver_fts.rowid FROM caregiver_fts JOIN caregiver ON caregiver.id = caregiver_fts.rowid "
+                 f"WHERE caregiver_fts MATCH :match "
+                 f"ORDER BY caregiver.rating_score DESC, bm25(caregiver_fts, {weights}) LIMIT :limit OFFSET :offset")
+    else:
+        query = (f"SELECT rowid FROM caregiver_fts WHERE caregiver_fts MATCH :match "
+                 f"ORDER BY bm25(caregiver_fts, {weights}) LIMIT :limit OFFSET :offset")
+    ids = db.session.execute(text(query), params).scalars().all()
+    if not ids:
+        return [], total
+
+    # Load the page by primary key and put it back in rank order
+    caregivers = {c.id: c for c in Caregiver.query.options(selectinload(Caregiver.reviews))
+                  .filter(Caregiver.id.in_(ids))}
+    return [caregivers[i] for i in ids if i in caregivers], total
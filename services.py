@@ -0,0 +1,72 @@
+from models import db, Caregiver, CaregiverService
+from forms import CaregiverRegistrationForm
+
+# Every service gets a fixed bit position from its place in SERVICES_CHOICES,
+# so only ever append to that list: reordering it would change stored masks.
+SERVICES = [value for value, label in CaregiverRegistrationForm.SERVICES_CHOICES]
+SERVICE_BITS = {service: position for position, service in enumerate(SERVICES)}
+ALL_SERVICES_MASK = (1 << len(SERVICES)) - 1
+
+
+def services_to_mask(services):
+    # Unknown service names are ignored rather than raising, the form's
+    # choices already restrict what can be submitted
+    mask = 0
+    for service in services:
+        position = SERVICE_BITS.get(service.strip())
+        if position is not None:
+            mask |= 1 << position
+    return mask
+
+
+def mask_to_services(mask):
+    return [service for service, position in SERVICE_BITS.items() if mask & (1 << position)]
+
+
+def care_needed_to_mask(care_needed):
+    # care_needed is free text, so look for each known service name in it
+    text = (care_needed or '').lower()
+    return services_to_mask(service for service in SERVICES if service.lower() in text)
+
+
+def set_caregiver_services(caregiver, services):
+    # Keep the display string, the bitmask and the association rows in step
+    mask = services_to_mask(services)
+    caregiver.services_offered = ', '.join(mask_to_services(mask))
+    caregiver.services_mask = mask
+    caregiver.services = [CaregiverService(service_bit=SERVICE_BITS[service])
+                          for service in mask_to_services(mask)]
+    return mask
+
+
+def offers_all(services_mask, required_mask):
+    return services_mask & required_mask == required_mask
+
+
+def patient_matches(patient, caregiver):
+    # O(1) check of a caregiver against the services the patient needs
+    return offers_all(caregiver.services_mask, patient.care_needed_mask)
+
+
+def caregivers_offering(services):
+    """Query caregivers that offer every service in ``services``.
+
+    ``services`` is either a list of service names or an already built mask.
+    """
+    required = services if isinstance(services, int) else services_to_mask(services)
+    query = Caregiver.query
+    if not required:
+        return query
+
+    # Narrow the candidates through the indexed association table on one of
+    # the required services, then bit-test the remaining ones per row
+    first_bit = (required & -required).bit_length() - 1
+    candidates = db.select(CaregiverService.caregiver_id).where(CaregiverService.service_bit == first_bit)
+    query = query.filter(Caregiver.id.in_(candidates))
+    if required != 1 << first_bit:
+        query = query.filter(Caregiver.services_mask.op('&')(required) == required)
+    return query
+
+
+def caregivers_for_patient(patient):
+    return caregivers_offering(patient.care_needed_mask)
@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+
+from models import db, User
+
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300  # seconds
+
+
+class UserCache:
+    # Bounded LRU of detached User snapshots for Flask-Login's user_loader.
+    # A hit is merged into the request's session without loading, so the
+    # route gets a normal session-bound User and no SELECT is issued. Entries
+    # are dropped when a User is updated or deleted in this process, and
+    # expire after `ttl` seconds to bound staleness from other processes.
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _snapshot(self, user):
+        values = {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+        snapshot = User(**values)
+        make_transient_to_detached(snapshot)
+        return snapshot
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                snapshot = entry[1]
+            else:
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                snapshot = None
+
+        if snapshot is not None:
+            return db.session.merge(snapshot, load=False)
+
+        user = db.session.get(User, user_id)
+        if user is not None:
+            self.put(user)
+        return user
+
+    def put(self, user):
+        snapshot = self._snapshot(user)
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+user_cache = UserCache()
+
+
+# Drop the entry as soon as the change is flushed, and again once it commits
+# in case another request cached the old row in between
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    user_cache.invalidate(target.id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_users', set()).add(target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changed_users(session, previous_transaction):
+    session.info.pop('changed_users', None)